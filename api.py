@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import API_RESPONSES, API_SECONDS
+from upstream import UpstreamGuard, upstream_guard
+
+load_dotenv()
+
+
+class HotelsApi:
+	"""
+	Client of the hotels service on rapidapi.com.
+	Owns a keep-alive connection pool, the request headers and the limit of simultaneous requests per api key,
+	the requests pass through the guard of the quota and the circuit breakers of the endpoints
+	"""
+
+	def __init__(self, url_api: str, host: str, api_key: str, guard: UpstreamGuard, pool_size: int = 10,
+				 max_in_flight: int = 5, connect_timeout: float = 3.05, read_timeout: float = 15, retries: int = 3,
+				 read_retries: int = 0, backoff: float = 0.5):
+		self.__url_api = url_api
+		self.__guard = guard
+		self.__timeout = (connect_timeout, read_timeout)
+		self.__semaphore = threading.BoundedSemaphore(max_in_flight)
+		# a request that timed out while reading is not repeated past read_retries, a hung upstream must fail fast
+		# into the stale cache instead of holding the handler for several read timeouts
+		retry = Retry(total=retries, connect=retries, read=read_retries, status=retries, backoff_factor=backoff,
+					  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(['GET']),
+					  raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+		self.__session = requests.Session()
+		self.__session.mount('https://', adapter)
+		self.__session.mount('http://', adapter)
+		self.__session.headers.update({'x-rapidapi-host': host, 'x-rapidapi-key': api_key})
+
+	@property
+	def url_api(self):
+		return self.__url_api
+
+	def get(self, endpoint: str, params: dict) -> requests.Response:
+		"""
+		The function makes a GET request to the endpoint of the hotels service
+		:param endpoint: path of the endpoint, for example "properties/list"
+		:param params: query string parameters
+		:return: response of the service
+		:raise UpstreamUnavailable: if the guard rejects the request
+		"""
+		delay = self.__guard.acquire(endpoint)
+		if delay:
+			time.sleep(delay)
+		start = time.perf_counter()
+		try:
+			with self.__semaphore:
+				response = self.__session.get(self.__url_api + endpoint, params=params, timeout=self.__timeout)
+		except Exception:
+			API_RESPONSES.inc(endpoint, 'error')
+			self.__guard.record(endpoint, None)
+			raise
+		except BaseException:
+			self.__guard.release(endpoint)
+			raise
+		finally:
+			API_SECONDS.observe(time.perf_counter() - start, endpoint)
+		API_RESPONSES.inc(endpoint, str(response.status_code))
+		self.__guard.record(endpoint, response.status_code, response.headers)
+		return response
+
+	def close(self) -> None:
+		"""
+		The function closes all connections of the pool
+		:return: None
+		"""
+		self.__session.close()
+
+
+hotels_api = HotelsApi(url_api=os.getenv('url_api', ''),
+					   host=os.getenv('x-rapidapi-host', ''),
+					   api_key=os.getenv('HOTELS_RU_TOKEN', ''),
+					   guard=upstream_guard,
+					   pool_size=int(os.getenv('API_POOL_SIZE', 10)),
+					   max_in_flight=int(os.getenv('MAX_REQUESTS_PER_KEY', 5)),
+					   connect_timeout=float(os.getenv('API_CONNECT_TIMEOUT', 3.05)),
+					   read_timeout=float(os.getenv('API_READ_TIMEOUT', 15)),
+					   retries=int(os.getenv('API_RETRIES', 3)),
+					   read_retries=int(os.getenv('API_READ_RETRIES', 0)),
+					   backoff=float(os.getenv('API_BACKOFF', 0.5)))
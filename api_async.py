@@ -0,0 +1,103 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
+import aiohttp
+from dotenv import load_dotenv
+
+from metrics import API_RESPONSES, API_SECONDS
+from upstream import UpstreamGuard, upstream_guard
+
+load_dotenv()
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class AsyncHotelsApi:
+	"""
+	Asynchronous client of the hotels service on rapidapi.com.
+	Owns a keep-alive connection pool, the request headers and the limit of simultaneous requests per api key,
+	the requests pass through the guard of the quota and the circuit breakers of the endpoints
+	"""
+
+	def __init__(self, url_api: str, host: str, api_key: str, guard: UpstreamGuard, pool_size: int = 10,
+				 max_in_flight: int = 5, connect_timeout: float = 3.05, read_timeout: float = 15, retries: int = 3,
+				 read_retries: int = 0, backoff: float = 0.5):
+		self.__url_api = url_api
+		self.__guard = guard
+		self.__headers = {'x-rapidapi-host': host, 'x-rapidapi-key': api_key}
+		self.__pool_size = pool_size
+		self.__max_in_flight = max_in_flight
+		self.__timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+		self.__retries = retries
+		self.__read_retries = read_retries
+		self.__backoff = backoff
+		self.__session: Optional[aiohttp.ClientSession] = None
+		self.__semaphore: Optional[asyncio.Semaphore] = None
+
+	async def get(self, endpoint: str, params: dict) -> tuple:
+		"""
+		The function makes a GET request to the endpoint of the hotels service
+		and repeats it with exponential backoff on connection errors and temporary failures,
+		a timed out request is repeated at most read_retries times so that a hung upstream fails fast
+		:param endpoint: path of the endpoint, for example "properties/list"
+		:param params: query string parameters
+		:return: status code and text of the response
+		:raise UpstreamUnavailable: if the guard rejects the request
+		"""
+		delay = self.__guard.acquire(endpoint)
+		if self.__session is None:
+			self.__session = aiohttp.ClientSession(headers=self.__headers, timeout=self.__timeout,
+												   connector=aiohttp.TCPConnector(limit=self.__pool_size))
+			self.__semaphore = asyncio.Semaphore(self.__max_in_flight)
+		params = {key: str(value) for key, value in params.items()}
+		start = time.perf_counter()
+		timeouts = 0
+		try:
+			if delay:
+				await asyncio.sleep(delay)
+			for attempt in range(self.__retries + 1):
+				try:
+					async with self.__semaphore:
+						async with self.__session.get(self.__url_api + endpoint, params=params) as response:
+							status, text = response.status, await response.text()
+					if status not in RETRY_STATUSES or attempt == self.__retries:
+						API_RESPONSES.inc(endpoint, str(status))
+						self.__guard.record(endpoint, status, response.headers)
+						return status, text
+				except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+					if isinstance(error, asyncio.TimeoutError):
+						timeouts += 1
+					if attempt == self.__retries or timeouts > self.__read_retries:
+						API_RESPONSES.inc(endpoint, 'error')
+						self.__guard.record(endpoint, None)
+						raise
+				await asyncio.sleep(self.__backoff * 2 ** attempt)
+		except asyncio.CancelledError:
+			self.__guard.release(endpoint)
+			raise
+		finally:
+			API_SECONDS.observe(time.perf_counter() - start, endpoint)
+
+	async def close(self) -> None:
+		"""
+		The function closes all connections of the pool
+		:return: None
+		"""
+		if self.__session is not None:
+			await self.__session.close()
+			self.__session = None
+
+
+async_hotels_api = AsyncHotelsApi(url_api=os.getenv('url_api', ''),
+								  host=os.getenv('x-rapidapi-host', ''),
+								  api_key=os.getenv('HOTELS_RU_TOKEN', ''),
+								  guard=upstream_guard,
+								  pool_size=int(os.getenv('API_POOL_SIZE', 10)),
+								  max_in_flight=int(os.getenv('MAX_REQUESTS_PER_KEY', 5)),
+								  connect_timeout=float(os.getenv('API_CONNECT_TIMEOUT', 3.05)),
+								  read_timeout=float(os.getenv('API_READ_TIMEOUT', 15)),
+								  retries=int(os.getenv('API_RETRIES', 3)),
+								  read_retries=int(os.getenv('API_READ_RETRIES', 0)),
+								  backoff=float(os.getenv('API_BACKOFF', 0.5)))
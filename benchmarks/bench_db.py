@@ -0,0 +1,84 @@
+"""
+Latency of db.get_last_request_fields and db.get_history on a history table of the given size.
+The queries are measured with the indexes of the current schema and without them.
+
+Usage: python benchmarks/bench_db.py [--rows 1000000] [--users 10000] [--repeat 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+
+def fill_history(cur, rows: int, users: int) -> None:
+	"""
+	The function fills the history table with synthetic requests
+	:param cur: connection to the database
+	:param rows: number of requests
+	:param users: number of users
+	:return: None
+	"""
+	batch = []
+	for _ in range(rows):
+		batch.append((random.randrange(users), '2022-01-01', '/lowprice', 549499, 'London', '2022-02-01',
+					  '2022-02-03', 2, 5, '[]'))
+		if len(batch) == 10000:
+			cur.executemany("INSERT INTO history VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+			batch.clear()
+	cur.executemany("INSERT INTO history VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+
+
+def measure(func, args_list: list) -> dict:
+	"""
+	The function calls func for each set of arguments and returns latency percentiles in milliseconds
+	:param func: measured function
+	:param args_list: list of argument tuples
+	:return: dictionary of latency percentiles
+	"""
+	timings = []
+	for args in args_list:
+		start = time.perf_counter()
+		func(*args)
+		timings.append((time.perf_counter() - start) * 1000)
+	timings.sort()
+	return {'p50': statistics.median(timings), 'p95': timings[int(len(timings) * 0.95) - 1], 'max': timings[-1]}
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--rows', type=int, default=1_000_000)
+	parser.add_argument('--users', type=int, default=10_000)
+	parser.add_argument('--repeat', type=int, default=200)
+	options = parser.parse_args()
+
+	os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	import db
+
+	start = time.perf_counter()
+	with db.get_connection() as connection:
+		fill_history(connection, options.rows, options.users)
+	print(f'history: {options.rows} rows, {options.users} users, filled in {time.perf_counter() - start:.1f} s')
+
+	users = [random.randrange(options.users) for _ in range(options.repeat)]
+	messages = [(SimpleNamespace(from_user=SimpleNamespace(id=id_user)),) for id_user in users]
+	for title in ('with indexes', 'without indexes'):
+		if title == 'without indexes':
+			db.get_connection().execute('DROP INDEX history_id_user_id_request')
+			repeat = max(options.repeat // 20, 5)
+		else:
+			repeat = options.repeat
+		for name, func, args in (('get_last_request_fields', db.get_last_request_fields,
+								  [(id_user,) for id_user in users]),
+								 ('get_history', db.get_history, messages)):
+			result = measure(func, args[:repeat])
+			print(f'{title:16} {name:23} p50={result["p50"]:.3f} ms p95={result["p95"]:.3f} ms '
+				  f'max={result["max"]:.3f} ms')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,234 @@
+"""
+Micro-benchmarks of the most called functions of db.py, func.py and date_calendar.py on a synthetic database
+of the given size and on recorded answers of the hotels service from benchmarks/payloads.
+Every benchmark is timed in --repeat samples of --number calls, the statistics of the time per call
+are written to json, and a previous json can be compared to find regressions between releases.
+
+Usage: python benchmarks/bench_hot.py [--requests 200000] [--users 20000] [--hotels 15] [--repeat 20]
+	   [--number 200] [--filter db.] [--output results.json] [--compare baseline.json] [--threshold 1.2]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAYLOADS = os.path.join(ROOT, 'benchmarks', 'payloads')
+
+BENCHMARKS = []
+
+
+def benchmark(name: str):
+	"""
+	The function returns a decorator registering the setup of a benchmark.
+	The setup receives the context of the suite and returns the measured function and the list of its arguments
+	:param name: name of the benchmark
+	:return: decorator
+	"""
+
+	def decorator(setup):
+		BENCHMARKS.append((name, setup))
+		return setup
+
+	return decorator
+
+
+@benchmark('db.get_last_request_fields')
+def bench_get_last_request_fields(context: SimpleNamespace) -> tuple:
+	return context.db.get_last_request_fields, [(id_user,) for id_user in context.users]
+
+
+@benchmark('db.get_history')
+def bench_get_history(context: SimpleNamespace) -> tuple:
+	messages = [(SimpleNamespace(from_user=SimpleNamespace(id=id_user)),) for id_user in context.users]
+	return context.db.get_history, messages
+
+
+@benchmark('db.get_last_request')
+def bench_get_last_request(context: SimpleNamespace) -> tuple:
+	return context.db.get_last_request, [(id_user,) for id_user in context.users]
+
+
+@benchmark('db.update_requests')
+def bench_update_requests(context: SimpleNamespace) -> tuple:
+	record = context.db.RequestRecord('2022-02-01', '2022-02-03', '/lowprice', 549499, 'London', 2, 5, context.hotels)
+	return context.db.update_requests, [([(id_request, record)],) for id_request in context.requests]
+
+
+@benchmark('func.form_message')
+def bench_form_message(context: SimpleNamespace) -> tuple:
+	for id_user in context.users:
+		context.conversations.get(id_user)  # the conversations of the dialog are in memory
+	return context.func.form_message, [(id_user,) for id_user in context.users]
+
+
+@benchmark('func.parse_properties')
+def bench_parse_properties(context: SimpleNamespace) -> tuple:
+	text = context.payloads['properties_list']
+	return lambda: context.func.parse_properties(json.loads(text)), [()]
+
+
+@benchmark('func.parse_district')
+def bench_parse_district(context: SimpleNamespace) -> tuple:
+	text = context.payloads['locations_search']
+	return lambda: context.func.parse_district(json.loads(text)), [()]
+
+
+@benchmark('date_calendar.process_calendar')
+def bench_process_calendar(context: SimpleNamespace) -> tuple:
+	today = datetime.date.today()
+	list_data = []
+	for days in range(0, 56, 7):
+		date = today + datetime.timedelta(days=days)
+		list_data.append((f'cal_f_s_m_{date:%Y%m}01_{today:%Y%m%d}_29991231',))  # a page of days from the cache
+		list_data.append((f'cal_f_s_d_{date:%Y%m%d}_{today:%Y%m%d}_29991231',))
+	return context.date_calendar.process_calendar, list_data
+
+
+def fill_database(db, requests: int, users: int, list_hotels: list) -> None:
+	"""
+	The function fills the users, history and hotel_results tables with synthetic requests,
+	every request has the hotels of the recorded answer in random order
+	:param db: module db
+	:param requests: number of requests
+	:param users: number of users
+	:param list_hotels: hotels of the recorded answer
+	:return: None
+	"""
+	fields = [tuple(hotel[field] for field in db.HOTEL_FIELDS) for hotel in list_hotels]
+	with db.get_connection() as connection:
+		connection.executemany("INSERT INTO users VALUES (NULL, ?, 'user', '', '')", [(i,) for i in range(users)])
+		for first in range(1, requests + 1, 10000):
+			ids = range(first, min(first + 10000, requests + 1))
+			connection.executemany("INSERT INTO history VALUES (?, ?, '2022-01-01', ?, 549499, 'London', "
+								   "'2022-02-01', '2022-02-03', 2, 5, NULL)",
+								   [(id_request, random.randrange(users),
+									 random.choice(('/lowprice', '/highprice', '/bestdeal'))) for id_request in ids])
+			connection.executemany("INSERT INTO hotel_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+								   [(id_request, position) + hotel for id_request in ids
+									for position, hotel in enumerate(random.sample(fields, len(fields)))])
+
+
+def run_benchmark(func, args_list: list, repeat: int, number: int) -> dict:
+	"""
+	The function times the function in repeat samples of number calls with the arguments taken in turn
+	:param func: measured function
+	:param args_list: list of argument tuples
+	:param repeat: number of samples
+	:param number: number of calls in a sample
+	:return: statistics of the time per call in microseconds
+	"""
+	calls = [args_list[index % len(args_list)] for index in range(number)]
+	for args in calls[:max(1, number // 10)]:
+		func(*args)
+	samples = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		for args in calls:
+			func(*args)
+		samples.append((time.perf_counter() - start) / number * 10 ** 6)
+	samples.sort()
+	return {'unit': 'us', 'min': samples[0], 'median': statistics.median(samples), 'mean': statistics.mean(samples),
+			'p95': samples[max(0, -(-len(samples) * 95 // 100) - 1)],
+			'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0, 'repeat': repeat, 'number': number}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+	"""
+	The function compares the medians of the benchmarks with the baseline
+	:param results: results of the current run
+	:param baseline: results of the previous run
+	:param threshold: ratio of the medians considered a regression
+	:return: list of names of the regressed benchmarks
+	"""
+	regressions = []
+	for name, stats in results.items():
+		if name not in baseline:
+			continue
+		ratio = stats['median'] / baseline[name]['median']
+		mark = 'REGRESSION' if ratio > threshold else 'improved' if ratio < 1 / threshold else ''
+		print(f'{name:28} {baseline[name]["median"]:10.2f} us -> {stats["median"]:10.2f} us  x{ratio:.2f} {mark}')
+		if ratio > threshold:
+			regressions.append(name)
+	return regressions
+
+
+def git_commit() -> str:
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+							  text=True).stdout.strip()
+	except OSError:
+		return ''
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--requests', type=int, default=200_000)
+	parser.add_argument('--users', type=int, default=20_000)
+	parser.add_argument('--sample', type=int, default=1000, help='number of random users and requests called')
+	parser.add_argument('--repeat', type=int, default=20)
+	parser.add_argument('--number', type=int, default=200)
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--filter', default='', help='run only the benchmarks whose name contains the text')
+	parser.add_argument('--output', help='path of the results in json')
+	parser.add_argument('--compare', help='path of the results of a previous run')
+	parser.add_argument('--threshold', type=float, default=1.2, help='ratio of the medians reported as a regression')
+	options = parser.parse_args()
+
+	random.seed(options.seed)
+	directory = tempfile.mkdtemp()
+	os.environ['DB_PATH'] = os.path.join(directory, 'bench.db')
+	sys.path.insert(0, ROOT)
+	import date_calendar
+	import db
+	import func
+	from conversation import conversations
+
+	payloads = {}
+	for file_name in sorted(os.listdir(PAYLOADS)):
+		with open(os.path.join(PAYLOADS, file_name), encoding='utf-8') as file:
+			payloads[os.path.splitext(file_name)[0]] = file.read()
+	list_hotels = func.parse_properties(json.loads(payloads['properties_list']))
+	start = time.perf_counter()
+	fill_database(db, options.requests, options.users, list_hotels)
+	print(f'{options.requests} requests of {options.users} users x {len(list_hotels)} hotels, '
+		  f'filled in {time.perf_counter() - start:.1f} s')
+
+	users = [row[0] for row in db.get_connection().execute('SELECT DISTINCT id_user FROM history')]
+	context = SimpleNamespace(db=db, func=func, date_calendar=date_calendar, conversations=conversations,
+							  payloads=payloads, hotels=list_hotels,
+							  users=random.sample(users, min(options.sample, len(users))),
+							  requests=random.sample(range(1, options.requests + 1),
+													 min(options.sample, options.requests)))
+	results = {}
+	for name, setup in BENCHMARKS:
+		if options.filter in name:
+			func_benchmark, args_list = setup(context)
+			results[name] = stats = run_benchmark(func_benchmark, args_list, options.repeat, options.number)
+			print(f'{name:28} median={stats["median"]:10.2f} us min={stats["min"]:10.2f} us '
+				  f'p95={stats["p95"]:10.2f} us stdev={stats["stdev"]:8.2f} us')
+
+	if options.output:
+		report = {'meta': {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+						   'python': platform.python_version(), 'sqlite': db.sqlite3.sqlite_version,
+						   'machine': platform.machine(), 'options': vars(options)},
+				  'results': results}
+		with open(options.output, 'w') as file:
+			json.dump(report, file, indent=2)
+	if options.compare:
+		with open(options.compare) as file:
+			regressions = compare(results, json.load(file)['results'], options.threshold)
+		if regressions:
+			sys.exit(f'Regressions: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,111 @@
+"""
+Size and decode time of hotel results stored as a json blob in history.response
+compared with the normalised hotel_results table.
+
+Usage: python benchmarks/bench_results.py [--requests 100000] [--hotels 15] [--repeat 2000]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+
+def make_hotels(count: int) -> list:
+	"""
+	The function returns a list of synthetic hotels in the format of func.parse_properties
+	:param count: number of hotels
+	:return: list of hotels
+	"""
+	list_hotels = []
+	for _ in range(count):
+		id_hotel = str(random.randrange(100000, 9999999))
+		list_hotels.append({'id': id_hotel, 'name': f'Hotel {random.randrange(10 ** 6)} Central Park Residence',
+							'current': round(random.uniform(50, 900), 2),
+							'address': f'London, {random.randrange(1, 300)} Oxford Street',
+							'distance': f'{random.uniform(0.1, 20):.1f} miles',
+							'url': f'https://ru.hotels.com/ho{id_hotel}'})
+	return list_hotels
+
+
+def database_size(connection: sqlite3.Connection) -> int:
+	"""
+	The function returns the size of the database in bytes after VACUUM
+	:param connection: connection to the database
+	:return: size of the database
+	"""
+	connection.execute('VACUUM')
+	return connection.execute('PRAGMA page_count').fetchone()[0] * connection.execute('PRAGMA page_size').fetchone()[0]
+
+
+def measure(func, args_list: list) -> dict:
+	"""
+	The function calls func for each set of arguments and returns latency percentiles in microseconds
+	:param func: measured function
+	:param args_list: list of argument tuples
+	:return: dictionary of latency percentiles
+	"""
+	timings = []
+	for args in args_list:
+		start = time.perf_counter()
+		func(*args)
+		timings.append((time.perf_counter() - start) * 10 ** 6)
+	timings.sort()
+	return {'p50': statistics.median(timings), 'p95': timings[int(len(timings) * 0.95) - 1]}
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--requests', type=int, default=100_000)
+	parser.add_argument('--hotels', type=int, default=15)
+	parser.add_argument('--repeat', type=int, default=2000)
+	options = parser.parse_args()
+
+	directory = tempfile.mkdtemp()
+	os.environ['DB_PATH'] = os.path.join(directory, 'results.db')
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	import db
+
+	blob_connection = sqlite3.connect(os.path.join(directory, 'blob.db'))
+	blob_connection.execute('CREATE TABLE history (id_request INTEGER PRIMARY KEY NOT NULL, response TEXT)')
+	record = db.RequestRecord('2022-02-01', '2022-02-03', '/lowprice', 549499, 'London', 2, 5, None)
+	for first in range(1, options.requests + 1, 1000):
+		ids = range(first, min(first + 1000, options.requests + 1))
+		batch = [(id_request, make_hotels(options.hotels)) for id_request in ids]
+		blob_connection.executemany('INSERT INTO history VALUES (?, ?)',
+									[(id_request, json.dumps(hotels)) for id_request, hotels in batch])
+		with db.get_connection() as connection:
+			connection.executemany("INSERT INTO history (id_request, id_user) VALUES (?, 0)", [(i,) for i in ids])
+		db.update_requests([(id_request, record._replace(hotels=hotels)) for id_request, hotels in batch])
+	blob_connection.commit()
+	with db.get_connection() as connection:
+		connection.execute('DELETE FROM history')  # only the storage of the results is compared
+	print(f'{options.requests} requests x {options.hotels} hotels')
+	print(f'size: json blob {database_size(blob_connection) / 2 ** 20:.1f} MiB, '
+		  f'hotel_results {database_size(db.get_connection()) / 2 ** 20:.1f} MiB')
+
+	def blob(id_request: int, limit: int = None) -> list:
+		row = blob_connection.execute('SELECT response FROM history WHERE id_request=?', (id_request,)).fetchone()
+		return json.loads(row[0])[:limit]
+
+	args = [(random.randrange(1, options.requests + 1),) for _ in range(options.repeat)]
+	cases = (('all hotels, all fields', blob, lambda id_request: db.get_hotel_results(id_request)),
+			 ('5 hotels, all fields (form_message)', lambda id_request: blob(id_request, 5),
+			  lambda id_request: db.get_hotel_results(id_request, limit=5)),
+			 ('5 hotels, id (get_photo_hotel)', lambda id_request: [hotel['id'] for hotel in blob(id_request, 5)],
+			  lambda id_request: db.get_hotel_results(id_request, ('id',), 5)),
+			 ('all hotels, 3 fields (history)',
+			  lambda id_request: [(hotel['name'], hotel['current'], hotel['url']) for hotel in blob(id_request)],
+			  lambda id_request: db.get_hotel_results(id_request, ('name', 'current', 'url'))))
+	for title, blob_func, table_func in cases:
+		blob_result, table_result = measure(blob_func, args), measure(table_func, args)
+		print(f'{title:38} json blob p50={blob_result["p50"]:.1f} us p95={blob_result["p95"]:.1f} us   '
+			  f'hotel_results p50={table_result["p50"]:.1f} us p95={table_result["p95"]:.1f} us')
+
+
+if __name__ == '__main__':
+	main()
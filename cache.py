@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from metrics import CACHE_REQUESTS
+
+
+class TTLCache:
+	"""
+	Thread-safe in-memory LRU cache with a limited lifetime of entries.
+	Lookups of a named cache are counted as hits and misses in the metrics
+	"""
+
+	def __init__(self, maxsize: int, ttl: float, name: Optional[str] = None):
+		self.__maxsize = maxsize
+		self.__ttl = ttl
+		self.__name = name
+		self.__data = OrderedDict()
+		self.__lock = threading.Lock()
+
+	@property
+	def ttl(self):
+		return self.__ttl
+
+	def get(self, key: Hashable, default: Any = None, stale: bool = False) -> Any:
+		"""
+		The function returns the cached value if it has not expired.
+		Expired entries stay in the cache until they are evicted, so they can be served when the source fails
+		:param key: cache key
+		:param default: value returned if the key is missing or expired
+		:param stale: return the value even if it has expired
+		:return: cached value or default
+		"""
+		with self.__lock:
+			item = self.__data.get(key)
+			expired = item is not None and item[0] < time.monotonic()
+			if item is not None and (stale or not expired):
+				self.__data.move_to_end(key)
+			else:
+				item = None
+		if self.__name is not None:
+			CACHE_REQUESTS.inc(self.__name, 'miss' if item is None else 'stale' if expired else 'hit')
+		return default if item is None else item[1]
+
+	def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+		"""
+		The function puts the value into the cache and evicts the least recently used entries over the limit
+		:param key: cache key
+		:param value: value to cache
+		:param ttl: lifetime of the entry in seconds, by default the lifetime of the cache
+		:return: None
+		"""
+		with self.__lock:
+			self.__data[key] = (time.monotonic() + (self.__ttl if ttl is None else ttl), value)
+			self.__data.move_to_end(key)
+			while len(self.__data) > self.__maxsize:
+				self.__data.popitem(last=False)
+
+	def delete(self, key: Hashable) -> None:
+		"""
+		The function removes the entry from the cache
+		:param key: cache key
+		:return: None
+		"""
+		with self.__lock:
+			self.__data.pop(key, None)
+
+	def clear(self) -> None:
+		"""
+		The function removes all entries from the cache
+		:return: None
+		"""
+		with self.__lock:
+			self.__data.clear()
+
+	def __len__(self):
+		return len(self.__data)
+
+
+class SingleFlight:
+	"""
+	Coalesces concurrent identical calls: while a call for the key is running,
+	other callers with the same key wait for its result instead of repeating it
+	"""
+
+	def __init__(self):
+		self.__calls = {}
+		self.__lock = threading.Lock()
+
+	def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+		"""
+		The function runs func once for all simultaneous callers with the same key
+		:param key: key of the call
+		:param func: function without arguments
+		:return: result of func
+		"""
+		with self.__lock:
+			future = self.__calls.get(key)
+			leader = future is None
+			if leader:
+				future = Future()
+				self.__calls[key] = future
+		if not leader:
+			return future.result()
+		try:
+			future.set_result(func())
+		except BaseException as ex:
+			future.set_exception(ex)
+		finally:
+			with self.__lock:
+				del self.__calls[key]
+		return future.result()
+
+
+class AsyncSingleFlight:
+	"""
+	Coalesces concurrent identical coroutine calls within one event loop
+	"""
+
+	def __init__(self):
+		self.__calls = {}
+
+	async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Any:
+		"""
+		The function awaits func once for all simultaneous callers with the same key
+		:param key: key of the call
+		:param func: coroutine function without arguments
+		:return: result of func
+		"""
+		task = self.__calls.get(key)
+		if task is None:
+			task = asyncio.ensure_future(func())
+			self.__calls[key] = task
+			task.add_done_callback(lambda _: self.__calls.pop(key, None))
+		return await asyncio.shield(task)
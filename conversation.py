@@ -0,0 +1,189 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+from telebot.types import Message
+
+import db
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.getenv('CONVERSATION_FLUSH_INTERVAL', 1))
+IDLE_TIMEOUT = float(os.getenv('CONVERSATION_IDLE_TIMEOUT', 60 * 60))
+
+
+class Conversation:
+	"""
+	State of the current search request of the user kept in memory.
+	Fields match the columns of the history table, hotels holds the rows of the hotel_results table
+	"""
+	__slots__ = ('id_request', 'date_from', 'date_to', 'command', 'id_destination', 'name_destination', 'q_days',
+				 'q_hotels', 'hotels', 'dirty', 'hotels_dirty', 'last_access')
+
+	def __init__(self, id_request: int, record: db.RequestRecord):
+		self.id_request = id_request
+		for field, value in zip(db.RequestRecord._fields, record):
+			setattr(self, field, value)
+		self.dirty = False
+		self.hotels_dirty = False
+		self.last_access = time.monotonic()
+
+	def record(self) -> db.RequestRecord:
+		"""
+		The function returns the request data for writing to the database.
+		The hotels are passed only if they have changed since the last write
+		:return: request data
+		"""
+		record = db.RequestRecord(*(getattr(self, field) for field in db.RequestRecord._fields))
+		return record if self.hotels_dirty else record._replace(hotels=None)
+
+
+class ConversationStore:
+	"""
+	Write-behind store of user conversations.
+	Handlers read and update conversations in memory, changes are written to the database
+	in batched transactions at checkpoints (a new command, both dates picked, the hotel list received)
+	and by a background timer, a crash loses at most the changes of the last flush interval
+	while the step of the dialog itself is kept by the dialog store.
+	The dialog of a chat may continue in another process after a restart, so a step that uses the conversation
+	starts with resume, which checks a conversation without unwritten changes against the database
+	"""
+
+	def __init__(self, flush_interval: float, idle_timeout: float):
+		self.__flush_interval = flush_interval
+		self.__idle_timeout = idle_timeout
+		self.__conversations = {}
+		self.__lock = threading.Lock()
+		self.__flush_lock = threading.Lock()
+		self.__timer = None
+
+	def start(self, message: Message, id_user: int) -> Conversation:
+		"""
+		The function creates a new request of the user in the database and in memory
+		:param message: object of type Message of class telebot
+						message.text contains the command sent to the bot
+		:param id_user: unique user number
+		:return: conversation of the user
+		"""
+		self.flush()
+		id_request = db.create_new_request(message, id_user)
+		conversation = Conversation(id_request, db.RequestRecord('', '', message.text, 0, '', 1, 0, []))
+		with self.__lock:
+			self.__conversations[id_user] = conversation
+		self.__start_timer()
+		return conversation
+
+	def get(self, id_user: int) -> Optional[Conversation]:
+		"""
+		The function returns the conversation of the user, loading the last request from the database if necessary
+		:param id_user: unique user number
+		:return: conversation of the user or None if the user has no requests
+		"""
+		with self.__lock:
+			conversation = self.__conversations.get(id_user)
+		if conversation is None:
+			last_request = db.get_last_request(id_user)
+			if last_request is None:
+				return None
+			with self.__lock:
+				conversation = self.__conversations.setdefault(id_user, Conversation(*last_request))
+		conversation.last_access = time.monotonic()
+		return conversation
+
+	def resume(self, id_user: int) -> Optional[Conversation]:
+		"""
+		The function returns the conversation of the user checked against the last request in the database.
+		The conversation is reloaded if another process has started a newer request or changed the request,
+		a conversation with unwritten changes is the newest state of the chat, since the updates of a chat
+		are handled by one process at a time, and is returned without reading the database
+		:param id_user: unique user number
+		:return: conversation of the user or None if the user has no requests
+		"""
+		with self.__lock:
+			conversation = self.__conversations.get(id_user)
+		if conversation is not None and conversation.dirty:
+			conversation.last_access = time.monotonic()
+			return conversation
+		with self.__flush_lock:  # a flush in progress has cleared the dirty flags but not yet written the changes
+			row = db.get_last_request_fields(id_user)
+			if row is None:
+				return None
+			if conversation is None or (conversation.id_request, *conversation.record()[:-1]) != tuple(row):
+				conversation = Conversation(row[0], db.RequestRecord(*row[1:], db.get_hotel_results(row[0])))
+				with self.__lock:
+					self.__conversations[id_user] = conversation
+		conversation.last_access = time.monotonic()
+		return conversation
+
+	def update(self, id_user: int, **fields) -> None:
+		"""
+		The function changes the fields of the conversation of the user in memory
+		:param id_user: unique user number
+		:param fields: new values of the request fields
+		:return: None
+		"""
+		conversation = self.get(id_user)
+		with self.__lock:
+			for field, value in fields.items():
+				setattr(conversation, field, value)
+			conversation.dirty = True
+			conversation.hotels_dirty = conversation.hotels_dirty or 'hotels' in fields
+		self.__start_timer()
+
+	def flush(self) -> None:
+		"""
+		The function writes all changed conversations to the database in one transaction
+		and forgets conversations that have not been used for a long time
+		:return: None
+		"""
+		with self.__flush_lock:
+			now = time.monotonic()
+			with self.__lock:
+				list_requests = []
+				for id_user, conversation in list(self.__conversations.items()):
+					if conversation.dirty:
+						list_requests.append((conversation.id_request, conversation.record()))
+						conversation.dirty = conversation.hotels_dirty = False
+					elif now - conversation.last_access > self.__idle_timeout:
+						del self.__conversations[id_user]
+			if not list_requests:
+				return
+			try:
+				db.update_requests(list_requests)
+			except Exception as ex:
+				logger.error(f'Ошибка записи запросов в базу данных', exc_info=ex)
+				failed = {id_request: record.hotels is not None for id_request, record in list_requests}
+				with self.__lock:
+					for conversation in self.__conversations.values():
+						if conversation.id_request in failed:
+							conversation.dirty = True
+							conversation.hotels_dirty = conversation.hotels_dirty or failed[conversation.id_request]
+
+	def __start_timer(self) -> None:
+		"""
+		The function starts the background thread that periodically writes changes to the database
+		:return: None
+		"""
+		if self.__timer is None:
+			with self.__lock:
+				if self.__timer is None:
+					self.__timer = threading.Thread(target=self.__run_timer, name='conversation-flush', daemon=True)
+					self.__timer.start()
+
+	def __run_timer(self) -> None:
+		"""
+		The function writes changes to the database every flush interval
+		:return: None
+		"""
+		while True:
+			time.sleep(self.__flush_interval)
+			self.flush()
+
+
+conversations = ConversationStore(FLUSH_INTERVAL, IDLE_TIMEOUT)
+atexit.register(conversations.flush)
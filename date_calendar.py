@@ -0,0 +1,133 @@
+import datetime
+import os
+from typing import NamedTuple, Optional
+
+from dotenv import load_dotenv
+from telegram_bot_calendar import DetailedTelegramCalendar
+from telegram_bot_calendar.base import DAY, GOTO, NOTHING, SELECT, YEAR
+from telegram_bot_calendar.detailed import STEPS
+
+from cache import TTLCache
+
+load_dotenv()
+
+CALENDAR_CACHE_SIZE = int(os.getenv('CALENDAR_CACHE_SIZE', 1000))
+CALENDAR_LOCALE = 'ru'
+CALLBACK_PREFIX = 'cal'
+STAGE_DATE_FROM = 'f'
+STAGE_DATE_TO = 't'
+DATE_FORMAT = '%Y%m%d'
+NO_MAX_DATE = datetime.date(2999, 12, 31)
+
+keyboards_cache = TTLCache(CALENDAR_CACHE_SIZE, float('inf'), name='calendar')
+
+
+class CalendarAnswer(NamedTuple):
+	"""
+	Result of the click on a button of the calendar
+	"""
+	stage: Optional[str]
+	result: Optional[datetime.date]
+	keyboard: Optional[str]
+	step: Optional[str]
+	min_date: Optional[datetime.date]
+
+
+class StatelessCalendar(DetailedTelegramCalendar):
+	"""
+	Calendar keeping the stage of the search dialog and the bounds of the dates in the callback data of its buttons,
+	so a click is processed without the state of the conversation.
+	The callback data is cal_<stage>_<action>_<step>_<date>_<min date>_<max date> with dates as YYYYMMDD,
+	at most 36 bytes of the 64 allowed by Telegram
+	"""
+
+	def __init__(self, stage: str, min_date: datetime.date, max_date: Optional[datetime.date],
+				 current_date: Optional[datetime.date] = None, locale: str = CALENDAR_LOCALE):
+		super().__init__(calendar_id=stage, current_date=current_date or min_date, locale=locale,
+						 min_date=min_date, max_date=max_date or NO_MAX_DATE)
+
+	def _build_callback(self, action: str, step: str, data: datetime.date, *args, **kwargs) -> str:
+		if action == NOTHING:
+			return f'{CALLBACK_PREFIX}_{self.calendar_id}_{NOTHING}'
+		return (f'{CALLBACK_PREFIX}_{self.calendar_id}_{action}_{step}_{data:{DATE_FORMAT}}_'
+				f'{self.min_date:{DATE_FORMAT}}_{self.max_date:{DATE_FORMAT}}')
+
+	def render(self, step: str) -> str:
+		"""
+		The function builds the keyboard of the step
+		:param step: y for years, m for months or d for days
+		:return: inline keyboard in json
+		"""
+		self._build(step=step)
+		return self._keyboard
+
+
+def _page(step: str, current_date: datetime.date) -> datetime.date:
+	"""
+	The function returns the first date of the page of the calendar, so every page has one key in the cache
+	:param step: y for years, m for months or d for days
+	:param current_date: any date of the page
+	:return: first day of the month for days and first day of the year for months and years
+	"""
+	return current_date.replace(day=1) if step == DAY else current_date.replace(month=1, day=1)
+
+
+def render_calendar(stage: str, step: str, current_date: datetime.date, min_date: datetime.date,
+					max_date: Optional[datetime.date], locale: str = CALENDAR_LOCALE) -> str:
+	"""
+	The function returns the keyboard of the page of the calendar from the cache or builds it
+	:param stage: STAGE_DATE_FROM or STAGE_DATE_TO
+	:param step: y for years, m for months or d for days
+	:param current_date: any date of the page
+	:param min_date: first date that may be selected
+	:param max_date: last date that may be selected or None
+	:param locale: language of the names of the months and the days
+	:return: inline keyboard in json
+	"""
+	page = _page(step, current_date)
+	key = (locale, stage, step, page, min_date, max_date or NO_MAX_DATE)
+	keyboard = keyboards_cache.get(key)
+	if keyboard is None:
+		keyboard = StatelessCalendar(stage, min_date, max_date, page, locale).render(step)
+		keyboards_cache.set(key, keyboard)
+	return keyboard
+
+
+def build_calendar(stage: str, min_date: datetime.date, max_date: Optional[datetime.date] = None) -> tuple:
+	"""
+	The function returns the first page of the calendar
+	:param stage: STAGE_DATE_FROM or STAGE_DATE_TO
+	:param min_date: first date that may be selected
+	:param max_date: last date that may be selected or None
+	:return: tuple (inline keyboard in json, step)
+	"""
+	return render_calendar(stage, YEAR, min_date, min_date, max_date), YEAR
+
+
+def is_calendar_callback(data: str) -> bool:
+	"""
+	The function checks whether the callback data belongs to a button of the calendar
+	:param data: callback data of the button
+	:return: True for the buttons of the calendar
+	"""
+	return data.startswith(f'{CALLBACK_PREFIX}_')
+
+
+def process_calendar(data: str) -> CalendarAnswer:
+	"""
+	The function processes the click on a button of the calendar
+	:param data: callback data of the button
+	:return: stage of the calendar with the selected date or the next page of the calendar and its step,
+			 the fields are None for the buttons without action
+	"""
+	params = data.split('_')
+	if len(params) != 7 or params[2] not in (GOTO, SELECT):
+		return CalendarAnswer(None, None, None, None, None)
+	stage, action, step = params[1:4]
+	current_date, min_date, max_date = (datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+										for value in params[4:])
+	if action == SELECT and step not in STEPS:
+		return CalendarAnswer(stage, current_date, None, step, min_date)
+	if action == SELECT:
+		step = STEPS[step]
+	return CalendarAnswer(stage, None, render_calendar(stage, step, current_date, min_date, max_date), step, min_date)
@@ -2,214 +2,414 @@ import datetime
 import logging
 import os
 import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import NamedTuple, Optional
 
 from telebot.types import Message
 
+from metrics import DB_SECONDS, timed
+
 logger = logging.getLogger(__name__)
 
-if not os.path.exists('users.db'):
-	con = sqlite3.connect('users.db', check_same_thread=False)
-	cur = con.cursor()
-	cur.execute('''CREATE TABLE if not exists users (id INTEGER PRIMARY KEY NOT NULL,
-	 												 id_user INTEGER NOT NULL,
-	 												 first_name TEXT NOT NULL,
-	 												 last_name TEXT NOT NULL,
-	 												 username TEXT NOT NULL)''')
-	cur.execute('''CREATE TABLE if not exists history (id_request INTEGER PRIMARY KEY NOT NULL,
-	 												   id_user INTEGER NOT NULL,
-	 												   date_request DATE,
-	 												   command TEXT,
-	 												   id_destination INTEGER,
-	 												   name_destination TEXT,
-	 												   date_from DATE,
-	 												   date_to DATE,
-	 												   q_days INTEGER,
-	 												   q_hotels INTEGER,
-	 												   response TEXT)''')
-	logger.info(f'Create db users.db')
-else:
-	con = sqlite3.connect('users.db', check_same_thread=False)
-	cur = con.cursor()
-	logger.info(f'Create connect with users.db')
 
+class RequestRecord(NamedTuple):
+	"""
+	Data of the user request stored in the history table
+	"""
+	date_from: str
+	date_to: str
+	command: str
+	id_destination: int
+	name_destination: str
+	q_days: int
+	q_hotels: int
+	hotels: Optional[list]
+
+
+DB_PATH = os.getenv('DB_PATH', 'users.db')
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 5))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 16000))
+
+MIGRATIONS = [
+	'''CREATE TABLE if not exists users (id INTEGER PRIMARY KEY NOT NULL,
+										 id_user INTEGER NOT NULL,
+										 first_name TEXT NOT NULL,
+										 last_name TEXT NOT NULL,
+										 username TEXT NOT NULL);
+	CREATE TABLE if not exists history (id_request INTEGER PRIMARY KEY NOT NULL,
+										id_user INTEGER NOT NULL,
+										date_request DATE,
+										command TEXT,
+										id_destination INTEGER,
+										name_destination TEXT,
+										date_from DATE,
+										date_to DATE,
+										q_days INTEGER,
+										q_hotels INTEGER,
+										response TEXT);
+	CREATE TABLE if not exists cities_cache (query TEXT PRIMARY KEY NOT NULL,
+											 response TEXT NOT NULL,
+											 created REAL NOT NULL);
+	CREATE TABLE if not exists photos_cache (id_hotel TEXT PRIMARY KEY NOT NULL,
+											 links TEXT NOT NULL,
+											 created REAL NOT NULL);''',
+	'''DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY id_user);
+	CREATE UNIQUE INDEX if not exists users_id_user ON users (id_user);
+	CREATE INDEX if not exists history_id_user_id_request ON history (id_user, id_request);''',
+	'''CREATE TABLE if not exists hotel_results (id_request INTEGER NOT NULL,
+											  position INTEGER NOT NULL,
+											  id_hotel TEXT NOT NULL,
+											  name TEXT NOT NULL,
+											  address TEXT NOT NULL,
+											  distance TEXT NOT NULL,
+											  current,
+											  url TEXT NOT NULL,
+											  PRIMARY KEY (id_request, position)) WITHOUT ROWID;
+	INSERT INTO hotel_results SELECT history.id_request, hotel.key,
+									 ifnull(json_extract(hotel.value, '$.id'), ''),
+									 ifnull(json_extract(hotel.value, '$.name'), ''),
+									 ifnull(json_extract(hotel.value, '$.address'), 'нет данных'),
+									 ifnull(json_extract(hotel.value, '$.distance'), 'нет данных'),
+									 ifnull(json_extract(hotel.value, '$.current'), 'нет данных'),
+									 ifnull(json_extract(hotel.value, '$.url'), 'нет данных')
+							  FROM history, json_each(history.response) AS hotel
+							  WHERE json_valid(history.response) AND json_type(history.response) = 'array';
+	UPDATE history SET response=NULL;''',
+	'''CREATE TABLE if not exists destinations (city TEXT NOT NULL,
+											 id_destination TEXT NOT NULL,
+											 name TEXT NOT NULL,
+											 group_name TEXT NOT NULL,
+											 position INTEGER NOT NULL,
+											 PRIMARY KEY (city, id_destination)) WITHOUT ROWID;
+	CREATE INDEX if not exists cities_cache_created ON cities_cache (created);''',
+	'''CREATE TABLE if not exists dialog_states (chat_id INTEGER PRIMARY KEY NOT NULL,
+											  state TEXT NOT NULL,
+											  args TEXT NOT NULL,
+											  updated REAL NOT NULL);''',
+]
+
+HOTEL_FIELDS = ('id', 'name', 'address', 'distance', 'current', 'url')
+_HOTEL_COLUMNS = {'id': 'id_hotel', 'name': 'name', 'address': 'address', 'distance': 'distance',
+				  'current': 'current', 'url': 'url'}
+
+
+def migrate(connection: sqlite3.Connection) -> None:
+	"""
+	The function brings the database schema up to date by applying missing migrations.
+	The number of applied migrations is stored in PRAGMA user_version
+	:param connection: connection to the database
+	:return: None
+	"""
+	version = connection.execute('PRAGMA user_version').fetchone()[0]
+	for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+		connection.executescript(f'BEGIN;\n{script}\nPRAGMA user_version={number};\nCOMMIT;')
+		logger.info(f'Apply migration {number} to {DB_PATH}')
+
+
+def _connect() -> sqlite3.Connection:
+	"""
+	The function opens a new connection to the database and sets it up
+	:return: connection to the database
+	"""
+	connection = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+	connection.execute('PRAGMA synchronous=NORMAL')
+	connection.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+	connection.execute('PRAGMA temp_store=MEMORY')
+	return connection
+
+
+def get_connection() -> sqlite3.Connection:
+	"""
+	The function returns the connection to the database of the current thread.
+	Every thread gets its own connection, so handlers never share a cursor.
+	Used as a context manager the connection commits the transaction on success and rolls it back on error
+	:return: connection to the database
+	"""
+	connection = getattr(_local, 'connection', None)
+	if connection is None:
+		connection = _connect()
+		_local.connection = connection
+	return connection
+
+
+_local = threading.local()
+with closing(_connect()) as _connection:
+	_connection.execute('PRAGMA journal_mode=WAL')
+	migrate(_connection)
+logger.info(f'Create connect with {DB_PATH}')
 
+
+@timed(DB_SECONDS)
 def add_new_user(message: Message) -> None:
 	"""
 	The function adds a new user to the database
 	:param message: object of type Message of class telebot
 	:return: None
 	"""
-	try:
-		if cur.execute(f"SELECT id_user FROM users"
-					   f" WHERE id_user='{message.from_user.id}'").fetchall():
-			raise ValueError
-		else:
-			cur.execute("INSERT INTO users VALUES (NULL, ?, ?, ?, ?)",
-						(message.from_user.id, message.from_user.first_name,
-						 message.from_user.last_name, message.from_user.username))
-			con.commit()
-			logger.info(f'Add into users.db new user')
-	except ValueError:
+	with get_connection() as connection:
+		inserted = connection.execute("INSERT OR IGNORE INTO users VALUES (NULL, ?, ?, ?, ?)",
+									  (message.from_user.id, message.from_user.first_name,
+									  message.from_user.last_name or '', message.from_user.username or '')).rowcount
+	if inserted:
+		logger.info(f'Add into users.db new user')
+	else:
 		logger.info(f'restart bot from user {message.from_user.id}')
 
 
-def create_new_request(message: Message, id_user: int) -> None:
+@timed(DB_SECONDS)
+def create_new_request(message: Message, id_user: int) -> int:
 	"""
 	The function adds a new query to the database
 	:param message: object of type Message of class telebot
 					message.text contains the command sent to the bot
 	:param id_user: unique user number
-	:return: None
+	:return: unique request number
 	"""
-	cur.execute("INSERT INTO history VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-				(id_user, datetime.date.today(), message.text, 0, '', '', '', 1, 0, ''))
-	con.commit()
+	with get_connection() as connection:
+		id_request = connection.execute("INSERT INTO history VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+										(id_user, datetime.date.today(), message.text, 0, '', '', '', 1, 0, None)).lastrowid
 	logger.info("Create new request")
+	return id_request
 
 
+@timed(DB_SECONDS)
 def get_id_user(message: Message) -> int:
 	"""
 	The function returns a unique user number
 	:param message: object of type Message of class telebot
 	:return: unique user number
 	"""
-	return cur.execute(f"SELECT id_user FROM users WHERE id_user='{message.from_user.id}'").fetchall()[0][0]
+	return get_connection().execute("SELECT id_user FROM users WHERE id_user=?", (message.from_user.id,)).fetchone()[0]
 
 
+@timed(DB_SECONDS)
 def get_history(message: Message) -> list:
 	"""
 	The function returns a list of the user's query history
 	:param message: object of type Message of class telebot
-	:return: user query history list
+	:return: user query history list, the hotels of a request are read by get_hotel_results with id_request
 	"""
-	list_history = cur.execute(f"SELECT date_request, command, name_destination, response "
-							   f"FROM history WHERE id_user='{message.from_user.id}' ORDER BY id_request DESC LIMIT 10").fetchall()
+	list_history = get_connection().execute("SELECT date_request, command, name_destination, id_request "
+											"FROM history WHERE id_user=? ORDER BY id_request DESC LIMIT 10",
+											(message.from_user.id,)).fetchall()
 	return list_history
 
 
-def update_history_destination(id_destination: int, name_destination: str, id_user: int) -> None:
+@timed(DB_SECONDS)
+def get_last_request_fields(id_user: int) -> Optional[tuple]:
 	"""
-	The function updates the request data
-	:param id_destination: unique city number
-	:param name_destination: the name of the city in which the user is looking for hotels
+	The function returns the fields of the last user request without its hotels
 	:param id_user: unique user number
-	:return: None
+	:return: tuple (unique request number, date_from, date_to, command, id_destination, name_destination,
+			 q_days, q_hotels) or None if the user has no requests
 	"""
-	cur.execute(
-		f"UPDATE history SET id_destination='{id_destination}', name_destination='{name_destination}' WHERE id_request="
-		f"(SELECT id_request FROM history WHERE id_user='{id_user}' ORDER BY id_request DESC LIMIT 1)")
-	con.commit()
-	logger.info(f'Update request')
+	return get_connection().execute("SELECT id_request, date_from, date_to, command, id_destination, "
+									"name_destination, q_days, q_hotels FROM history WHERE id_user=? "
+									"ORDER BY id_request DESC LIMIT 1", (id_user,)).fetchone()
 
 
-def get_id_request(id_user: int) -> int:
+def get_last_request(id_user: int) -> Optional[tuple]:
 	"""
 	The function returns the last user request from the database
 	:param id_user: unique user number
-	:return: unique request number
+	:return: unique request number and request data or None if the user has no requests
 	"""
-	id_request = cur.execute(
-		f"SELECT id_request FROM history WHERE id_user='{id_user}'"
-		f" ORDER BY id_request DESC LIMIT 1").fetchall()[0][0]
-	return id_request
+	row = get_last_request_fields(id_user)
+	return (row[0], RequestRecord(*row[1:], get_hotel_results(row[0]))) if row else None
 
 
-def get_data_history(id_request: int) -> tuple:
+@timed(DB_SECONDS)
+def update_requests(list_requests: list) -> None:
 	"""
-	The function returns a tuple of values from the database
-	:param id_request: unique request number
-	:return: tuple of values from the database
+	The function writes the data of several requests to the database in one transaction
+	:param list_requests: list of tuples (unique request number, request data),
+						  the hotels are written only if record.hotels is not None
+	:return: None
 	"""
-	date_from = cur.execute(f"SELECT date_from FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	date_to = cur.execute(f"SELECT date_to FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	command = cur.execute(f"SELECT command FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	id_destination = \
-		cur.execute(f"SELECT id_destination FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	name_destination = \
-		cur.execute(f"SELECT name_destination FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	q_days = \
-		cur.execute(f"SELECT q_days FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	q_hotels = \
-		cur.execute(f"SELECT q_hotels FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	response = \
-		cur.execute(f"SELECT response FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
+	with get_connection() as connection:
+		connection.executemany("UPDATE history SET date_from=?, date_to=?, command=?, id_destination=?, "
+							   "name_destination=?, q_days=?, q_hotels=? WHERE id_request=?",
+							   [(*record[:-1], id_request) for id_request, record in list_requests])
+		for id_request, record in list_requests:
+			if record.hotels is not None:
+				_replace_hotel_results(connection, id_request, record.hotels)
 
-	return date_from, date_to, command, id_destination, name_destination, q_days, q_hotels, response
 
-
-def get_q_photo(id_request: int) -> int:
+def _replace_hotel_results(connection: sqlite3.Connection, id_request: int, list_hotels: list) -> None:
 	"""
-	The function returns the number of photos required for issuance for each hotel
+	The function replaces the hotels found for the request
+	:param connection: connection to the database with an open transaction
 	:param id_request: unique request number
-	:return: number of photos required for issuance for each hotel
+	:param list_hotels: list of hotels in the order of output
+	:return: None
 	"""
-	q_photo = cur.execute(f"SELECT q_photo FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	return q_photo
+	connection.execute("DELETE FROM hotel_results WHERE id_request=?", (id_request,))
+	connection.executemany("INSERT INTO hotel_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+						   [(id_request, position, hotel['id'], hotel['name'], hotel['address'], hotel['distance'],
+							 hotel['current'], hotel['url']) for position, hotel in enumerate(list_hotels)])
 
 
-def get_response(id_request: int) -> str:
+@timed(DB_SECONDS)
+def get_hotel_results(id_request: int, fields: tuple = HOTEL_FIELDS, limit: int = -1) -> list:
 	"""
-	The function returns query result by unique query number
+	The function returns the hotels found for the request reading only the required fields
 	:param id_request: unique request number
-	:return: query result by unique query number
+	:param fields: names of the required fields from HOTEL_FIELDS
+	:param limit: maximum number of hotels, -1 for all
+	:return: list of hotels in the order of output, each a dictionary with the required fields
 	"""
-	response = cur.execute(f"SELECT response FROM history WHERE id_request='{id_request}'").fetchall()[0][0]
-	return response
+	columns = ', '.join(_HOTEL_COLUMNS[field] for field in fields)
+	rows = get_connection().execute(f"SELECT {columns} FROM hotel_results WHERE id_request=? "
+									f"ORDER BY position LIMIT ?", (id_request, limit)).fetchall()
+	return [dict(zip(fields, row)) for row in rows]
 
 
-def add_date_from_to_request(id_request: int, date_from) -> None:
+@timed(DB_SECONDS)
+def get_cities_cache(query: str, ttl: float) -> Optional[str]:
 	"""
-	The function updates the query with the arrival date
-	:param id_request: unique request number
-	:param date_from: arrival date
+	The function returns the cached list of districts for the city if it has not expired
+	:param query: normalized name of the city
+	:param ttl: lifetime of the cache entry in seconds
+	:return: cached list of districts in json format or None
+	"""
+	row = get_connection().execute("SELECT response FROM cities_cache WHERE query=? AND created>?",
+								   (query, time.time() - ttl)).fetchone()
+	return row[0] if row else None
+
+
+@timed(DB_SECONDS)
+def add_cities_cache(query: str, response: str, max_size: int) -> None:
+	"""
+	The function saves the list of districts for the city and removes the oldest entries over the limit
+	:param query: normalized name of the city
+	:param response: list of districts in json format
+	:param max_size: maximum number of cached cities
 	:return: None
 	"""
-	cur.execute(f"UPDATE history SET date_from='{date_from}' WHERE id_request='{id_request}'")
-	con.commit()
+	with get_connection() as connection:
+		connection.execute("INSERT OR REPLACE INTO cities_cache VALUES (?, ?, ?)", (query, response, time.time()))
+		connection.execute("DELETE FROM cities_cache WHERE query NOT IN "
+						   "(SELECT query FROM cities_cache ORDER BY created DESC LIMIT ?)", (max_size,))
 
 
-def add_date_to_to_request(id_request: int, date_to) -> None:
+@timed(DB_SECONDS)
+def get_cities_cache_since(created: float) -> list:
 	"""
-	The function updates the query with the departure date
-	:param id_request: unique request number
-	:param date_to: departure date
+	The function returns the lists of districts cached after the given moment
+	:param created: moment in seconds since the epoch
+	:return: list of tuples (normalized name of the city, list of districts in json format, moment of caching)
+	"""
+	return get_connection().execute("SELECT query, response, created FROM cities_cache WHERE created>? "
+									"ORDER BY created", (created,)).fetchall()
+
+
+@timed(DB_SECONDS)
+def add_destinations(list_destinations: list) -> None:
+	"""
+	The function replaces the destinations of the cities in the destination index
+	:param list_destinations: list of tuples (normalized name of the city, list of tuples (name, destination id, group))
 	:return: None
 	"""
-	cur.execute(f"UPDATE history SET date_to='{date_to}' WHERE id_request='{id_request}'")
-	con.commit()
+	with get_connection() as connection:
+		for city, entities in list_destinations:
+			connection.execute("DELETE FROM destinations WHERE city=?", (city,))
+			connection.executemany("INSERT OR IGNORE INTO destinations VALUES (?, ?, ?, ?, ?)",
+								   [(city, str(id_destination), name, group, position)
+									for position, (name, id_destination, group) in enumerate(entities)])
 
 
-def add_q_hotels(id_user: int, q_hotels: int) -> None:
+@timed(DB_SECONDS)
+def get_destinations(city: str, group: str) -> list:
 	"""
-	The function updates the query with the number of hotels
-	:param id_user: unique user number
-	:param q_hotels: number of hotels
+	The function returns the destinations of the city from the destination index
+	:param city: normalized name of the city
+	:param group: group of the destinations, for example CITY_GROUP
+	:return: list of tuples (name, destination id) in the order of the service
+	"""
+	return get_connection().execute("SELECT name, id_destination FROM destinations WHERE city=? AND group_name=? "
+									"ORDER BY position", (city, group)).fetchall()
+
+
+@timed(DB_SECONDS)
+def get_destination_cities(prefix: str, limit: int) -> list:
+	"""
+	The function returns the names of the cities of the destination index starting with the prefix
+	:param prefix: beginning of the normalized name of the city
+	:param limit: maximum number of cities
+	:return: list of normalized names of the cities in alphabetical order
+	"""
+	rows = get_connection().execute("SELECT DISTINCT city FROM destinations WHERE city>=? AND city<? "
+									"ORDER BY city LIMIT ?", (prefix, prefix + '\U0010ffff', limit)).fetchall()
+	return [row[0] for row in rows]
+
+
+@timed(DB_SECONDS)
+def get_dialog_state(chat_id: int, ttl: float) -> Optional[tuple]:
+	"""
+	The function returns the step of the search dialog the chat is at if it has not expired
+	:param chat_id: unique chat number
+	:param ttl: lifetime of the step in seconds
+	:return: tuple (name of the step, arguments of the step in json format) or None
+	"""
+	return get_connection().execute("SELECT state, args FROM dialog_states WHERE chat_id=? AND updated>?",
+									(chat_id, time.time() - ttl)).fetchone()
+
+
+@timed(DB_SECONDS)
+def set_dialog_state(chat_id: int, state: str, args: str) -> None:
+	"""
+	The function saves the step of the search dialog the chat is at
+	:param chat_id: unique chat number
+	:param state: name of the step
+	:param args: arguments of the step in json format
 	:return: None
 	"""
-	cur.execute(f"UPDATE history SET q_hotels='{q_hotels}' WHERE id_request="
-				f"(SELECT id_request FROM history WHERE id_user='{id_user}' ORDER BY id_request DESC LIMIT 1)")
-	con.commit()
+	with get_connection() as connection:
+		connection.execute("INSERT OR REPLACE INTO dialog_states VALUES (?, ?, ?, ?)",
+						   (chat_id, state, args, time.time()))
 
 
-def update_q_days(q_days: int, id_request: int) -> None:
+@timed(DB_SECONDS)
+def delete_dialog_state(chat_id: int) -> None:
 	"""
-	The function updates the query with the number of days
-	:param q_days: number of days
-	:param id_request: unique request number
+	The function removes the step of the search dialog of the chat
+	:param chat_id: unique chat number
 	:return: None
 	"""
-	cur.execute(f"UPDATE history SET q_days='{q_days}' WHERE id_request='{id_request}'")
-	con.commit()
+	with get_connection() as connection:
+		connection.execute("DELETE FROM dialog_states WHERE chat_id=?", (chat_id,))
 
 
-def add_response_to_history(id_user: int, response: str) -> None:
+@timed(DB_SECONDS)
+def get_photos_cache(list_id_hotels: list, ttl: float) -> dict:
 	"""
-	The function updates the query with the response
-	:param id_user: unique user number
-	:param response: query result
-	:return:
+	The function returns the cached photo link templates for the hotels that have not expired
+	:param list_id_hotels: list of unique hotel numbers
+	:param ttl: lifetime of the cache entry in seconds
+	:return: dictionary of unique hotel number and list of photo link templates
+	"""
+	photos = {}
+	created = time.time() - ttl
+	connection = get_connection()
+	for start in range(0, len(list_id_hotels), 500):
+		chunk = list_id_hotels[start:start + 500]
+		rows = connection.execute(f"SELECT id_hotel, links FROM photos_cache WHERE created>? "
+								  f"AND id_hotel IN ({', '.join('?' * len(chunk))})", (created, *chunk)).fetchall()
+		for id_hotel, links in rows:
+			photos[id_hotel] = links.split('\n') if links else []
+	return photos
+
+
+@timed(DB_SECONDS)
+def add_photos_cache(photos: dict) -> None:
+	"""
+	The function saves photo link templates of the hotels
+	:param photos: dictionary of unique hotel number and list of photo link templates
+	:return: None
 	"""
-	response = response.replace("'", "`")
-	cur.execute(f"UPDATE history SET response='{response}' WHERE id_request="
-				f"(SELECT id_request FROM history WHERE id_user='{id_user}' ORDER BY id_request DESC LIMIT 1)")
-	con.commit()
+	now = time.time()
+	with get_connection() as connection:
+		connection.executemany("INSERT OR REPLACE INTO photos_cache VALUES (?, ?, ?)",
+							   [(id_hotel, '\n'.join(links), now) for id_hotel, links in photos.items()])
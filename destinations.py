@@ -0,0 +1,175 @@
+"""
+Local index of destinations of the hotels service.
+
+Usage: python destinations.py import dataset.csv
+	   python destinations.py refresh
+
+The dataset is a csv file with the columns city, destinationId, name and group (CITY_GROUP by default),
+rows of one city go in the order of the districts in the answer of locations/v2/search
+"""
+import argparse
+import csv
+import difflib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+
+import db
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+CITY_GROUP = 'CITY_GROUP'
+DESTINATIONS_MIN_PREFIX = int(os.getenv('DESTINATIONS_MIN_PREFIX', 4))
+DESTINATIONS_FUZZY_CUTOFF = float(os.getenv('DESTINATIONS_FUZZY_CUTOFF', 0.8))
+DESTINATIONS_FUZZY_CANDIDATES = int(os.getenv('DESTINATIONS_FUZZY_CANDIDATES', 5000))
+DESTINATIONS_REFRESH_INTERVAL = float(os.getenv('DESTINATIONS_REFRESH_INTERVAL', 10 * 60))
+
+
+def normalize_city(city: str) -> str:
+	"""
+	The function returns the name of the city in the form used as a cache key
+	:param city: the city in which the user is looking for hotels
+	:return: normalized name of the city
+	"""
+	return ' '.join(city.lower().split())
+
+
+class DestinationIndex:
+	"""
+	Index of destinations kept in the destinations table.
+	It is filled from an imported dataset and from the answers of the service saved in cities_cache,
+	finds the city by the exact name and suggests a city by a unique prefix or by the closest spelling
+	"""
+
+	def __init__(self, min_prefix: int, fuzzy_cutoff: float, fuzzy_candidates: int, refresh_interval: float):
+		self.__min_prefix = min_prefix
+		self.__fuzzy_cutoff = fuzzy_cutoff
+		self.__fuzzy_candidates = fuzzy_candidates
+		self.__refresh_interval = refresh_interval
+		self.__refreshed = 0.0
+		self.__lock = threading.Lock()
+		self.__timer = None
+
+	def match(self, query: str) -> Optional[list]:
+		"""
+		The function returns the districts of the city with exactly this name
+		:param query: normalized name of the city
+		:return: list of tuples (name, destination id) or None if the city is not in the index
+		"""
+		self.__start_timer()
+		if not query:
+			return None
+		return db.get_destinations(query, CITY_GROUP) or None
+
+	def suggest(self, query: str) -> Optional[list]:
+		"""
+		The function returns the districts of the city of the index the user most likely meant,
+		found by a unique prefix or by the closest spelling. It is only a suggestion: a city missing from the index
+		may be spelled close to another city of the index
+		:param query: normalized name of the city
+		:return: list of tuples (name, destination id) or None if no city is close enough
+		"""
+		if not query:
+			return None
+		city = self.__closest(query)
+		if city is None:
+			return None
+		logger.info(f'Для города "{query}" предложен город "{city}" из индекса')
+		return db.get_destinations(city, CITY_GROUP) or None
+
+	def add(self, query: str, entities: list) -> None:
+		"""
+		The function puts the districts of the city received from the service into the index
+		:param query: normalized name of the city
+		:param entities: list of tuples (name, destination id)
+		:return: None
+		"""
+		if entities:
+			db.add_destinations([(query, [(name, id_destination, CITY_GROUP) for name, id_destination in entities])])
+
+	def refresh(self) -> int:
+		"""
+		The function puts the cities cached since the previous refresh into the index
+		:return: number of cities
+		"""
+		with self.__lock:
+			rows = db.get_cities_cache_since(self.__refreshed)
+			if rows:
+				db.add_destinations([(query, [(name, id_destination, CITY_GROUP)
+											  for name, id_destination in json.loads(response)])
+									 for query, response, _ in rows])
+				self.__refreshed = rows[-1][2]
+		return len(rows)
+
+	def import_dataset(self, path: str) -> int:
+		"""
+		The function puts the destinations from the csv dataset into the index
+		:param path: path to the dataset
+		:return: number of cities
+		"""
+		cities = {}
+		with open(path, newline='', encoding='utf-8') as file:
+			for row in csv.DictReader(file):
+				cities.setdefault(normalize_city(row['city']), []).append(
+					(row['name'], row['destinationId'], row.get('group') or CITY_GROUP))
+		db.add_destinations(list(cities.items()))
+		return len(cities)
+
+	def __closest(self, query: str) -> Optional[str]:
+		"""
+		The function finds the city of the index by a unique prefix or by the closest spelling
+		:param query: normalized name of the city
+		:return: normalized name of the city of the index or None
+		"""
+		if len(query) >= self.__min_prefix:
+			cities = db.get_destination_cities(query, 2)
+			if len(cities) == 1:
+				return cities[0]
+		candidates = db.get_destination_cities(query[0], self.__fuzzy_candidates)
+		matches = difflib.get_close_matches(query, candidates, n=1, cutoff=self.__fuzzy_cutoff)
+		return matches[0] if matches else None
+
+	def __start_timer(self) -> None:
+		"""
+		The function starts the background thread that periodically refreshes the index from cities_cache
+		:return: None
+		"""
+		if self.__timer is None:
+			with self.__lock:
+				if self.__timer is None:
+					self.__timer = threading.Thread(target=self.__run_timer, name='destinations-refresh', daemon=True)
+					self.__timer.start()
+
+	def __run_timer(self) -> None:
+		"""
+		The function refreshes the index every refresh interval
+		:return: None
+		"""
+		while True:
+			try:
+				self.refresh()
+			except Exception as ex:
+				logger.error(f'Ошибка обновления индекса направлений', exc_info=ex)
+			time.sleep(self.__refresh_interval)
+
+
+destination_index = DestinationIndex(DESTINATIONS_MIN_PREFIX, DESTINATIONS_FUZZY_CUTOFF, DESTINATIONS_FUZZY_CANDIDATES,
+									 DESTINATIONS_REFRESH_INTERVAL)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	subparsers.add_parser('import').add_argument('path')
+	subparsers.add_parser('refresh')
+	options = parser.parse_args()
+	if options.command == 'import':
+		print(f'Импортировано городов: {destination_index.import_dataset(options.path)}')
+	else:
+		print(f'Обновлено городов: {destination_index.refresh()}')
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+from typing import Any, Callable, Optional
+
+from dotenv import load_dotenv
+
+import db
+from cache import TTLCache
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DIALOG_STORE = os.getenv('DIALOG_STORE', 'sqlite')
+DIALOG_REDIS_URL = os.getenv('DIALOG_REDIS_URL', 'redis://localhost:6379/0')
+DIALOG_STATE_TTL = float(os.getenv('DIALOG_STATE_TTL', 24 * 60 * 60))
+
+
+class SQLiteStateStore:
+	"""
+	Store of the steps of the search dialog in the dialog_states table of the bot database
+	"""
+
+	def __init__(self, ttl: float):
+		self.__ttl = ttl
+
+	def get(self, chat_id: int) -> Optional[tuple]:
+		"""
+		The function returns the step the chat is at
+		:param chat_id: unique chat number
+		:return: tuple (name of the step, list of arguments) or None
+		"""
+		row = db.get_dialog_state(chat_id, self.__ttl)
+		return (row[0], json.loads(row[1])) if row else None
+
+	def set(self, chat_id: int, state: str, args: list) -> None:
+		"""
+		The function saves the step the chat is at
+		:param chat_id: unique chat number
+		:param state: name of the step
+		:param args: arguments of the step serializable to json
+		:return: None
+		"""
+		db.set_dialog_state(chat_id, state, json.dumps(args))
+
+	def delete(self, chat_id: int) -> None:
+		"""
+		The function removes the step of the chat
+		:param chat_id: unique chat number
+		:return: None
+		"""
+		db.delete_dialog_state(chat_id)
+
+
+class RedisStateStore:
+	"""
+	Store of the steps of the search dialog in Redis or in any client with the get, set(ex=) and delete
+	methods of redis.Redis, the steps expire by the ttl of the keys
+	"""
+
+	def __init__(self, client: Any, ttl: float, prefix: str = 'dialog:'):
+		self.__client = client
+		self.__ttl = ttl
+		self.__prefix = prefix
+
+	def get(self, chat_id: int) -> Optional[tuple]:
+		"""
+		The function returns the step the chat is at
+		:param chat_id: unique chat number
+		:return: tuple (name of the step, list of arguments) or None
+		"""
+		value = self.__client.get(f'{self.__prefix}{chat_id}')
+		if value is None:
+			return None
+		data = json.loads(value)
+		return data['state'], data['args']
+
+	def set(self, chat_id: int, state: str, args: list) -> None:
+		"""
+		The function saves the step the chat is at
+		:param chat_id: unique chat number
+		:param state: name of the step
+		:param args: arguments of the step serializable to json
+		:return: None
+		"""
+		self.__client.set(f'{self.__prefix}{chat_id}', json.dumps({'state': state, 'args': args}),
+						  ex=int(self.__ttl))
+
+	def delete(self, chat_id: int) -> None:
+		"""
+		The function removes the step of the chat
+		:param chat_id: unique chat number
+		:return: None
+		"""
+		self.__client.delete(f'{self.__prefix}{chat_id}')
+
+
+class LocalRedis:
+	"""
+	In-process stand-in for the subset of the redis.Redis client used by RedisStateStore.
+	The data is lost on restart and is not shared between processes
+	"""
+
+	def __init__(self, maxsize: int = 100000):
+		self.__data = TTLCache(maxsize, float('inf'))
+
+	def get(self, name: str) -> Optional[bytes]:
+		return self.__data.get(name)
+
+	def set(self, name: str, value: str, ex: Optional[int] = None) -> bool:
+		self.__data.set(name, value.encode() if isinstance(value, str) else value, ex)
+		return True
+
+	def delete(self, *names: str) -> int:
+		deleted = sum(self.__data.get(name) is not None for name in names)
+		for name in names:
+			self.__data.delete(name)
+		return deleted
+
+
+def create_state_store(kind: str = DIALOG_STORE) -> Any:
+	"""
+	The function creates the store of the steps of the search dialog
+	:param kind: sqlite, redis (needs the redis package and DIALOG_REDIS_URL) or memory for LocalRedis
+	:return: store of the steps
+	"""
+	if kind == 'redis':
+		import redis
+
+		return RedisStateStore(redis.Redis.from_url(DIALOG_REDIS_URL), DIALOG_STATE_TTL)
+	if kind == 'memory':
+		return RedisStateStore(LocalRedis(), DIALOG_STATE_TTL)
+	return SQLiteStateStore(DIALOG_STATE_TTL)
+
+
+class Dialog:
+	"""
+	Finite-state machine of the search dialog.
+	The state of a chat is the step function waiting for the next text message of the user and its arguments.
+	It is kept in the store instead of the memory of the process, so the dialog survives a restart
+	and any process of the bot can continue it
+	"""
+
+	def __init__(self, store: Any):
+		self.__store = store
+		self.__steps = {}
+
+	def step(self, func: Callable) -> Callable:
+		"""
+		The function registers the step function of the dialog under its name
+		:param func: step function taking the message and the arguments of the step
+		:return: the same function
+		"""
+		self.__steps[func.__name__] = func
+		return func
+
+	def next(self, chat_id: int, step: Callable, *args) -> None:
+		"""
+		The function moves the chat to the step, the next text message of the chat is passed to it
+		:param chat_id: unique chat number
+		:param step: registered step function
+		:param args: arguments of the step serializable to json
+		:return: None
+		"""
+		if step.__name__ not in self.__steps:
+			raise ValueError(f'Step {step.__name__} is not registered')
+		self.__store.set(chat_id, step.__name__, list(args))
+
+	def active(self, chat_id: int) -> bool:
+		"""
+		The function checks whether the chat is waiting for the answer of the user
+		:param chat_id: unique chat number
+		:return: True if the chat is at a step of the dialog
+		"""
+		return self.__store.get(chat_id) is not None
+
+	def pop(self, chat_id: int) -> Optional[tuple]:
+		"""
+		The function takes the step of the chat, the step has to move the chat further or return it to itself
+		:param chat_id: unique chat number
+		:return: tuple (step function, list of arguments) or None
+		"""
+		state = self.__store.get(chat_id)
+		if state is None:
+			return None
+		self.__store.delete(chat_id)
+		step = self.__steps.get(state[0])
+		if step is None:
+			logger.error(f'Неизвестный шаг диалога {state[0]} в чате {chat_id}')
+			return None
+		return step, state[1]
+
+
+dialog_states = create_state_store()
@@ -1,4 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
 import requests
 import json
@@ -7,10 +10,41 @@ from dotenv import load_dotenv
 import logging
 
 import db
+from api import hotels_api
+from cache import SingleFlight, TTLCache
+from conversation import conversations
+from destinations import destination_index, normalize_city
+from upstream import UpstreamUnavailable, upstream_guard
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', 8))
+CITY_CACHE_TTL = float(os.getenv('CITY_CACHE_TTL', 7 * 24 * 60 * 60))
+CITY_CACHE_SIZE = int(os.getenv('CITY_CACHE_SIZE', 1000))
+CITY_CACHE_DB_SIZE = int(os.getenv('CITY_CACHE_DB_SIZE', 10000))
+
+PROPERTIES_CACHE_TTL = float(os.getenv('PROPERTIES_CACHE_TTL', 5 * 60))
+PROPERTIES_CACHE_SIZE = int(os.getenv('PROPERTIES_CACHE_SIZE', 500))
+PHOTO_CACHE_TTL = float(os.getenv('PHOTO_CACHE_TTL', 30 * 24 * 60 * 60))
+PHOTO_CACHE_SIZE = int(os.getenv('PHOTO_CACHE_SIZE', 5000))
+PHOTO_CACHE_LINKS = 5
+
+PROPERTIES_PAGE_SIZE = 15
+BESTDEAL_MAX_PAGES = int(os.getenv('BESTDEAL_MAX_PAGES', 5))
+BESTDEAL_MAX_HOTELS = int(os.getenv('BESTDEAL_MAX_HOTELS', 15))
+
+MESSAGE_MODE = os.getenv('MESSAGE_MODE', 'single')
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+_cities_cache = TTLCache(CITY_CACHE_SIZE, CITY_CACHE_TTL, 'cities')
+properties_cache = TTLCache(PROPERTIES_CACHE_SIZE, PROPERTIES_CACHE_TTL, 'properties')
+_properties_flight = SingleFlight()
+_photos_cache = TTLCache(PHOTO_CACHE_SIZE, PHOTO_CACHE_TTL, 'photos')
+_photos_flight = SingleFlight()
+
 
 class City:
 	"""
@@ -52,134 +86,524 @@ def get_help() -> str:
 		   '<b>/history</b> - история поиска\n'
 
 
-def get_district(city: str) -> list:
+def parse_district(data_location: dict) -> list:
 	"""
-	The function makes a request through the rapidapi service and
-	returns a list of districts of the city specified in the request
-	:param city: the city in which the user is looking for hotels
+	The function returns a list of districts from the response of the locations/v2/search service
+	:param data_location: decoded response of the service
 	:return: list of districts of the city specified in the request
 	"""
 	list_class_cities = []
-	url_location = os.getenv('url_api') + "locations/v2/search"
-	headers = {
-		'x-rapidapi-host': os.getenv('x-rapidapi-host'),
-		'x-rapidapi-key': os.getenv('HOTELS_RU_TOKEN')
-	}
-	querystring_location = {"query": city.lower(), "locale": "en_EN", "currency": "USD"}
+	if data_location.get('suggestions'):
+		for value in data_location['suggestions']:
+			if value.get('group') and value['group'] == 'CITY_GROUP' and value['entities']:
+				for district in value['entities']:
+					list_class_cities.append(City(district['name'], district['destinationId']))
+				return list_class_cities
+	else:
+		raise ValueError
+	return list_class_cities
+
 
-	response_location = requests.request("GET", url_location, headers=headers, params=querystring_location)
+def _request_district(query: str) -> Optional[list]:
+	"""
+	The function makes a request through the rapidapi service and
+	returns a list of districts of the city specified in the request
+	:param query: normalized name of the city
+	:return: list of districts of the city specified in the request or None in case of failure
+	"""
+	querystring_location = {"query": query, "locale": "en_EN", "currency": "USD"}
 
 	try:
+		response_location = hotels_api.get("locations/v2/search", querystring_location)
 		if response_location.status_code == 200:
-			data_location = json.loads(response_location.text)
-			if data_location.get('suggestions'):
-				for value in data_location['suggestions']:
-					if value.get('group') and value['group'] == 'CITY_GROUP' and value['entities']:
-						for district in value['entities']:
-							list_class_cities.append(City(district['name'], district['destinationId']))
-						return list_class_cities
-			else:
-				raise ValueError
-	except ValueError as ex:
+			return parse_district(json.loads(response_location.text))
+		logger.error(f'Сервис rapidapi.com/locations/v2/search ответил {response_location.status_code}. Нет данных')
+	except UpstreamUnavailable as ex:
+		logger.warning(f'Запрос к сервису rapidapi.com/locations/v2/search отклонен: {ex}')
+	except (ValueError, requests.RequestException) as ex:
 		logger.error(f'Ошибка GET запроса к сервису rapidapi.com/locations/v2/search. Нет данных', exc_info=ex)
+	return None
 
 
-def get_properties(id_destination: int, date_from: date, date_to: date, order_by: str, min_cost=None,
-				   max_cost=None) -> list:
+def get_cached_district(query: str) -> Optional[list]:
 	"""
-	The function makes a request through the rapidapi service and
-	returns a list of hotels suitable on request
+	The function returns a list of districts of the city from the memory cache, the database cache
+	or the destination index by the exact name of the city
+	:param query: normalized name of the city
+	:return: list of districts or None if the city is not cached
+	"""
+	list_class_cities = _cities_cache.get(query)
+	if list_class_cities is None:
+		response = db.get_cities_cache(query, CITY_CACHE_TTL)
+		if response is not None:
+			list_class_cities = [City(name, id_destination) for name, id_destination in json.loads(response)]
+			_cities_cache.set(query, list_class_cities)
+	if list_class_cities is None:
+		entities = destination_index.match(query)
+		if entities is not None:
+			list_class_cities = [City(name, id_destination) for name, id_destination in entities]
+			_cities_cache.set(query, list_class_cities)
+	return list_class_cities
+
+
+def suggest_district(query: str) -> list:
+	"""
+	The function returns the districts of the city of the destination index with a close name,
+	they are offered when the service knows no such city or is unavailable and are not cached under the query
+	:param query: normalized name of the city
+	:return: list of districts or an empty list
+	"""
+	entities = destination_index.suggest(query)
+	return [City(name, id_destination) for name, id_destination in entities] if entities else []
+
+
+def get_stale_district(query: str) -> list:
+	"""
+	The function returns the expired list of districts of the city from the memory cache or the database cache,
+	it is served when the rapidapi service fails
+	:param query: normalized name of the city
+	:return: list of districts or an empty list
+	"""
+	list_class_cities = _cities_cache.get(query, stale=True)
+	if list_class_cities is None:
+		response = db.get_cities_cache(query, float('inf'))
+		if response is not None:
+			list_class_cities = [City(name, id_destination) for name, id_destination in json.loads(response)]
+	if list_class_cities:
+		upstream_guard.stale("locations/v2/search")
+	return list_class_cities or []
+
+
+def cache_district(query: str, list_class_cities: list) -> None:
+	"""
+	The function puts a non-empty list of districts of the city into the memory cache, the database cache
+	and the destination index
+	:param query: normalized name of the city
+	:param list_class_cities: list of districts of the city
+	:return: None
+	"""
+	if list_class_cities:
+		entities = [(city.name, city.id_destination) for city in list_class_cities]
+		db.add_cities_cache(query, json.dumps(entities), CITY_CACHE_DB_SIZE)
+		destination_index.add(query, entities)
+		_cities_cache.set(query, list_class_cities)
+
+
+def get_district(city: str) -> list:
+	"""
+	The function returns a list of districts of the city specified in the request
+	from the memory cache, the database cache, the destination index or through the rapidapi service.
+	If the service finds nothing, the districts of a city of the index with a close name are offered
+	:param city: the city in which the user is looking for hotels
+	:return: list of districts of the city specified in the request
+	"""
+	query = normalize_city(city)
+	list_class_cities = get_cached_district(query)
+	if list_class_cities is None:
+		list_class_cities = _request_district(query)
+		if list_class_cities is None:
+			list_class_cities = get_stale_district(query)
+		else:
+			cache_district(query, list_class_cities)
+	return list_class_cities or suggest_district(query)
+
+
+def properties_querystring(id_destination: int, date_from: date, date_to: date, order_by: str, min_cost=None,
+						   max_cost=None, page_number: int = 1) -> dict:
+	"""
+	The function returns the query string parameters of the properties/list service
 	:param id_destination: unique destination number
 	:param date_from: arrival date
 	:param date_to: departure date
 	:param order_by: hotel sorting method
 	:param min_cost: minimal price
 	:param max_cost: maximal price
+	:param page_number: number of the page of results starting from 1
+	:return: query string parameters
+	"""
+	if min_cost and max_cost:
+		return {"adults1": "1", "pageNumber": str(page_number), "destinationId": id_destination,
+				"pageSize": str(PROPERTIES_PAGE_SIZE), "checkOut": date_to, "checkIn": date_from,
+				"priceMin": min_cost, "priceMax": max_cost, "sortOrder": order_by, "locale": "en_EN", "currency": "USD"}
+	return {"adults1": "1", "pageNumber": str(page_number), "destinationId": id_destination,
+			"pageSize": str(PROPERTIES_PAGE_SIZE), "checkOut": date_to, "checkIn": date_from, "sortOrder": order_by,
+			"locale": "en_EN", "currency": "USD"}
+
+
+def parse_properties(data_properties_list: dict) -> list:
+	"""
+	The function returns a list of hotels from the response of the properties/list service
+	:param data_properties_list: decoded response of the service
 	:return: list of hotels suitable on request
 	"""
 	list_result = []
-	url_properties_list = os.getenv('url_api') + "properties/list"
-	headers_properties_list = {'x-rapidapi-key': os.getenv('HOTELS_RU_TOKEN'),
-							   'x-rapidapi-host': os.getenv('x-rapidapi-host')}
-	if min_cost and max_cost:
-		querystring_properties_list = {"adults1": "1", "pageNumber": "1", "destinationId": id_destination, "pageSize": "15",
-									   "checkOut": date_to, "checkIn": date_from, "priceMin": min_cost, "priceMax": max_cost,
-									   "sortOrder": order_by, "locale": "en_EN", "currency": "USD"}
-	else:
-		querystring_properties_list = {"adults1": "1", "pageNumber": "1", "destinationId": id_destination, "pageSize": "15",
-									   "checkOut": date_to, "checkIn": date_from, "sortOrder": order_by,
-									   "locale": "en_EN", "currency": "USD"}
-	response_properties_list = requests.request("GET", url_properties_list,
-												headers=headers_properties_list,
-												params=querystring_properties_list)
+	if data_properties_list.get('data') and data_properties_list['data'].get('body') and \
+			data_properties_list['data']['body'].get('searchResults') and \
+			data_properties_list['data']['body']['searchResults'].get('results'):
+		for hotel in data_properties_list['data']['body']['searchResults']['results']:
+			tmp_dict = {'id': '', 'name': '', 'current': 'нет данных', 'address': 'нет данных',
+						'distance': 'нет данных', 'url': 'нет данных'}
+			if hotel.get('id'):
+				tmp_dict['id'] = str(hotel['id'])
+			if hotel.get('name'):
+				tmp_dict['name'] = hotel['name']
+			if hotel.get('ratePlan'):
+				if hotel['ratePlan'].get('price'):
+					if hotel['ratePlan']['price'].get('exactCurrent'):
+						tmp_dict['current'] = hotel['ratePlan']['price']['exactCurrent']
+			if hotel.get('address'):
+				if hotel['address'].get('locality') and hotel['address'].get('streetAddress'):
+					tmp_dict['address'] = ', '.join([hotel['address']['locality'],
+													 hotel['address']['streetAddress']])
+			if hotel.get('landmarks'):
+				if hotel['landmarks'][0].get('distance'):
+					tmp_dict['distance'] = hotel['landmarks'][0]['distance']
+			tmp_dict['url'] = f'https://ru.hotels.com/ho{tmp_dict["id"]}'
+			list_result.append(tmp_dict)
+	return list_result
+
+
+def _request_properties(*args) -> Optional[list]:
+	"""
+	The function makes a request through the rapidapi service and
+	returns a list of hotels suitable on request
+	:param args: arguments of properties_querystring
+	:return: list of hotels suitable on request or None in case of failure
+	"""
 	try:
+		response_properties_list = hotels_api.get("properties/list", properties_querystring(*args))
 		if response_properties_list.status_code == 200:
-			data_properties_list = json.loads(response_properties_list.text)
-			if data_properties_list.get('data') and data_properties_list['data'].get('body') and \
-					data_properties_list['data']['body'].get('searchResults') and \
-					data_properties_list['data']['body']['searchResults'].get('results'):
-				for hotel in data_properties_list['data']['body']['searchResults']['results']:
-					tmp_dict = {'id': '', 'name': '', 'current': 'нет данных', 'address': 'нет данных',
-								'distance': 'нет данных', 'url': 'нет данных'}
-					if hotel.get('id'):
-						tmp_dict['id'] = str(hotel['id'])
-					if hotel.get('name'):
-						tmp_dict['name'] = hotel['name']
-					if hotel.get('ratePlan'):
-						if hotel['ratePlan'].get('price'):
-							if hotel['ratePlan']['price'].get('exactCurrent'):
-								tmp_dict['current'] = hotel['ratePlan']['price']['exactCurrent']
-					if hotel.get('address'):
-						if hotel['address'].get('locality') and hotel['address'].get('streetAddress'):
-							tmp_dict['address'] = ', '.join([hotel['address']['locality'],
-															 hotel['address']['streetAddress']])
-					if hotel.get('landmarks'):
-						if hotel['landmarks'][0].get('distance'):
-							tmp_dict['distance'] = hotel['landmarks'][0]['distance']
-					tmp_dict['url'] = f'https://ru.hotels.com/ho{tmp_dict["id"]}'
-					list_result.append(tmp_dict)
-	except:
-		logger.error(f'Ошибка GET запроса к сервису rapidapi.com/properties/list. Нет данных по отелям')
+			return parse_properties(json.loads(response_properties_list.text))
+		logger.error(f'Сервис rapidapi.com/properties/list ответил {response_properties_list.status_code}. '
+					 f'Нет данных по отелям')
+	except UpstreamUnavailable as ex:
+		logger.warning(f'Запрос к сервису rapidapi.com/properties/list отклонен: {ex}')
+	except (ValueError, KeyError, TypeError, requests.RequestException) as ex:
+		logger.error(f'Ошибка GET запроса к сервису rapidapi.com/properties/list. Нет данных по отелям', exc_info=ex)
+	return None
+
+
+def get_stale_properties(key: tuple) -> list:
+	"""
+	The function returns the expired list of hotels from the cache, it is served when the rapidapi service fails
+	:param key: cache key of the request
+	:return: list of hotels or an empty list
+	"""
+	list_result = properties_cache.get(key, stale=True)
+	if list_result:
+		upstream_guard.stale("properties/list")
+	return list_result or []
+
+
+def properties_key(*args) -> tuple:
+	"""
+	The function returns the cache key of the request to the properties/list service
+	:param args: arguments of properties_querystring
+	:return: cache key
+	"""
+	return tuple(str(arg) for arg in args)
+
+
+def get_properties(id_destination: int, date_from: date, date_to: date, order_by: str, min_cost=None,
+				   max_cost=None, page_number: int = 1) -> list:
+	"""
+	The function returns a list of hotels suitable on request from the cache or through the rapidapi service.
+	Simultaneous identical requests are merged into one request to the service
+	:param id_destination: unique destination number
+	:param date_from: arrival date
+	:param date_to: departure date
+	:param order_by: hotel sorting method
+	:param min_cost: minimal price
+	:param max_cost: maximal price
+	:param page_number: number of the page of results starting from 1
+	:return: list of hotels suitable on request
+	"""
+	args = (id_destination, date_from, date_to, order_by, min_cost, max_cost, page_number)
+	key = properties_key(*args)
+	list_result = properties_cache.get(key)
+	if list_result is None:
+		list_result = _properties_flight.do(key, lambda: _load_properties(key, *args))
+	return list(list_result)
 
+
+def _load_properties(key: tuple, *args) -> list:
+	"""
+	The function requests the list of hotels and puts a non-empty result into the cache
+	:param key: cache key of the request
+	:param args: arguments of the request to the rapidapi service
+	:return: list of hotels suitable on request
+	"""
+	list_result = properties_cache.get(key)
+	if list_result is None:
+		list_result = _request_properties(*args)
+		if list_result is None:
+			return get_stale_properties(key)
+		if list_result:
+			properties_cache.set(key, list_result)
 	return list_result
 
 
-def get_photo_hotel(q_photo: int, id_user: int) -> list:
+def parse_distance(distance: str) -> Optional[float]:
+	"""
+	The function returns the distance of the hotel from the center as a number
+	:param distance: distance in the format of the service, for example "1.5 miles"
+	:return: distance or None if it is unknown
+	"""
+	try:
+		return float(distance.split()[0])
+	except (ValueError, IndexError):
+		return None
+
+
+def filter_distance(list_hotels: Iterable, min_dist: float, max_dist: float) -> Iterator[dict]:
+	"""
+	The function lazily selects hotels whose distance from the center is within the range
+	:param list_hotels: hotels in the order of output
+	:param min_dist: desired minimum distance of the hotel from the center
+	:param max_dist: desired maximum distance of the hotel from the center
+	:return: iterator over the suitable hotels
+	"""
+	for hotel in list_hotels:
+		distance = parse_distance(hotel['distance'])
+		if distance is not None and min_dist <= distance <= max_dist:
+			yield hotel
+
+
+def iter_properties(id_destination: int, date_from: date, date_to: date, order_by: str, min_cost=None,
+					max_cost=None, max_pages: int = BESTDEAL_MAX_PAGES) -> Iterator[dict]:
+	"""
+	The function yields hotels suitable on request page by page.
+	The next page is requested only when the previous one has been consumed
+	and the last page is recognised by an incomplete list of results
+	:param id_destination: unique destination number
+	:param date_from: arrival date
+	:param date_to: departure date
+	:param order_by: hotel sorting method
+	:param min_cost: minimal price
+	:param max_cost: maximal price
+	:param max_pages: maximum number of pages
+	:return: iterator over the hotels without repetitions
+	"""
+	seen = set()
+	for page_number in range(1, max_pages + 1):
+		list_hotels = get_properties(id_destination, date_from, date_to, order_by, min_cost, max_cost, page_number)
+		for hotel in list_hotels:
+			if hotel['id'] not in seen:
+				seen.add(hotel['id'])
+				yield hotel
+		if len(list_hotels) < PROPERTIES_PAGE_SIZE:
+			break
+
+
+def get_bestdeal(id_destination: int, date_from: date, date_to: date, order_by: str, min_cost, max_cost,
+				 min_dist: float, max_dist: float, limit: int = BESTDEAL_MAX_HOTELS) -> list:
+	"""
+	The function returns hotels in the price range sent by the service and in the distance range
+	checked on each page, requesting further pages only until limit hotels are found
+	:param id_destination: unique destination number
+	:param date_from: arrival date
+	:param date_to: departure date
+	:param order_by: hotel sorting method
+	:param min_cost: minimal price
+	:param max_cost: maximal price
+	:param min_dist: desired minimum distance of the hotel from the center
+	:param max_dist: desired maximum distance of the hotel from the center
+	:param limit: maximum number of hotels
+	:return: list of hotels suitable on request
+	"""
+	list_hotels = iter_properties(id_destination, date_from, date_to, order_by, min_cost, max_cost)
+	return list(islice(filter_distance(list_hotels, min_dist, max_dist), limit))
+
+
+def parse_photo_links(data: dict) -> list:
+	"""
+	The function returns a list of photo link templates from the response of the get-hotel-photos service
+	:param data: decoded response of the service
+	:return: list of photo link templates
+	"""
+	return [photo['baseUrl'] for photo in data.get('hotelImages', [])[:PHOTO_CACHE_LINKS]]
+
+
+def _request_photo_links(id_hotel: str) -> Optional[list]:
 	"""
 	The function makes a request through the rapidapi service and
-	returns a list of photo links for each hotel
+	returns a list of photo link templates for one hotel
+	:param id_hotel: unique hotel number
+	:return: list of photo link templates for the hotel or None in case of failure
+	"""
+	querystring = {"id": id_hotel}
+	try:
+		response_photo = hotels_api.get("properties/get-hotel-photos", querystring)
+		if response_photo.status_code == 200:
+			return parse_photo_links(json.loads(response_photo.text))
+		logger.error(f'Сервис rapidapi.com/properties/get-hotel-photos ответил {response_photo.status_code}. '
+					 f'Нет данных по фото для отеля {id_hotel}')
+	except UpstreamUnavailable as ex:
+		logger.warning(f'Запрос к сервису rapidapi.com/properties/get-hotel-photos отклонен: {ex}')
+	except (ValueError, KeyError, TypeError, requests.RequestException) as ex:
+		logger.error(f'Ошибка GET запроса к сервису rapidapi.com/properties/get-hotel-photos Нет данных по фото '
+					 f'для отеля {id_hotel}', exc_info=ex)
+
+
+def _load_photo_links(id_hotel: str) -> Optional[list]:
+	"""
+	The function requests photo link templates of the hotel once for all simultaneous callers
+	:param id_hotel: unique hotel number
+	:return: list of photo link templates for the hotel or None in case of failure
+	"""
+	return _photos_flight.do(id_hotel, lambda: _request_photo_links(id_hotel))
+
+
+def get_cached_photo_links(list_id_hotels: list) -> dict:
+	"""
+	The function returns photo link templates of the hotels found in the memory cache or the database cache
+	:param list_id_hotels: list of unique hotel numbers
+	:return: dictionary of unique hotel number and list of photo link templates
+	"""
+	templates = {}
+	for id_hotel in list_id_hotels:
+		links = _photos_cache.get(id_hotel)
+		if links is not None:
+			templates[id_hotel] = links
+	missing = [id_hotel for id_hotel in dict.fromkeys(list_id_hotels) if id_hotel not in templates]
+	if missing:
+		for id_hotel, links in db.get_photos_cache(missing, PHOTO_CACHE_TTL).items():
+			templates[id_hotel] = links
+			_photos_cache.set(id_hotel, links)
+	return templates
+
+
+def get_stale_photo_links(id_hotel: str) -> Optional[list]:
+	"""
+	The function returns the expired photo link templates of the hotel from the memory cache or the database cache,
+	they are served when the rapidapi service fails
+	:param id_hotel: unique hotel number
+	:return: list of photo link templates or None
+	"""
+	links = _photos_cache.get(id_hotel, stale=True)
+	if links is None:
+		links = db.get_photos_cache([id_hotel], float('inf')).get(id_hotel)
+	if links:
+		upstream_guard.stale("properties/get-hotel-photos")
+	return links
+
+
+def cache_photo_links(fetched: dict) -> None:
+	"""
+	The function puts photo link templates of the hotels into the memory cache and the database cache
+	:param fetched: dictionary of unique hotel number and list of photo link templates
+	:return: None
+	"""
+	if fetched:
+		db.add_photos_cache(fetched)
+	for id_hotel, links in fetched.items():
+		_photos_cache.set(id_hotel, links)
+
+
+def render_photo_links(list_id_hotels: list, templates: dict, q_photo: int) -> list:
+	"""
+	The function returns a list of photo links for each hotel in the order of the list of hotels
+	:param list_id_hotels: list of unique hotel numbers
+	:param templates: dictionary of unique hotel number and list of photo link templates
+	:param q_photo: number of photos required for issuance for each hotel
+	:return: list of photo links for each hotel, an empty list for hotels without photos
+	"""
+	list_links_photo = []
+	for id_hotel in list_id_hotels:
+		links = templates.get(id_hotel)
+		if links:
+			list_links_photo.append([link.format(size='b') for link in links[:q_photo]])
+		else:
+			list_links_photo.append([])
+	return list_links_photo
+
+
+def iter_photo_links(list_id_hotels: list, q_photo: int) -> Iterator:
+	"""
+	The function yields photo links for each hotel in the order of the list of hotels as soon as they are ready.
+	Links are taken from the memory cache and the database cache, and only missing hotels
+	are requested concurrently through the rapidapi service, so a hotel waits only for its own request
+	and the requests of the hotels before it
+	:param list_id_hotels: list of unique hotel numbers
+	:param q_photo: number of photos required for issuance for each hotel
+	:return: iterator over photo links of each hotel, an empty list for hotels without photos
+	"""
+	templates = get_cached_photo_links(list_id_hotels)
+	missing = [id_hotel for id_hotel in dict.fromkeys(list_id_hotels) if id_hotel not in templates]
+	if not missing:
+		yield from render_photo_links(list_id_hotels, templates, q_photo)
+		return
+	fetched = {}
+	executor = ThreadPoolExecutor(max_workers=min(PHOTO_WORKERS, len(missing)))
+	futures = {id_hotel: executor.submit(_load_photo_links, id_hotel) for id_hotel in missing}
+	try:
+		for id_hotel in list_id_hotels:
+			future = futures.pop(id_hotel, None)
+			if future is not None:
+				links = future.result()
+				if links is not None:
+					fetched[id_hotel] = templates[id_hotel] = links
+				else:
+					templates[id_hotel] = get_stale_photo_links(id_hotel)
+			yield render_photo_links([id_hotel], templates, q_photo)[0]
+	finally:
+		executor.shutdown(wait=False, cancel_futures=True)
+		cache_photo_links(fetched)
+
+
+def get_photo_links(list_id_hotels: list, q_photo: int) -> list:
+	"""
+	The function returns a list of photo links for each hotel in the order of the list of hotels
+	:param list_id_hotels: list of unique hotel numbers
+	:param q_photo: number of photos required for issuance for each hotel
+	:return: list of photo links for each hotel, an empty list for hotels without photos
+	"""
+	return list(iter_photo_links(list_id_hotels, q_photo))
+
+
+def warm_photo_links(list_id_hotels: list) -> None:
+	"""
+	The function requests photo link templates of the hotels missing from the caches ahead of time
+	:param list_id_hotels: list of unique hotel numbers
+	:return: None
+	"""
+	templates = get_cached_photo_links(list_id_hotels)
+	fetched = {}
+	for id_hotel in dict.fromkeys(list_id_hotels):
+		if id_hotel not in templates:
+			links = _load_photo_links(id_hotel)
+			if links is not None:
+				fetched[id_hotel] = links
+	cache_photo_links(fetched)
+
+
+def get_photo_hotel(q_photo: int, id_user: int) -> list:
+	"""
+	The function returns a list of photo links for each hotel of the last user request
+	in the order of the hotel list
 	:param q_photo: number of photos required for issuance for each hotel
 	:param id_user: unique user number
 	:return: list of photo links for each hotel
 	"""
-	list_links_photo = []
-	id_request = db.get_id_request(id_user)
-	data_history = db.get_data_history(id_request)[6:]
-	q_hotels = data_history[0]
-	list_hotels = json.loads(data_history[1])[:q_hotels]
-	for hotel in list_hotels:
-		url_photo = os.getenv('url_api') + "properties/get-hotel-photos"
-		querystring = {"id": hotel["id"]}
-		headers = {
-			'x-rapidapi-host': os.getenv('x-rapidapi-host'),
-			'x-rapidapi-key': os.getenv('HOTELS_RU_TOKEN')
-		}
-		response_photo = requests.request("GET", url_photo, headers=headers, params=querystring)
-		try:
-			if response_photo.status_code == 200:
-				data = json.loads(response_photo.text)
-				if data.get('hotelImages'):
-					list_photo = data['hotelImages'][:q_photo]
-					list_links = []
-					for photo in list_photo:
-						link = photo['baseUrl'].format(size='b')
-						list_links.append(f'{link}')
-					list_links_photo.append(list_links)
-		except:
-			list_links_photo.append('нет данных')
-			logger.error(f'Ошибка GET запроса к сервису rapidapi.com/properties/get-hotel-photos Нет данных по фото')
+	conversation = conversations.get(id_user)
+	list_hotels = conversation.hotels[:conversation.q_hotels]
+	return get_photo_links([hotel["id"] for hotel in list_hotels], q_photo)
 
-	return list_links_photo
+
+def iter_photo_hotel(q_photo: int, id_user: int) -> Iterator:
+	"""
+	The function yields photo links for each hotel of the last user request in the order of the hotel list
+	as soon as the photos of the hotel are received
+	:param q_photo: number of photos required for issuance for each hotel, 0 without photos
+	:param id_user: unique user number
+	:return: iterator over photo links of each hotel, an empty list for hotels without photos
+			 and None for each hotel when no photos are requested
+	"""
+	conversation = conversations.get(id_user)
+	list_hotels = conversation.hotels[:conversation.q_hotels]
+	if not q_photo:
+		return iter([None] * len(list_hotels))
+	return iter_photo_links([hotel["id"] for hotel in list_hotels], q_photo)
 
 
 def form_message(id_user: int) -> list:
@@ -189,10 +613,10 @@ def form_message(id_user: int) -> list:
 	:return: message for output to the user
 	"""
 	answer = []
-	id_request = db.get_id_request(id_user)
-	date_from, date_to, command, id_destination, name_destination, q_days, q_hotels, response = db.get_data_history(
-		id_request)
-	list_hotels = json.loads(response)[:q_hotels]
+	conversation = conversations.get(id_user)
+	date_from, date_to, command = conversation.date_from, conversation.date_to, conversation.command
+	q_days = conversation.q_days
+	list_hotels = conversation.hotels[:conversation.q_hotels]
 	if command == '/lowprice':
 		answer.append(f'<b>Список отелей с минимальной стоимостью в $ за период: '
 					  f'c {date_from} по {date_to}</b>\n')
@@ -218,6 +642,85 @@ def form_message(id_user: int) -> list:
 	return answer
 
 
+def form_progress(header: str, q_sent: int, q_hotels: int) -> str:
+	"""
+	The function adds the progress of sending the response to its header
+	:param header: header of the response
+	:param q_sent: number of hotels already sent
+	:param q_hotels: number of hotels in the response
+	:return: text of the header with the progress
+	"""
+	return f'{header.rstrip()}\nОтправлено отелей: {q_sent} из {q_hotels}...'
+
+
+def pack_messages(parts: list, limit: int = MESSAGE_LIMIT) -> list:
+	"""
+	The function joins consecutive parts of the answer into as few messages as fit into the length limit
+	:param parts: texts in the order of output
+	:param limit: maximum length of one message
+	:return: list of message texts
+	"""
+	messages = []
+	current = ''
+	for part in parts:
+		while len(part) > limit:
+			if current:
+				messages.append(current)
+				current = ''
+			messages.append(part[:limit])
+			part = part[limit:]
+		if current and len(current) + 1 + len(part) > limit:
+			messages.append(current)
+			current = part
+		else:
+			current = f'{current}\n{part}' if current else part
+	if current:
+		messages.append(current)
+	return messages
+
+
+def pack_albums(list_links_photo: list, captions: list, limit: int = MEDIA_GROUP_LIMIT) -> list:
+	"""
+	The function merges the photos of several hotels into albums of at most limit photos.
+	Photos of one hotel are not split between albums, the first photo of a hotel is signed with its caption
+	:param list_links_photo: list of links to photo for each hotel, hotels without a list of links are skipped
+	:param captions: caption for each hotel
+	:param limit: maximum number of photos in one album
+	:return: list of albums, each a list of pairs (link, caption or None)
+	"""
+	albums = [[]]
+	for links, caption in zip(list_links_photo, captions):
+		if not isinstance(links, list) or not links:
+			continue
+		links = links[:limit]
+		if len(albums[-1]) + len(links) > limit:
+			albums.append([])
+		albums[-1].extend((link, caption[:CAPTION_LIMIT] if index == 0 else None) for index, link in enumerate(links))
+	return [album for album in albums if album]
+
+
+def form_history_pages(list_history: list) -> list:
+	"""
+	The function generates the pages of the query history: the hotels found for each request are packed into
+	as few pages as fit into the length limit of a message, every page starts with the request it belongs to
+	:param list_history: user query history list
+	:return: list of messages for output to the user, one per page
+	"""
+	pages = []
+	for number, (date_request, command, name_destination, id_request) in enumerate(list_history, 1):
+		header = (f'<b>Запрос {number} из {len(list_history)}</b>\n'
+				  f'<b>дата запроса - {date_request}</b>\n'
+				  f'<b>команда - {command}</b>\n'
+				  f'<b>город - {name_destination}</b>\n')
+		list_hotels = db.get_hotel_results(id_request, ('name', 'current', 'url'))
+		parts = [f"отель - {hotel['name']}\n"
+				 f"стоимость - {hotel['current']}\n"
+				 f"ссылка - {hotel['url']}\n" for hotel in list_hotels]
+		for message in pack_messages(parts or ['Ничего не нашлось'], MESSAGE_LIMIT - len(header) - 1):
+			pages.append(f'{header}\n{message}')
+	return pages
+
+
 def get_another_message():
 	"""
 	The function returns a help message
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from api_async import async_hotels_api
+from cache import AsyncSingleFlight
+from conversation import conversations
+from func import parse_district, normalize_city, get_cached_district, cache_district, properties_querystring, \
+	parse_properties, properties_key, properties_cache, parse_photo_links, get_cached_photo_links, cache_photo_links, \
+	render_photo_links, filter_distance, suggest_district, get_stale_district, get_stale_properties, \
+	get_stale_photo_links, PROPERTIES_PAGE_SIZE, BESTDEAL_MAX_PAGES, BESTDEAL_MAX_HOTELS
+from upstream import UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+_properties_flight = AsyncSingleFlight()
+_photos_flight = AsyncSingleFlight()
+
+
+async def get_district(city: str) -> list:
+	"""
+	The function returns a list of districts of the city specified in the request
+	from the memory cache, the database cache or through the rapidapi service.
+	If the service finds nothing, the districts of a city of the index with a close name are offered
+	:param city: the city in which the user is looking for hotels
+	:return: list of districts of the city specified in the request
+	"""
+	query = normalize_city(city)
+	list_class_cities = await asyncio.to_thread(get_cached_district, query)
+	if list_class_cities is None:
+		querystring_location = {"query": query, "locale": "en_EN", "currency": "USD"}
+		try:
+			status, text = await async_hotels_api.get("locations/v2/search", querystring_location)
+			if status == 200:
+				list_class_cities = parse_district(json.loads(text))
+			else:
+				logger.error(f'Сервис rapidapi.com/locations/v2/search ответил {status}. Нет данных')
+		except UpstreamUnavailable as ex:
+			logger.warning(f'Запрос к сервису rapidapi.com/locations/v2/search отклонен: {ex}')
+		except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+			logger.error(f'Ошибка GET запроса к сервису rapidapi.com/locations/v2/search. Нет данных', exc_info=ex)
+		if list_class_cities is None:
+			list_class_cities = await asyncio.to_thread(get_stale_district, query)
+		else:
+			await asyncio.to_thread(cache_district, query, list_class_cities)
+	return list_class_cities or await asyncio.to_thread(suggest_district, query)
+
+
+async def _load_properties(key: tuple, *args) -> list:
+	"""
+	The function requests the list of hotels and puts a non-empty result into the cache
+	:param key: cache key of the request
+	:param args: arguments of properties_querystring
+	:return: list of hotels suitable on request
+	"""
+	list_result = None
+	try:
+		status, text = await async_hotels_api.get("properties/list", properties_querystring(*args))
+		if status == 200:
+			list_result = parse_properties(json.loads(text))
+		else:
+			logger.error(f'Сервис rapidapi.com/properties/list ответил {status}. Нет данных по отелям')
+	except UpstreamUnavailable as ex:
+		logger.warning(f'Запрос к сервису rapidapi.com/properties/list отклонен: {ex}')
+	except (ValueError, KeyError, TypeError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+		logger.error(f'Ошибка GET запроса к сервису rapidapi.com/properties/list. Нет данных по отелям', exc_info=ex)
+	if list_result is None:
+		return get_stale_properties(key)
+	if list_result:
+		properties_cache.set(key, list_result)
+	return list_result
+
+
+async def get_properties(id_destination: int, date_from: str, date_to: str, order_by: str, min_cost=None,
+						 max_cost=None, page_number: int = 1) -> list:
+	"""
+	The function returns a list of hotels suitable on request from the cache or through the rapidapi service.
+	Simultaneous identical requests are merged into one request to the service
+	:param id_destination: unique destination number
+	:param date_from: arrival date
+	:param date_to: departure date
+	:param order_by: hotel sorting method
+	:param min_cost: minimal price
+	:param max_cost: maximal price
+	:param page_number: number of the page of results starting from 1
+	:return: list of hotels suitable on request
+	"""
+	args = (id_destination, date_from, date_to, order_by, min_cost, max_cost, page_number)
+	key = properties_key(*args)
+	list_result = properties_cache.get(key)
+	if list_result is None:
+		list_result = await _properties_flight.do(key, lambda: _load_properties(key, *args))
+	return list(list_result)
+
+
+async def iter_properties(id_destination: int, date_from: str, date_to: str, order_by: str, min_cost=None,
+						  max_cost=None, max_pages: int = BESTDEAL_MAX_PAGES):
+	"""
+	The function yields pages of hotels suitable on request.
+	The next page is requested only when the previous one has been consumed
+	and the last page is recognised by an incomplete list of results
+	:param id_destination: unique destination number
+	:param date_from: arrival date
+	:param date_to: departure date
+	:param order_by: hotel sorting method
+	:param min_cost: minimal price
+	:param max_cost: maximal price
+	:param max_pages: maximum number of pages
+	:return: asynchronous iterator over the pages, hotels already yielded on previous pages are skipped
+	"""
+	seen = set()
+	for page_number in range(1, max_pages + 1):
+		list_hotels = await get_properties(id_destination, date_from, date_to, order_by, min_cost, max_cost,
+										   page_number)
+		yield [hotel for hotel in list_hotels if hotel['id'] not in seen]
+		seen.update(hotel['id'] for hotel in list_hotels)
+		if len(list_hotels) < PROPERTIES_PAGE_SIZE:
+			break
+
+
+async def get_bestdeal(id_destination: int, date_from: str, date_to: str, order_by: str, min_cost, max_cost,
+					   min_dist: float, max_dist: float, limit: int = BESTDEAL_MAX_HOTELS) -> list:
+	"""
+	The function returns hotels in the price range sent by the service and in the distance range
+	checked on each page, requesting further pages only until limit hotels are found
+	:param id_destination: unique destination number
+	:param date_from: arrival date
+	:param date_to: departure date
+	:param order_by: hotel sorting method
+	:param min_cost: minimal price
+	:param max_cost: maximal price
+	:param min_dist: desired minimum distance of the hotel from the center
+	:param max_dist: desired maximum distance of the hotel from the center
+	:param limit: maximum number of hotels
+	:return: list of hotels suitable on request
+	"""
+	list_result = []
+	async for list_hotels in iter_properties(id_destination, date_from, date_to, order_by, min_cost, max_cost):
+		list_result.extend(filter_distance(list_hotels, min_dist, max_dist))
+		if len(list_result) >= limit:
+			break
+	return list_result[:limit]
+
+
+async def _request_photo_links(id_hotel: str):
+	"""
+	The function makes a request through the rapidapi service and
+	returns a list of photo link templates for one hotel
+	:param id_hotel: unique hotel number
+	:return: list of photo link templates for the hotel or None in case of failure
+	"""
+	try:
+		status, text = await async_hotels_api.get("properties/get-hotel-photos", {"id": id_hotel})
+		if status == 200:
+			return parse_photo_links(json.loads(text))
+		logger.error(f'Сервис rapidapi.com/properties/get-hotel-photos ответил {status}. '
+					 f'Нет данных по фото для отеля {id_hotel}')
+	except UpstreamUnavailable as ex:
+		logger.warning(f'Запрос к сервису rapidapi.com/properties/get-hotel-photos отклонен: {ex}')
+	except (ValueError, KeyError, TypeError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+		logger.error(f'Ошибка GET запроса к сервису rapidapi.com/properties/get-hotel-photos Нет данных по фото '
+					 f'для отеля {id_hotel}', exc_info=ex)
+
+
+async def _load_photo_links(id_hotel: str):
+	"""
+	The function requests photo link templates of the hotel once for all simultaneous callers
+	:param id_hotel: unique hotel number
+	:return: list of photo link templates for the hotel or None in case of failure
+	"""
+	return await _photos_flight.do(id_hotel, lambda: _request_photo_links(id_hotel))
+
+
+async def warm_photo_links(list_id_hotels: list) -> None:
+	"""
+	The function requests photo link templates of the hotels missing from the caches ahead of time
+	:param list_id_hotels: list of unique hotel numbers
+	:return: None
+	"""
+	templates = await asyncio.to_thread(get_cached_photo_links, list_id_hotels)
+	missing = [id_hotel for id_hotel in dict.fromkeys(list_id_hotels) if id_hotel not in templates]
+	if missing:
+		results = await asyncio.gather(*(_load_photo_links(id_hotel) for id_hotel in missing))
+		await asyncio.to_thread(cache_photo_links, {id_hotel: links for id_hotel, links in zip(missing, results)
+													if links is not None})
+
+
+async def iter_photo_links(list_id_hotels: list, q_photo: int):
+	"""
+	The function yields photo links for each hotel in the order of the list of hotels as soon as they are ready.
+	Links are taken from the caches, and only missing hotels are requested concurrently through the rapidapi service,
+	so a hotel waits only for its own request and the requests of the hotels before it
+	:param list_id_hotels: list of unique hotel numbers
+	:param q_photo: number of photos required for issuance for each hotel
+	:return: asynchronous iterator over photo links of each hotel, an empty list for hotels without photos
+	"""
+	templates = await asyncio.to_thread(get_cached_photo_links, list_id_hotels)
+	missing = [id_hotel for id_hotel in dict.fromkeys(list_id_hotels) if id_hotel not in templates]
+	tasks = {id_hotel: asyncio.ensure_future(_load_photo_links(id_hotel)) for id_hotel in missing}
+	fetched = {}
+	try:
+		for id_hotel in list_id_hotels:
+			task = tasks.pop(id_hotel, None)
+			if task is not None:
+				links = await task
+				if links is not None:
+					fetched[id_hotel] = templates[id_hotel] = links
+				else:
+					templates[id_hotel] = await asyncio.to_thread(get_stale_photo_links, id_hotel)
+			yield render_photo_links([id_hotel], templates, q_photo)[0]
+	finally:
+		for task in tasks.values():
+			task.cancel()
+		await asyncio.to_thread(cache_photo_links, fetched)
+
+
+async def get_photo_links(list_id_hotels: list, q_photo: int) -> list:
+	"""
+	The function returns a list of photo links for each hotel in the order of the list of hotels
+	:param list_id_hotels: list of unique hotel numbers
+	:param q_photo: number of photos required for issuance for each hotel
+	:return: list of photo links for each hotel, an empty list for hotels without photos
+	"""
+	return [links async for links in iter_photo_links(list_id_hotels, q_photo)]
+
+
+async def get_photo_hotel(q_photo: int, id_user: int) -> list:
+	"""
+	The function returns a list of photo links for each hotel of the last user request
+	in the order of the hotel list
+	:param q_photo: number of photos required for issuance for each hotel
+	:param id_user: unique user number
+	:return: list of photo links for each hotel
+	"""
+	conversation = await asyncio.to_thread(conversations.get, id_user)
+	list_hotels = conversation.hotels[:conversation.q_hotels]
+	return await get_photo_links([hotel["id"] for hotel in list_hotels], q_photo)
+
+
+async def iter_photo_hotel(q_photo: int, id_user: int):
+	"""
+	The function yields photo links for each hotel of the last user request in the order of the hotel list
+	as soon as the photos of the hotel are received
+	:param q_photo: number of photos required for issuance for each hotel, 0 without photos
+	:param id_user: unique user number
+	:return: asynchronous iterator over photo links of each hotel, an empty list for hotels without photos
+			 and None for each hotel when no photos are requested
+	"""
+	conversation = await asyncio.to_thread(conversations.get, id_user)
+	list_hotels = conversation.hotels[:conversation.q_hotels]
+	if not q_photo:
+		for _ in list_hotels:
+			yield None
+		return
+	async for links in iter_photo_links([hotel["id"] for hotel in list_hotels], q_photo):
+		yield links
@@ -0,0 +1,48 @@
+import telebot
+from telebot.types import InlineKeyboardMarkup
+
+
+def get_keyboard_district(list_names_districts: list) -> InlineKeyboardMarkup:
+	"""
+	The function returns an inline keyboard to specify the area of the city
+	:param list_names_districts: list of districts for the requested city
+	:return: inline keyboard to specify the area of the city
+	"""
+	keyboard = telebot.types.InlineKeyboardMarkup()
+	for name_district in list_names_districts:
+		keyboard.row_width = 1
+		keyboard.add(telebot.types.InlineKeyboardButton(name_district.name,
+														callback_data='***'.join(
+															[name_district.id_destination, name_district.name[:20]])))
+	return keyboard
+
+
+def get_keyboard_photo():
+	"""
+	The function returns a built-in keyboard with yes or no answer buttons
+	:return: inline keyboard а built-in keyboard with yes or no answer buttons
+	"""
+	keyboard = telebot.types.InlineKeyboardMarkup()
+	keyboard.row_width = 1
+	keyboard.add(telebot.types.InlineKeyboardButton('ДА', callback_data='да'),
+				 telebot.types.InlineKeyboardButton('НЕТ', callback_data='нет'))
+
+	return keyboard
+
+
+def get_keyboard_history(page: int, q_pages: int) -> InlineKeyboardMarkup:
+	"""
+	The function returns an inline keyboard to turn the pages of the query history
+	:param page: number of the current page starting from 0
+	:param q_pages: number of pages
+	:return: inline keyboard with buttons to the previous and the next page
+	"""
+	keyboard = telebot.types.InlineKeyboardMarkup()
+	buttons = []
+	if page > 0:
+		buttons.append(telebot.types.InlineKeyboardButton('◀', callback_data=f'history:{page - 1}'))
+	if page < q_pages - 1:
+		buttons.append(telebot.types.InlineKeyboardButton('▶', callback_data=f'history:{page + 1}'))
+	if buttons:
+		keyboard.row(*buttons)
+	return keyboard
@@ -0,0 +1,255 @@
+"""
+Fake Telegram Bot API for load tests.
+
+Serves the methods used by the bot (getUpdates, sendMessage, editMessageText, sendMediaGroup, sendPhoto,
+answerCallbackQuery and others), queues updates of simulated users for getUpdates and keeps
+the messages of the bot per chat, so the simulated users can wait for the answers.
+The bot is pointed at it with TELEGRAM_API_URL=http://127.0.0.1:8081/
+"""
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Choosing hotels', 'username': 'choosing_hotels_bot'}
+SEND_METHODS = ('sendMessage', 'sendPhoto', 'sendMediaGroup')
+EDIT_METHODS = ('editMessageText', 'editMessageReplyMarkup')
+
+
+class FakeTelegram:
+	"""
+	Http server answering like the Telegram Bot API after a random latency.
+	A share of sending methods fails with error 429 to check the outbound queue of the bot,
+	getUpdates requests without the timeout of long polling are counted in short_polls
+	"""
+
+	def __init__(self, host: str = '127.0.0.1', port: int = 8081, latency: float = 0.03,
+				 throttle_rate: float = 0.0):
+		self.latency = latency
+		self.throttle_rate = throttle_rate
+		self.requests = Counter()
+		self.short_polls = 0
+		self.__updates = []
+		self.__update_ids = itertools.count(1)
+		self.__message_ids = itertools.count(1)
+		self.__chats = {}
+		self.__condition = threading.Condition()
+		self.__polled = threading.Event()
+		self.__server = ThreadingHTTPServer((host, port), self.__make_handler())
+		self.__server.daemon_threads = True
+
+	@property
+	def url(self) -> str:
+		host, port = self.__server.server_address[:2]
+		return f'http://{host}:{port}/'
+
+	def start(self) -> 'FakeTelegram':
+		"""
+		The function starts the server in a background thread
+		:return: the server
+		"""
+		threading.Thread(target=self.__server.serve_forever, name='fake-telegram', daemon=True).start()
+		return self
+
+	def stop(self) -> None:
+		"""
+		The function stops the server
+		:return: None
+		"""
+		self.__server.shutdown()
+		self.__server.server_close()
+
+	def wait_polling(self, timeout: float) -> bool:
+		"""
+		The function waits for the first getUpdates request of the bot
+		:param timeout: timeout in seconds
+		:return: True if the bot polls the updates
+		"""
+		return self.__polled.wait(timeout)
+
+	def send_text(self, chat_id: int, text: str) -> None:
+		"""
+		The function queues a text message of the user, commands are marked with the bot_command entity
+		:param chat_id: unique chat number of the user
+		:param text: text of the message
+		:return: None
+		"""
+		message = self.__message(chat_id, text=text, from_user=self.__user(chat_id))
+		if text.startswith('/'):
+			message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+		self.__push({'message': message})
+
+	def press_button(self, chat_id: int, message_id: int, data: str) -> None:
+		"""
+		The function queues a press of an inline keyboard button by the user
+		:param chat_id: unique chat number of the user
+		:param message_id: unique number of the message with the keyboard
+		:param data: callback data of the button
+		:return: None
+		"""
+		self.__push({'callback_query': {'id': str(next(self.__update_ids)), 'chat_instance': str(chat_id),
+										'from': self.__user(chat_id), 'data': data,
+										'message': {'message_id': message_id, 'date': int(time.time()),
+													'chat': {'id': chat_id, 'type': 'private'}}}})
+
+	def wait_message(self, chat_id: int, predicate: Callable, timeout: float) -> Optional[dict]:
+		"""
+		The function waits for the next message of the bot to the chat that satisfies the predicate,
+		the messages before it are skipped
+		:param chat_id: unique chat number of the user
+		:param predicate: function of the message returning True for the awaited message
+		:param timeout: timeout in seconds
+		:return: message of the bot with the keys method, message_id, text and reply_markup or None on timeout
+		"""
+		deadline = time.monotonic() + timeout
+		with self.__condition:
+			chat = self.__chats.setdefault(chat_id, {'messages': [], 'cursor': 0})
+			while True:
+				messages = chat['messages']
+				for index in range(chat['cursor'], len(messages)):
+					if predicate(messages[index]):
+						chat['cursor'] = index + 1
+						return messages[index]
+				chat['cursor'] = len(messages)
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return None
+				self.__condition.wait(remaining)
+
+	def forget(self, chat_id: int) -> None:
+		"""
+		The function removes the messages of the chat
+		:param chat_id: unique chat number of the user
+		:return: None
+		"""
+		with self.__condition:
+			self.__chats.pop(chat_id, None)
+
+	def call(self, method: str, params: dict) -> tuple:
+		"""
+		The function executes the method of the Bot API
+		:param method: name of the method
+		:param params: parameters of the method
+		:return: status code and decoded body of the answer
+		"""
+		if method != 'getUpdates':
+			time.sleep(max(0.0, random.gauss(self.latency, self.latency / 3)))
+		if method in SEND_METHODS + EDIT_METHODS and random.random() < self.throttle_rate:
+			self.__count(method, 429)
+			return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+						 'parameters': {'retry_after': 1}}
+		if method == 'getUpdates':
+			timeout = float(params.get('timeout') or 0)
+			if not timeout:
+				with self.__condition:
+					self.short_polls += 1
+			result = self.__get_updates(int(params.get('offset') or 0), timeout)
+		elif method == 'getMe':
+			result = BOT_USER
+		elif method in SEND_METHODS + EDIT_METHODS:
+			result = self.__record(method, params)
+		else:
+			result = True
+		self.__count(method, 200)
+		return 200, {'ok': True, 'result': result}
+
+	def __count(self, method: str, status: int) -> None:
+		with self.__condition:
+			self.requests[(method, status)] += 1
+
+	def __get_updates(self, offset: int, timeout: float) -> list:
+		"""
+		The function returns the updates starting from offset and waits up to timeout for new ones
+		:param offset: identifier of the first update to be returned
+		:param timeout: timeout of long polling in seconds
+		:return: list of updates
+		"""
+		self.__polled.set()
+		deadline = time.monotonic() + min(timeout, 1)
+		with self.__condition:
+			self.__updates = [update for update in self.__updates if update['update_id'] >= offset]
+			while not self.__updates and time.monotonic() < deadline:
+				self.__condition.wait(deadline - time.monotonic())
+			return list(self.__updates)
+
+	def __record(self, method: str, params: dict):
+		"""
+		The function keeps the message of the bot and returns it in the format of the Bot API
+		:param method: name of the method
+		:param params: parameters of the method
+		:return: message or list of messages for sendMediaGroup
+		"""
+		chat_id = int(params['chat_id'])
+		reply_markup = json.loads(params['reply_markup']) if params.get('reply_markup') else None
+		text = params.get('text') or params.get('caption') or ''
+		if method in EDIT_METHODS:
+			message_ids = [int(params['message_id'])]
+		elif method == 'sendMediaGroup':
+			message_ids = [next(self.__message_ids) for _ in json.loads(params['media'])]
+		else:
+			message_ids = [next(self.__message_ids)]
+		with self.__condition:
+			chat = self.__chats.setdefault(chat_id, {'messages': [], 'cursor': 0})
+			chat['messages'].append({'method': method, 'message_id': message_ids[0], 'text': text,
+									 'reply_markup': reply_markup, 'time': time.monotonic()})
+			self.__condition.notify_all()
+		messages = [self.__message(chat_id, message_id, text=text, from_user=BOT_USER) for message_id in message_ids]
+		return messages if method == 'sendMediaGroup' else messages[0]
+
+	def __push(self, update: dict) -> None:
+		with self.__condition:
+			update['update_id'] = next(self.__update_ids)
+			self.__updates.append(update)
+			self.__condition.notify_all()
+
+	def __message(self, chat_id: int, message_id: Optional[int] = None, **fields) -> dict:
+		message = {'message_id': message_id or next(self.__message_ids), 'date': int(time.time()),
+				   'chat': {'id': chat_id, 'type': 'private'}}
+		if 'from_user' in fields:
+			message['from'] = fields.pop('from_user')
+		message.update(fields)
+		return message
+
+	@staticmethod
+	def __user(chat_id: int) -> dict:
+		return {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}', 'language_code': 'ru'}
+
+	def __make_handler(self) -> type:
+		api = self
+
+		class Handler(BaseHTTPRequestHandler):
+
+			def do_GET(self) -> None:
+				self.__answer()
+
+			def do_POST(self) -> None:
+				self.__answer()
+
+			def __answer(self) -> None:
+				# the asynchronous bot sends the parameters in the body of GET requests as well
+				body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+				url = urlparse(self.path)
+				params = parse_qs(url.query)
+				if body and 'multipart/form-data' not in self.headers.get('Content-Type', ''):
+					params.update(parse_qs(body.decode()))
+				status, answer = api.call(url.path.rsplit('/', 1)[-1],
+										  {key: values[0] for key, values in params.items()})
+				data = json.dumps(answer).encode()
+				try:
+					self.send_response(status)
+					self.send_header('Content-Type', 'application/json')
+					self.send_header('Content-Length', str(len(data)))
+					self.end_headers()
+					self.wfile.write(data)
+				except ConnectionError:
+					pass  # the bot has stopped during long polling
+
+			def log_message(self, format: str, *args) -> None:
+				pass
+
+		return Handler
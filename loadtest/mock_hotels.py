@@ -0,0 +1,239 @@
+"""
+Local stand-in for the endpoints of the hotels service used by the bot:
+locations/v2/search, properties/list and properties/get-hotel-photos.
+
+Usage: python loadtest/mock_hotels.py [--port 8765] [--hotels-latency 0.2] [--hotels-jitter 0.1]
+	   [--error-rate 0.01] [--throttle-rate 0.01] [--pages 3] [--quota 500] [--quota-window 60]
+
+The bot is pointed at it with url_api=http://127.0.0.1:8765/
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE = 15
+
+
+def _seed(*values) -> int:
+	"""
+	The function returns a stable seed for the generated data, so repeated requests get the same answer
+	:param values: parameters of the request
+	:return: seed
+	"""
+	return int(hashlib.md5('|'.join(map(str, values)).encode()).hexdigest()[:8], 16)
+
+
+def search_locations(query: str) -> dict:
+	"""
+	The function returns the answer of locations/v2/search with three districts of the city
+	:param query: name of the city
+	:return: answer of the service
+	"""
+	id_city = _seed(query.lower()) % 10 ** 6
+	entities = [{'name': f'{query.title()} {district}', 'destinationId': str(id_city * 10 + number)}
+				for number, district in enumerate(('Center', 'North', 'South'))]
+	return {'suggestions': [{'group': 'CITY_GROUP', 'entities': entities},
+							{'group': 'HOTEL_GROUP', 'entities': []}]}
+
+
+def list_properties(params: dict, pages: int) -> dict:
+	"""
+	The function returns the answer of properties/list with a page of generated hotels of the destination
+	filtered by price and sorted by sortOrder
+	:param params: query string parameters
+	:param pages: number of pages of every destination
+	:return: answer of the service
+	"""
+	page_number = int(params.get('pageNumber', 1))
+	page_size = int(params.get('pageSize', PAGE_SIZE))
+	generator = random.Random(_seed(params.get('destinationId'), params.get('checkIn'), params.get('checkOut')))
+	hotels = []
+	for number in range(pages * page_size):
+		id_hotel = generator.randrange(10 ** 5, 10 ** 7)
+		hotels.append({'id': id_hotel, 'name': f'Hotel {id_hotel}',
+					   'address': {'locality': 'City', 'streetAddress': f'{number + 1} Main Street'},
+					   'ratePlan': {'price': {'exactCurrent': round(generator.uniform(20, 600), 2)}},
+					   'landmarks': [{'label': 'City center', 'distance': f'{generator.uniform(0.1, 12):.1f} miles'}]})
+	if params.get('priceMin') and params.get('priceMax'):
+		hotels = [hotel for hotel in hotels if float(params['priceMin']) <= hotel['ratePlan']['price']['exactCurrent']
+				  <= float(params['priceMax'])]
+	hotels.sort(key=lambda hotel: hotel['ratePlan']['price']['exactCurrent'],
+				reverse=params.get('sortOrder') == 'PRICE_HIGHEST_FIRST')
+	results = hotels[(page_number - 1) * page_size:page_number * page_size]
+	pagination = {'currentPage': page_number}
+	if page_number * page_size < len(hotels):
+		pagination['nextPageNumber'] = page_number + 1
+	return {'result': 'OK', 'data': {'body': {'searchResults': {'results': results, 'pagination': pagination}}}}
+
+
+def get_hotel_photos(id_hotel: str) -> dict:
+	"""
+	The function returns the answer of properties/get-hotel-photos with eight photos of the hotel
+	:param id_hotel: unique hotel number
+	:return: answer of the service
+	"""
+	images = [{'imageId': number, 'baseUrl': f'https://exp.cdn-hotels.com/{id_hotel}/{number}_{{size}}.jpg'}
+			  for number in range(8)]
+	return {'hotelId': id_hotel, 'hotelImages': images}
+
+
+class MockHotelsApi:
+	"""
+	Http server answering like the hotels service after a random latency.
+	A share of requests fails with error 500 or 429 to check the retries of the bot.
+	With a quota the answers carry the x-ratelimit-requests-* headers of rapidapi
+	and the requests over the quota of the window fail with error 429
+	"""
+
+	def __init__(self, host: str = '127.0.0.1', port: int = 8765, latency: float = 0.2, jitter: float = 0.1,
+				 error_rate: float = 0.0, throttle_rate: float = 0.0, pages: int = 3, quota: int = 0,
+				 quota_window: float = 60.0):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.throttle_rate = throttle_rate
+		self.pages = pages
+		self.quota = quota
+		self.quota_window = quota_window
+		self.__quota_used = 0
+		self.__quota_reset_at = time.monotonic() + quota_window
+		self.requests = Counter()
+		self.__lock = threading.Lock()
+		self.__server = ThreadingHTTPServer((host, port), self.__make_handler())
+		self.__server.daemon_threads = True
+
+	@property
+	def url(self) -> str:
+		host, port = self.__server.server_address[:2]
+		return f'http://{host}:{port}/'
+
+	def start(self) -> 'MockHotelsApi':
+		"""
+		The function starts the server in a background thread
+		:return: the server
+		"""
+		threading.Thread(target=self.__server.serve_forever, name='mock-hotels', daemon=True).start()
+		return self
+
+	def stop(self) -> None:
+		"""
+		The function stops the server
+		:return: None
+		"""
+		self.__server.shutdown()
+		self.__server.server_close()
+
+	def spend_quota(self) -> dict:
+		"""
+		The function spends one request of the quota of the current window
+		:return: quota headers of the answer, empty without a quota
+		"""
+		if not self.quota:
+			return {}
+		with self.__lock:
+			now = time.monotonic()
+			if now >= self.__quota_reset_at:
+				self.__quota_used = 0
+				self.__quota_reset_at = now + self.quota_window
+			self.__quota_used += 1
+			return {'x-ratelimit-requests-limit': str(self.quota),
+					'x-ratelimit-requests-remaining': str(max(0, self.quota - self.__quota_used)),
+					'x-ratelimit-requests-reset': str(int(self.__quota_reset_at - now))}
+
+	def answer(self, path: str, params: dict) -> tuple:
+		"""
+		The function returns the status, the body and the headers of the answer to the request
+		:param path: path of the endpoint
+		:param params: query string parameters
+		:return: status code, decoded body and headers
+		"""
+		time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+		headers = self.spend_quota()
+		chance = random.random()
+		if self.quota and self.__quota_used > self.quota:
+			status, body = 429, {'message': 'You have exceeded the rate limit per minute for your plan'}
+		elif chance < self.error_rate:
+			status, body = 500, {'message': 'Internal Server Error'}
+		elif chance < self.error_rate + self.throttle_rate:
+			status, body = 429, {'message': 'Too many requests'}
+		elif path.endswith('locations/v2/search'):
+			status, body = 200, search_locations(params.get('query', ''))
+		elif path.endswith('properties/list'):
+			status, body = 200, list_properties(params, self.pages)
+		elif path.endswith('properties/get-hotel-photos'):
+			status, body = 200, get_hotel_photos(params.get('id', ''))
+		else:
+			status, body = 404, {'message': 'Endpoint does not exist'}
+		with self.__lock:
+			self.requests[(path.strip('/'), status)] += 1
+		return status, body, headers
+
+	def __make_handler(self) -> type:
+		api = self
+
+		class Handler(BaseHTTPRequestHandler):
+
+			def do_GET(self) -> None:
+				url = urlparse(self.path)
+				params = {key: values[0] for key, values in parse_qs(url.query).items()}
+				status, body, headers = api.answer(url.path, params)
+				data = json.dumps(body).encode()
+				self.send_response(status)
+				for name, value in headers.items():
+					self.send_header(name, value)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def log_message(self, format: str, *args) -> None:
+				pass
+
+		return Handler
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+	"""
+	The function adds the options of the mock to the parser of the command line
+	:param parser: parser of the command line
+	:return: None
+	"""
+	parser.add_argument('--hotels-latency', type=float, default=0.2, help='mean latency of the answer in seconds')
+	parser.add_argument('--hotels-jitter', type=float, default=0.1, help='standard deviation of the latency')
+	parser.add_argument('--error-rate', type=float, default=0.0, help='share of answers with error 500')
+	parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of answers with error 429')
+	parser.add_argument('--pages', type=int, default=3, help='pages of hotels of every destination')
+	parser.add_argument('--quota', type=int, default=0, help='requests allowed in a quota window, 0 for no quota')
+	parser.add_argument('--quota-window', type=float, default=60.0, help='length of the quota window in seconds')
+
+
+def from_arguments(options: argparse.Namespace, port: int) -> MockHotelsApi:
+	"""
+	The function creates the mock with the options of the command line
+	:param options: parsed options
+	:param port: port of the server, 0 for any free port
+	:return: the mock
+	"""
+	return MockHotelsApi(port=port, latency=options.hotels_latency, jitter=options.hotels_jitter,
+						 error_rate=options.error_rate, throttle_rate=options.throttle_rate, pages=options.pages,
+						 quota=options.quota, quota_window=options.quota_window)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--port', type=int, default=8765)
+	add_arguments(parser)
+	options = parser.parse_args()
+	mock = from_arguments(options, options.port).start()
+	print(f'Mock hotels api on {mock.url}')
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		mock.stop()
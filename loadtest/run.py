@@ -0,0 +1,341 @@
+"""
+Load test of the bot: N simulated users run full /lowprice and /bestdeal conversations,
+including the calendar, against the bot started with the mock hotels api and the fake Telegram Bot API.
+Reports the throughput and p50/p95/p99 latency of whole conversations and of every step.
+
+Usage: python loadtest/run.py [--users 20] [--rounds 3] [--commands lowprice,bestdeal] [--runtime sync]
+	   [--photos 2] [--hotels-latency 0.2] [--error-rate 0.01] [--env OUTBOX_CHAT_RATE=5] [--json report.json]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Callable
+
+import mock_hotels
+from fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FINAL_TEXT = 'Чем я еще могу вам помочь?'
+NOT_FOUND_TEXT = 'ничего не найдено'
+COUNT_TEXT = 'Какое кол-во отелей'
+
+
+class ConversationError(Exception):
+	"""
+	The bot has not answered the step of the conversation in time
+	"""
+
+	def __init__(self, step: str):
+		super().__init__(step)
+		self.step = step
+
+
+def _buttons(message: dict, marker: str) -> list:
+	"""
+	The function returns the callback data of the inline keyboard buttons containing the marker
+	:param message: message of the bot
+	:param marker: substring of the callback data
+	:return: list of callback data
+	"""
+	keyboard = (message.get('reply_markup') or {}).get('inline_keyboard', [])
+	return [button['callback_data'] for row in keyboard for button in row if marker in button.get('callback_data', '')]
+
+
+def _starts(text: str) -> Callable:
+	return lambda message: message['text'].startswith(text)
+
+
+def _contains(*texts) -> Callable:
+	return lambda message: any(text in message['text'] for text in texts)
+
+
+class SimulatedUser:
+	"""
+	User answering the prompts of the bot after a reaction delay and an optional random think time
+	"""
+
+	def __init__(self, telegram: FakeTelegram, chat_id: int, options: argparse.Namespace):
+		self.__telegram = telegram
+		self.__chat_id = chat_id
+		self.__options = options
+		self.__steps = []
+
+	def register(self) -> None:
+		"""
+		The function sends the start command, so the user is saved in the database of the bot
+		:return: None
+		"""
+		self.__say('start', '/start', lambda message: True)
+
+	def converse(self, command: str, city: str) -> dict:
+		"""
+		The function runs one conversation from the command to the final answer
+		:param command: search command without the slash
+		:param city: city of the search
+		:return: result with the keys command, outcome, duration, steps and the failed step if any
+		"""
+		self.__steps = []
+		start = time.monotonic()
+		result = {'command': command, 'outcome': 'answer'}
+		try:
+			self.__say('command', f'/{command}', _starts('Введите город'))
+			message = self.__say('city', city, lambda message: bool(_buttons(message, '***')))
+			message = self.__press('district', message, _buttons(message, '***')[0], _starts('Выберите дату заезда'))
+			message = self.__pick_date('date_from', message, 0, _starts('Выберите дату отъезда'))
+			if command == 'bestdeal':
+				self.__pick_date('date_to', message, 1, _starts('Введите минимальную стоимость'))
+				self.__say('min_cost', str(self.__options.min_cost), _starts('Введите максимальную стоимость'))
+				self.__say('max_cost', str(self.__options.max_cost), _starts('Введите минимальную удаленность'))
+				self.__say('min_dist', '0', _starts('Введите максимальную удаленность'))
+				message = self.__say('max_dist', str(self.__options.max_dist), _contains(COUNT_TEXT, NOT_FOUND_TEXT))
+			else:
+				message = self.__pick_date('date_to', message, 1, _contains(COUNT_TEXT, NOT_FOUND_TEXT))
+			if NOT_FOUND_TEXT in message['text']:
+				result['outcome'] = 'not_found'
+				self.__wait('final', _starts(FINAL_TEXT))
+			else:
+				q_hotels = min(self.__options.hotels, int(re.findall(r'\d+', message['text'])[-1]))
+				message = self.__say('q_hotels', str(q_hotels), _starts('Загрузить фото?'))
+				if self.__options.photos:
+					self.__press('photo', message, 'да', _starts('Сколько фотографий'))
+					self.__say('answer', str(self.__options.photos), _starts(FINAL_TEXT))
+				else:
+					self.__press('answer', message, 'нет', _starts(FINAL_TEXT))
+		except ConversationError as ex:
+			result.update(outcome='failed', failed_step=ex.step)
+		result.update(duration=time.monotonic() - start, steps=self.__steps)
+		return result
+
+	def __pick_date(self, step: str, message: dict, day_index: int, predicate: Callable) -> dict:
+		"""
+		The function selects the year, the month and the day in the calendar of the bot
+		:param step: name of the step
+		:param message: message of the bot with the calendar
+		:param day_index: index of the day among the selectable days
+		:param predicate: condition of the message the bot answers with when the day is selected
+		:return: answer of the bot
+		"""
+		while True:
+			buttons = _buttons(message, '_s_')
+			if not buttons:
+				raise ConversationError(step)
+			if '_s_d_' in buttons[0]:
+				return self.__press(step, message, buttons[min(day_index, len(buttons) - 1)], predicate)
+			message = self.__press(step, message, buttons[0], lambda answer: bool(_buttons(answer, '_s_')))
+
+	def __say(self, step: str, text: str, predicate: Callable) -> dict:
+		self.__think()
+		start = time.monotonic()
+		self.__telegram.send_text(self.__chat_id, text)
+		return self.__measure(step, start, predicate)
+
+	def __press(self, step: str, message: dict, data: str, predicate: Callable) -> dict:
+		self.__think()
+		start = time.monotonic()
+		self.__telegram.press_button(self.__chat_id, message['message_id'], data)
+		return self.__measure(step, start, predicate)
+
+	def __wait(self, step: str, predicate: Callable) -> dict:
+		return self.__measure(step, time.monotonic(), predicate)
+
+	def __measure(self, step: str, start: float, predicate: Callable) -> dict:
+		"""
+		The function waits for the answer of the bot and records the latency of the step
+		:param step: name of the step
+		:param start: monotonic time of the action of the user
+		:param predicate: condition of the awaited message
+		:return: answer of the bot
+		"""
+		message = self.__telegram.wait_message(self.__chat_id, predicate, self.__options.timeout)
+		if message is None:
+			raise ConversationError(step)
+		self.__steps.append((step, message['time'] - start))
+		return message
+
+	def __think(self) -> None:
+		think = random.expovariate(1 / self.__options.think) if self.__options.think else 0
+		time.sleep(self.__options.reaction + think)
+
+
+def percentile(values: list, rank: float) -> float:
+	"""
+	The function returns the percentile of the values by the nearest rank method
+	:param values: sorted list of values
+	:param rank: percentile from 0 to 100
+	:return: value of the percentile
+	"""
+	return values[max(0, math.ceil(len(values) * rank / 100) - 1)] if values else float('nan')
+
+
+def summarize(values: list) -> dict:
+	"""
+	The function returns the count and the latency percentiles in seconds
+	:param values: list of latencies
+	:return: dictionary of statistics
+	"""
+	values = sorted(values)
+	return {'count': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95),
+			'p99': percentile(values, 99), 'max': values[-1] if values else float('nan')}
+
+
+def build_report(results: list, elapsed: float, hotels: mock_hotels.MockHotelsApi, telegram: FakeTelegram) -> dict:
+	"""
+	The function aggregates the results of the conversations
+	:param results: results of SimulatedUser.converse
+	:param elapsed: duration of the test in seconds
+	:param hotels: mock hotels api
+	:param telegram: fake Telegram Bot API
+	:return: report
+	"""
+	outcomes = defaultdict(int)
+	durations = defaultdict(list)
+	steps = defaultdict(list)
+	for result in results:
+		outcomes[result['outcome'] if result['outcome'] != 'failed' else f'failed at {result["failed_step"]}'] += 1
+		if result['outcome'] != 'failed':
+			durations[result['command']].append(result['duration'])
+			durations['all'].append(result['duration'])
+		for step, seconds in result['steps']:
+			steps[step].append(seconds)
+	completed = len(durations.get('all', []))
+	polls = sum(count for (method, status), count in telegram.requests.items() if method == 'getUpdates')
+	return {'elapsed': elapsed, 'conversations': len(results), 'outcomes': dict(outcomes),
+			'throughput': completed / elapsed if elapsed else 0.0,
+			'conversation_latency': {command: summarize(values) for command, values in durations.items()},
+			'step_latency': {step: summarize(values) for step, values in steps.items()},
+			'hotels_api_requests': {f'{endpoint} {status}': count
+									for (endpoint, status), count in sorted(hotels.requests.items())},
+			'telegram_requests': {f'{method} {status}': count
+								  for (method, status), count in sorted(telegram.requests.items())},
+			'telegram_polling': {'get_updates': polls, 'per_second': polls / elapsed if elapsed else 0.0,
+								 'without_timeout': telegram.short_polls}}
+
+
+def print_report(report: dict) -> None:
+	"""
+	The function prints the report
+	:param report: report of build_report
+	:return: None
+	"""
+	print(f'{report["conversations"]} conversations in {report["elapsed"]:.1f} s, '
+		  f'throughput {report["throughput"]:.2f} conversations/s')
+	print('outcomes: ' + ', '.join(f'{outcome} {count}' for outcome, count in sorted(report['outcomes'].items())))
+	for title, key in (('conversation', 'conversation_latency'), ('step', 'step_latency')):
+		for name, stats in report[key].items():
+			print(f'{title:12} {name:10} n={stats["count"]:<5} '
+				  + ' '.join(f'{key}={stats[key] * 1000:8.1f} ms' for key in ('p50', 'p95', 'p99', 'max')))
+	for title, key in (('hotels api', 'hotels_api_requests'), ('telegram', 'telegram_requests')):
+		print(f'{title}: ' + ', '.join(f'{name} x{count}' for name, count in report[key].items()))
+	polling = report['telegram_polling']
+	print(f'polling: getUpdates x{polling["get_updates"]} ({polling["per_second"]:.1f}/s), '
+		  f'{polling["without_timeout"]} without the timeout of long polling')
+
+
+def start_bot(options: argparse.Namespace, hotels: mock_hotels.MockHotelsApi, telegram: FakeTelegram,
+			  directory: str) -> subprocess.Popen:
+	"""
+	The function starts the bot in a separate process pointed at the mock servers with an empty database
+	:param options: parsed options
+	:param hotels: mock hotels api
+	:param telegram: fake Telegram Bot API
+	:param directory: working directory of the bot for the database and the logs
+	:return: process of the bot
+	"""
+	env = dict(os.environ, BOT_TOKEN='1:loadtest', url_api=hotels.url, TELEGRAM_API_URL=telegram.url,
+			   DB_PATH=os.path.join(directory, 'users.db'), BOT_RUNTIME=options.runtime, BOT_MODE='polling')
+	env.update(item.split('=', 1) for item in options.env)
+	output = open(os.path.join(directory, 'bot.out'), 'w')
+	return subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], cwd=directory, env=env,
+							stdout=output, stderr=subprocess.STDOUT)
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--users', type=int, default=20, help='number of simultaneous users')
+	parser.add_argument('--rounds', type=int, default=3, help='conversations of every user')
+	parser.add_argument('--commands', default='lowprice,bestdeal', help='commands run by the users in turn')
+	parser.add_argument('--cities', default='London,Paris,Rome,Berlin,Madrid,Prague,Vienna,Lisbon')
+	parser.add_argument('--hotels', type=int, default=5, help='number of hotels requested by the users')
+	parser.add_argument('--photos', type=int, default=2, help='photos of every hotel, 0 to answer no')
+	parser.add_argument('--min-cost', type=int, default=50)
+	parser.add_argument('--max-cost', type=int, default=400)
+	parser.add_argument('--max-dist', type=int, default=8)
+	parser.add_argument('--reaction', type=float, default=0.1,
+						help='delay of every answer of the users in seconds, the bot registers the next step '
+							 'after its message is delivered, so users answering instantly race with it')
+	parser.add_argument('--think', type=float, default=0.0, help='mean random think time of the users in seconds')
+	parser.add_argument('--ramp', type=float, default=1.0, help='seconds over which the users arrive')
+	parser.add_argument('--timeout', type=float, default=60.0, help='timeout of every answer of the bot')
+	parser.add_argument('--runtime', choices=('sync', 'async'), default='sync')
+	parser.add_argument('--env', action='append', default=[], help='KEY=VALUE passed to the bot')
+	parser.add_argument('--external', action='store_true',
+						help='do not start the bot, print its environment and wait for it to poll')
+	parser.add_argument('--telegram-latency', type=float, default=0.03)
+	parser.add_argument('--telegram-throttle-rate', type=float, default=0.0, help='share of sends with error 429')
+	parser.add_argument('--json', help='path of the report in json')
+	mock_hotels.add_arguments(parser)
+	options = parser.parse_args()
+
+	hotels = mock_hotels.from_arguments(options, 0).start()
+	telegram = FakeTelegram(port=0, latency=options.telegram_latency,
+							throttle_rate=options.telegram_throttle_rate).start()
+	directory = tempfile.mkdtemp(prefix='loadtest-')
+	bot = None
+	if options.external:
+		print(f'url_api={hotels.url} TELEGRAM_API_URL={telegram.url} BOT_TOKEN=1:loadtest')
+	else:
+		bot = start_bot(options, hotels, telegram, directory)
+	try:
+		if not telegram.wait_polling(60 if bot else 600):
+			sys.exit(f'The bot does not poll the updates, see {directory}')
+		commands = options.commands.split(',')
+		cities = options.cities.split(',')
+		results = []
+
+		def simulate(number: int) -> None:
+			time.sleep(options.ramp * number / options.users)
+			user = SimulatedUser(telegram, 10 ** 6 + number, options)
+			try:
+				user.register()
+			except ConversationError:
+				results.append({'command': 'start', 'outcome': 'failed', 'failed_step': 'start', 'steps': []})
+				return
+			for round_number in range(options.rounds):
+				results.append(user.converse(commands[(number + round_number) % len(commands)], random.choice(cities)))
+
+		start = time.monotonic()
+		threads = [threading.Thread(target=simulate, args=(number,), daemon=True) for number in range(options.users)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		report = build_report(results, time.monotonic() - start, hotels, telegram)
+	finally:
+		if bot is not None:
+			bot.terminate()
+			try:
+				bot.wait(10)
+			except subprocess.TimeoutExpired:
+				bot.kill()
+		hotels.stop()
+		telegram.stop()
+	print_report(report)
+	print(f'logs of the bot: {directory}')
+	if options.json:
+		with open(options.json, 'w') as file:
+			json.dump(report, file, indent=2)
+	if report['telegram_polling']['without_timeout']:
+		sys.exit('The bot polls getUpdates without the timeout of long polling')
+
+
+if __name__ == '__main__':
+	main()
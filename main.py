@@ -1,21 +1,30 @@
 import datetime
-import json
 import logging
 import os
-import time
 import telebot
-from typing import Any
+from concurrent.futures import Future
+from typing import Any, Optional
 from dotenv import load_dotenv
-from telebot.types import Message, CallbackQuery, InlineKeyboardMarkup
-from telegram_bot_calendar import DetailedTelegramCalendar, LSTEP
-from db import add_new_user, get_id_user, create_new_request, get_history, update_history_destination, get_id_request, \
-	get_data_history, add_date_from_to_request, add_date_to_to_request, update_q_days, add_response_to_history, \
-	add_q_hotels
+from telebot.types import Message, CallbackQuery
+from telegram_bot_calendar import LSTEP
+from conversation import conversations
+from prefetch import prefetcher
+from date_calendar import STAGE_DATE_FROM, STAGE_DATE_TO, build_calendar, is_calendar_callback, process_calendar
+from dialog import Dialog, dialog_states
+from db import add_new_user, get_id_user, get_history, get_hotel_results
+from sender import outbox, PRIORITY_HIGH, PRIORITY_LOW
+from metrics import HANDLER_SECONDS, timed, tracer, start_exporter
+from keyboards import get_keyboard_district, get_keyboard_photo, get_keyboard_history
 from func import get_start, get_help, get_another_message, get_properties, get_district, get_photo_hotel, form_message
+from func import MESSAGE_MODE, pack_messages, pack_albums, form_history_pages, get_bestdeal
+from func import form_progress, iter_photo_hotel
 
 logger = logging.getLogger('bot_logger')
 load_dotenv()
 bot = telebot.TeleBot(os.getenv('BOT_TOKEN'), parse_mode='HTML')
+if os.getenv('TELEGRAM_API_URL'):
+	telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL') + 'bot{0}/{1}'
+dialog = Dialog(dialog_states)
 
 
 @bot.message_handler(commands=['start'])
@@ -27,7 +36,7 @@ def start_message(message: Message) -> None:
 	"""
 	add_new_user(message)
 	id_user = get_id_user(message)
-	bot.send_message(id_user, get_start())
+	outbox.submit(id_user, bot.send_message, id_user, get_start())
 
 
 @bot.message_handler(commands=['help'])
@@ -38,10 +47,11 @@ def help_message(message: Message) -> None:
 	:return: None
 	"""
 	id_user = get_id_user(message)
-	bot.send_message(id_user, get_help())
+	outbox.submit(id_user, bot.send_message, id_user, get_help())
 
 
 @bot.message_handler(commands=['lowprice', 'highprice', 'bestdeal'])
+@timed(HANDLER_SECONDS)
 def action_message(message: Message) -> None:
 	"""
 	The function executes the bot command lowprice or highprice or bestdeal and sends a request to the search city
@@ -49,9 +59,10 @@ def action_message(message: Message) -> None:
 	:return: None
 	"""
 	id_user = get_id_user(message)
-	create_new_request(message, id_user)
-	bot.send_message(id_user, 'Введите город поиска на английском языке:')
-	bot.register_next_step_handler(message, get_id_hotels)
+	prefetcher.cancel(id_user)
+	tracer.start(id_user, conversations.start(message, id_user).command)
+	outbox.submit(id_user, bot.send_message, id_user, 'Введите город поиска на английском языке:')
+	dialog.next(message.chat.id, get_id_hotels)
 
 
 @bot.message_handler(commands=['history'])
@@ -65,31 +76,47 @@ def history_message(message: Message) -> None:
 	id_user = get_id_user(message)
 	list_history = get_history(message)
 	if len(list_history) == 0:
-		bot.send_message(message.chat.id, 'Пока пусто')
+		outbox.submit(message.chat.id, bot.send_message, message.chat.id, 'Пока пусто')
+	elif MESSAGE_MODE == 'compact':
+		pages = form_history_pages(list_history)
+		outbox.submit(id_user, bot.send_message, id_user, pages[0], disable_web_page_preview=True,
+					  reply_markup=get_keyboard_history(0, len(pages)), priority=PRIORITY_LOW)
 	else:
 		for elem in list_history:
 			text = ''
 			text += f"<b>дата запроса - {elem[0]}</b> "
 			text += f"<b>команда - {elem[1]}</b> "
 			text += f"<b>город - {elem[2]}</b> "
-			bot.send_message(id_user, text)
-			try:
-				json.loads(elem[3])
-				for hotel in json.loads(elem[3]):
-					text = ''
-					text += f"<b>отель - {hotel['name']}</b>\n"
-					text += f"<b>стоимость - {hotel['current']}</b>\n"
-					text += f"<b>ссылка - {hotel['url']}</b>\n"
-					bot.send_message(id_user, text, disable_web_page_preview=True)
-					time.sleep(0.2)
-			except:
+			outbox.submit(id_user, bot.send_message, id_user, text, priority=PRIORITY_LOW)
+			list_hotels = get_hotel_results(elem[3], ('name', 'current', 'url'))
+			for hotel in list_hotels:
+				text = ''
+				text += f"<b>отель - {hotel['name']}</b>\n"
+				text += f"<b>стоимость - {hotel['current']}</b>\n"
+				text += f"<b>ссылка - {hotel['url']}</b>\n"
+				outbox.submit(id_user, bot.send_message, id_user, text, disable_web_page_preview=True,
+							  priority=PRIORITY_LOW)
+			if not list_hotels:
 				logger.error(f'No history')
 				text = 'Ничего не нашлось'
-				bot.send_message(id_user, text)
-			time.sleep(0.5)
+				outbox.submit(id_user, bot.send_message, id_user, text, priority=PRIORITY_LOW)
 	logger.info(f'End history query')
-	bot.send_message(id_user, 'Чем я еще могу вам помочь?')
-	bot.send_message(id_user, get_help())
+	outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?', priority=PRIORITY_LOW)
+	outbox.submit(id_user, bot.send_message, id_user, get_help(), priority=PRIORITY_LOW)
+
+
+@bot.message_handler(func=lambda message: dialog.active(message.chat.id), content_types=['text'])
+def dialog_message(message: Message) -> None:
+	"""
+	The function passes the answer of the user to the step of the search dialog the chat is at
+	:param message: object of type Message of class telebot
+	:return: None
+	"""
+	step = dialog.pop(message.chat.id)
+	if step:
+		func, args = step
+		conversations.resume(message.from_user.id)
+		func(message, *args)
 
 
 @bot.message_handler(content_types=['text'])
@@ -100,10 +127,28 @@ def another_message(message: Message) -> None:
 	:return: None
 	"""
 	id_user = get_id_user(message)
-	bot.send_message(id_user, get_another_message())
+	outbox.submit(id_user, bot.send_message, id_user, get_another_message())
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('history:'))
+def history_page(call: CallbackQuery) -> None:
+	"""
+	The function turns the page of the query history sent in compact mode
+	:param call: object of type CallbackQuery of class telebot, call.data contains the number of the page
+	:return: None
+	"""
+	id_user = call.from_user.id
+	page = int(call.data.split(':')[1])
+	pages = form_history_pages(get_history(call))
+	if 0 <= page < len(pages):
+		outbox.submit(id_user, bot.edit_message_text, pages[page], id_user, call.message.message_id,
+					  disable_web_page_preview=True, reply_markup=get_keyboard_history(page, len(pages)),
+					  priority=PRIORITY_HIGH)
+	bot.answer_callback_query(call.id)
 
 
 @bot.callback_query_handler(func=lambda call: True)
+@timed(HANDLER_SECONDS)
 def callback_query(call: CallbackQuery) -> None:
 	"""
 	The object handler function for incoming callback requests from built-in keyboard callback buttons
@@ -112,72 +157,62 @@ def callback_query(call: CallbackQuery) -> None:
 	"""
 	id_user = call.from_user.id
 	if '***' in call.data:
+		conversations.resume(id_user)
 		id_destination = int(call.data.split('***')[0])
 		name_destination = call.data.split('***')[1]
-		update_history_destination(id_destination, name_destination, id_user)
-		calendar, step = DetailedTelegramCalendar(min_date=datetime.date.today(), locale='ru').build()
-		bot.edit_message_text(f"Выберите дату заезда: {LSTEP[step]}",
-							  id_user,
-							  call.message.message_id,
-							  reply_markup=calendar)
+		conversations.update(id_user, id_destination=id_destination, name_destination=name_destination)
+		tracer.event(id_user, 'district')
+		calendar, step = build_calendar(STAGE_DATE_FROM, datetime.date.today())
+		outbox.submit(id_user, bot.edit_message_text, f"Выберите дату заезда: {LSTEP[step]}",
+					  id_user,
+					  call.message.message_id,
+					  reply_markup=calendar)
 	elif 'да' in call.data or 'нет' in call.data:
 		if 'да' in call.data:
-			msg = bot.edit_message_text('Сколько фотографий для каждого отеля необходимо вывести (не более 5)',
-										id_user, call.message.message_id)
-			bot.register_next_step_handler(msg, get_photo, id_user)
+			outbox.submit(id_user, bot.edit_message_text,
+						  'Сколько фотографий для каждого отеля необходимо вывести (не более 5)',
+						  id_user, call.message.message_id)
+			dialog.next(call.message.chat.id, get_photo, id_user)
 		else:
-			list_links_photo = []
-			get_answer(id_user, list_links_photo, None)
-	else:
-		id_request = get_id_request(id_user)
-		date_from, date_to, command, id_destination, name_destination = get_data_history(id_request)[:5]
-		min_date = datetime.date.today() if not date_from else datetime.datetime.strptime(date_from, "%Y-%m-%d").date()
-		max_date = None if not date_from else (
-				datetime.datetime.strptime(date_from, "%Y-%m-%d") + datetime.timedelta(days=28)).date()
-		result, calendar, step = DetailedTelegramCalendar(min_date=min_date, max_date=max_date, locale='ru').process(
-			call.data)
-
-		if not result and calendar:
-			bot.edit_message_text(f"{LSTEP[step]}",
-								  id_user, call.message.message_id, reply_markup=calendar)
-		elif result:
-			if not date_from:
-				add_date_from_to_request(id_request, result)
-				calendar, step = DetailedTelegramCalendar(min_date=datetime.datetime.now().date(), locale='ru').build()
-				bot.edit_message_text(f"Выберите дату отъезда: {LSTEP[step]}",
-									  id_user,
-									  call.message.message_id,
-									  reply_markup=calendar)
-			elif not date_to:
-				date_to = result
-				date_from = datetime.datetime.strptime(date_from, "%Y-%m-%d").date()
-				add_date_to_to_request(id_request, result)
-				if date_from != date_to:
-					q_days = (date_to - date_from).days
-					update_q_days(q_days, id_request)
-				if command == '/bestdeal':
-					msg = bot.send_message(call.message.chat.id, 'Введите минимальную стоимость отеля в сутки в $')
-					bot.register_next_step_handler(msg, get_min_cost, id_user)
-				else:
-					bot.send_message(call.message.chat.id, 'Подождите, пожалуйста, запрашиваю для вас информацию...')
-					get_count_hotel(id_user)
-
-
-def get_keyboard_district(list_names_districts: list) -> InlineKeyboardMarkup:
-	"""
-	The function returns an inline keyboard to specify the area of the city
-	:param list_names_districts: list of districts for the requested city
-	:return: inline keyboard to specify the area of the city
-	"""
-	keyboard = telebot.types.InlineKeyboardMarkup()
-	for name_district in list_names_districts:
-		keyboard.row_width = 1
-		keyboard.add(telebot.types.InlineKeyboardButton(name_district.name,
-														callback_data='***'.join(
-															[name_district.id_destination, name_district.name[:20]])))
-	return keyboard
-
-
+			conversations.resume(id_user)
+			prefetcher.cancel(id_user)
+			get_answer(id_user, 0, None)
+	elif is_calendar_callback(call.data):
+		answer = process_calendar(call.data)
+		if answer.keyboard:
+			outbox.submit(id_user, bot.edit_message_text, f"{LSTEP[answer.step]}",
+						  id_user, call.message.message_id, reply_markup=answer.keyboard)
+		elif answer.stage == STAGE_DATE_FROM and answer.result:
+			conversations.resume(id_user)
+			conversations.update(id_user, date_from=str(answer.result))
+			tracer.event(id_user, 'date_from')
+			calendar, step = build_calendar(STAGE_DATE_TO, answer.result, answer.result + datetime.timedelta(days=28))
+			outbox.submit(id_user, bot.edit_message_text, f"Выберите дату отъезда: {LSTEP[step]}",
+						  id_user,
+						  call.message.message_id,
+						  reply_markup=calendar)
+		elif answer.stage == STAGE_DATE_TO and answer.result:
+			conversation = conversations.resume(id_user)
+			if conversation.date_to:
+				return
+			date_from, date_to = answer.min_date, answer.result
+			conversations.update(id_user, date_from=str(date_from), date_to=str(date_to))
+			if date_from != date_to:
+				q_days = (date_to - date_from).days
+				conversations.update(id_user, q_days=q_days)
+			conversations.flush()
+			tracer.event(id_user, 'date_to')
+			if conversation.command == '/bestdeal':
+				outbox.submit(call.message.chat.id, bot.send_message, call.message.chat.id,
+							  'Введите минимальную стоимость отеля в сутки в $')
+				dialog.next(call.message.chat.id, get_min_cost, id_user)
+			else:
+				outbox.submit(call.message.chat.id, bot.send_message, call.message.chat.id,
+							  'Подождите, пожалуйста, запрашиваю для вас информацию...')
+				get_count_hotel(id_user)
+
+
+@dialog.step
 def get_id_hotels(message: Message) -> None:
 	"""
 	The function sends an inline keyboard to specify the area of the city, if a response is received
@@ -186,17 +221,19 @@ def get_id_hotels(message: Message) -> None:
 					message.text contains the city sent to the bot
 	:return: None
 	"""
-	msg = bot.send_message(message.chat.id, 'Подождите, пожалуйста, запрашиваю для вас информацию...')
+	msg = outbox.submit(message.chat.id, bot.send_message, message.chat.id,
+						'Подождите, пожалуйста, запрашиваю для вас информацию...')
 	list_class_cities = get_district(message.text)
+	tracer.event(message.from_user.id, 'city')
 	if len(list_class_cities) > 0:
-		bot.edit_message_text('Уточните, пожалуйста, район:', chat_id=message.chat.id, message_id=msg.message_id,
-							  reply_markup=get_keyboard_district(list_class_cities))
+		outbox.submit(message.chat.id, edit_sent_message, msg, 'Уточните, пожалуйста, район:',
+					  reply_markup=get_keyboard_district(list_class_cities))
 	else:
-		bot.edit_message_text('Такого города нет!\nПопробуйте еще раз:', chat_id=message.chat.id,
-							  message_id=msg.message_id)
-		bot.register_next_step_handler(message, get_id_hotels)
+		outbox.submit(message.chat.id, edit_sent_message, msg, 'Такого города нет!\nПопробуйте еще раз:')
+		dialog.next(message.chat.id, get_id_hotels)
 
 
+@dialog.step
 def get_min_cost(message: Message, id_user: int):
 	"""
 	The function asks the client for the minimum desired cost of the hotel and checks the user's response
@@ -208,15 +245,17 @@ def get_min_cost(message: Message, id_user: int):
 	min_cost = message.text
 	try:
 		float(min_cost)
-		msg = bot.send_message(id_user, 'Введите максимальную стоимость отеля в сутки в $')
-		bot.register_next_step_handler(msg, get_max_cost, id_user, min_cost)
+		outbox.submit(id_user, bot.send_message, id_user, 'Введите максимальную стоимость отеля в сутки в $')
+		dialog.next(id_user, get_max_cost, id_user, min_cost)
 	except ValueError as ex:
 		logger.error(f'Ошибка неверный тип данных минимальная стоимость отеля в сутки в $', exc_info=ex)
-		msg = bot.send_message(id_user, f'Вы ввели неправильное число, попробуйте еще раз.\n'
-										f'Введите минимальную стоимость отеля в сутки')
-		bot.register_next_step_handler(msg, get_min_cost, id_user)
+		outbox.submit(id_user, bot.send_message, id_user,
+					  f'Вы ввели неправильное число, попробуйте еще раз.\n'
+					  f'Введите минимальную стоимость отеля в сутки')
+		dialog.next(id_user, get_min_cost, id_user)
 
 
+@dialog.step
 def get_max_cost(message: Message, id_user: int, min_cost: int):
 	"""
 	The function asks the client for the maximum desired cost of the hotel and checks the user's response
@@ -229,15 +268,20 @@ def get_max_cost(message: Message, id_user: int, min_cost: int):
 	max_cost = message.text
 	try:
 		float(max_cost)
-		msg = bot.send_message(id_user, 'Введите минимальную удаленность отеля от центра в милях')
-		bot.register_next_step_handler(msg, get_min_dist, id_user, min_cost, max_cost)
+		conversation = conversations.get(id_user)
+		prefetcher.properties(id_user, conversation.id_destination, conversation.date_from, conversation.date_to,
+							  'PRICE', min_cost, max_cost)
+		outbox.submit(id_user, bot.send_message, id_user, 'Введите минимальную удаленность отеля от центра в милях')
+		dialog.next(id_user, get_min_dist, id_user, min_cost, max_cost)
 	except ValueError as ex:
 		logger.error(f'Ошибка неверный тип данных максимальная стоимость отеля в сутки в $', exc_info=ex)
-		msg = bot.send_message(id_user, f'Вы ввели неправильное число, попробуйте еще раз.\n'
-										f'Введите максимальную стоимость отеля в сутки')
-		bot.register_next_step_handler(msg, get_max_cost, id_user, min_cost)
+		outbox.submit(id_user, bot.send_message, id_user,
+					  f'Вы ввели неправильное число, попробуйте еще раз.\n'
+					  f'Введите максимальную стоимость отеля в сутки')
+		dialog.next(id_user, get_max_cost, id_user, min_cost)
 
 
+@dialog.step
 def get_min_dist(message: Message, id_user: int, min_cost: int, max_cost: int):
 	"""
 	The function asks the client for the minimum desired distance of the hotel from the center
@@ -252,15 +296,17 @@ def get_min_dist(message: Message, id_user: int, min_cost: int, max_cost: int):
 	min_dist = message.text
 	try:
 		float(min_dist)
-		msg = bot.send_message(id_user, 'Введите максимальную удаленность отеля от центра в милях')
-		bot.register_next_step_handler(msg, get_max_dist, id_user, min_cost, max_cost, min_dist)
+		outbox.submit(id_user, bot.send_message, id_user, 'Введите максимальную удаленность отеля от центра в милях')
+		dialog.next(id_user, get_max_dist, id_user, min_cost, max_cost, min_dist)
 	except ValueError as ex:
 		logger.error(f'Ошибка неверный тип данных минимальная удаленность отеля от центра в милях', exc_info=ex)
-		msg = bot.send_message(id_user, f'Вы ввели неправильное число, попробуйте еще раз.\n'
-										f'Введите минимальную удаленность отеля от центра')
-		bot.register_next_step_handler(msg, get_min_dist, id_user, min_cost, max_cost)
+		outbox.submit(id_user, bot.send_message, id_user,
+					  f'Вы ввели неправильное число, попробуйте еще раз.\n'
+					  f'Введите минимальную удаленность отеля от центра')
+		dialog.next(id_user, get_min_dist, id_user, min_cost, max_cost)
 
 
+@dialog.step
 def get_max_dist(message: Message, id_user: int, min_cost: int, max_cost: int, min_dist: int):
 	"""
 	The function asks the client for the maximum desired distance of the hotel from the center
@@ -276,15 +322,18 @@ def get_max_dist(message: Message, id_user: int, min_cost: int, max_cost: int, m
 	max_dist = message.text
 	try:
 		float(max_dist)
-		bot.send_message(message.chat.id, 'Подождите, пожалуйста, запрашиваю для вас информацию...')
+		outbox.submit(message.chat.id, bot.send_message, message.chat.id,
+					  'Подождите, пожалуйста, запрашиваю для вас информацию...')
 		get_count_hotel(id_user, min_cost, max_cost, min_dist, max_dist)
 	except ValueError as ex:
 		logger.error(f'Ошибка неверный тип данных максимальная удаленность отеля от центра в милях', exc_info=ex)
-		msg = bot.send_message(id_user, f'Вы ввели неправильное число, попробуйте еще раз.\n'
-										f'Введите  максимальную удаленность отеля от центра')
-		bot.register_next_step_handler(msg, get_max_dist, id_user, min_cost, max_cost, min_dist)
+		outbox.submit(id_user, bot.send_message, id_user,
+					  f'Вы ввели неправильное число, попробуйте еще раз.\n'
+					  f'Введите  максимальную удаленность отеля от центра')
+		dialog.next(id_user, get_max_dist, id_user, min_cost, max_cost, min_dist)
 
 
+@timed(HANDLER_SECONDS)
 def get_count_hotel(id_user: int, min_cost: int = None, max_cost: int = None, min_dist: int = None,
 					max_dist: int = None):
 	"""
@@ -297,45 +346,35 @@ def get_count_hotel(id_user: int, min_cost: int = None, max_cost: int = None, mi
 	:param max_dist: desired maximum distance of the hotel from the center
 	:return: None
 	"""
-	id_request = get_id_request(id_user)
-	date_from, date_to, command, id_destination, name_destination = get_data_history(id_request)[:5]
+	conversation = conversations.get(id_user)
+	date_from, date_to, command = conversation.date_from, conversation.date_to, conversation.command
+	id_destination, name_destination = conversation.id_destination, conversation.name_destination
 	order_by = 'PRICE_HIGHEST_FIRST' if command == '/highprice' else 'PRICE'
 	if command == '/bestdeal':
-		tmp_list_hotels = get_properties(id_destination, date_from, date_to, order_by, min_cost, max_cost)
-		list_hotels = list(
-			filter(lambda x: int(min_dist) <= float(x['distance'].split()[0]) <= int(max_dist), tmp_list_hotels))
+		list_hotels = get_bestdeal(id_destination, date_from, date_to, order_by, min_cost, max_cost,
+								   float(min_dist), float(max_dist))
 	else:
 		list_hotels = get_properties(id_destination, date_from, date_to, order_by)
-	response = json.dumps(list_hotels)
-	add_response_to_history(id_user, response)
+	conversations.update(id_user, hotels=list_hotels)
+	conversations.flush()
+	tracer.event(id_user, 'hotels')
 	if len(list_hotels) != 0:
+		prefetcher.photos(id_user, [hotel['id'] for hotel in list_hotels])
 		max_q_hotels = len(list_hotels)
-		msg = bot.send_message(id_user, f"Вы выбрали {name_destination}"
-										f" c {date_from} по {date_to}\n"
-										f"Какое кол-во отелей вывести в диапазоне от 1"
-										f" до {max_q_hotels}?")
-		bot.register_next_step_handler(msg, need_a_photo, max_q_hotels)
+		outbox.submit(id_user, bot.send_message, id_user,
+					  f"Вы выбрали {name_destination}"
+					  f" c {date_from} по {date_to}\n"
+					  f"Какое кол-во отелей вывести в диапазоне от 1"
+					  f" до {max_q_hotels}?")
+		dialog.next(id_user, need_a_photo, max_q_hotels)
 	else:
-		bot.send_message(id_user, f"К сожалению по данному запросу ничего не найдено")
-		response = 'Ничего не нашлось'
-		add_response_to_history(id_user, response)
-		bot.send_message(id_user, 'Чем я еще могу вам помочь?')
-		bot.send_message(id_user, get_help())
-
-
-def get_keyboard_photo():
-	"""
-	The function returns a built-in keyboard with yes or no answer buttons
-	:return: inline keyboard а built-in keyboard with yes or no answer buttons
-	"""
-	keyboard = telebot.types.InlineKeyboardMarkup()
-	keyboard.row_width = 1
-	keyboard.add(telebot.types.InlineKeyboardButton('ДА', callback_data='да'),
-				 telebot.types.InlineKeyboardButton('НЕТ', callback_data='нет'))
-
-	return keyboard
+		tracer.finish(id_user, 'not_found')
+		outbox.submit(id_user, bot.send_message, id_user, f"К сожалению по данному запросу ничего не найдено")
+		outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?')
+		outbox.submit(id_user, bot.send_message, id_user, get_help())
 
 
+@dialog.step
 def need_a_photo(message: Message, max_q_hotels: int) -> None:
 	"""
 	The function checks the possibility of displaying the requested number of hotels
@@ -347,15 +386,18 @@ def need_a_photo(message: Message, max_q_hotels: int) -> None:
 	"""
 	id_user = get_id_user(message)
 	if int(message.text) > max_q_hotels or int(message.text) < 1:
-		msg = bot.send_message(id_user, f'Вы ввели неправильное число, попробуйте еще раз.\n'
-										f'Какое кол-во отелей вывести в диапазоне'
-										f' от 1 до {max_q_hotels}?')
-		bot.register_next_step_handler(msg, need_a_photo, max_q_hotels)
+		outbox.submit(id_user, bot.send_message, id_user,
+					  f'Вы ввели неправильное число, попробуйте еще раз.\n'
+					  f'Какое кол-во отелей вывести в диапазоне'
+					  f' от 1 до {max_q_hotels}?')
+		dialog.next(id_user, need_a_photo, max_q_hotels)
 	else:
-		add_q_hotels(id_user, int(message.text))
-		bot.send_message(id_user, f'Загрузить фото?', reply_markup=get_keyboard_photo())
+		conversations.update(id_user, q_hotels=int(message.text))
+		prefetcher.photos(id_user, [hotel['id'] for hotel in conversations.get(id_user).hotels], int(message.text))
+		outbox.submit(id_user, bot.send_message, id_user, f'Загрузить фото?', reply_markup=get_keyboard_photo())
 
 
+@dialog.step
 def get_photo(message: Message, id_user: int) -> None:
 	"""
 	The function creates a list of links photos for each hotel
@@ -366,45 +408,100 @@ def get_photo(message: Message, id_user: int) -> None:
 	:return: None
 	"""
 	if 0 < int(message.text) <= 5:
-		msg = bot.send_message(id_user, 'Подождите, пожалуйста, запрашиваю для вас информацию...')
-		q_photo = int(message.text)
-		list_links_photo = get_photo_hotel(q_photo, id_user)
-		get_answer(id_user, list_links_photo, msg)
+		msg = outbox.submit(id_user, bot.send_message, id_user,
+							'Подождите, пожалуйста, запрашиваю для вас информацию...')
+		get_answer(id_user, int(message.text), msg)
 	else:
-		msg = bot.send_message(id_user, f'Вы ввели неправильное число, попробуйте еще раз.\n'
-										f'Сколько фотографий для каждого отеля необходимо вывести (не более 5)')
-		bot.register_next_step_handler(msg, get_photo, id_user)
+		outbox.submit(id_user, bot.send_message, id_user,
+					  f'Вы ввели неправильное число, попробуйте еще раз.\n'
+					  f'Сколько фотографий для каждого отеля необходимо вывести (не более 5)')
+		dialog.next(id_user, get_photo, id_user)
 
 
-def get_answer(id_user: int, list_links_photo: list, msg: Any) -> None:
+@timed(HANDLER_SECONDS)
+def get_answer(id_user: int, q_photo: int, msg: Optional[Future]) -> None:
 	"""
-	The function sends the generated response to the request to the user
+	The function sends the header of the response first and then each hotel with its photos
+	as soon as the photos of the hotel are received, the header shows how many hotels have been sent
 	:param id_user: unique user number
-	:param list_links_photo: list of links to photo for each hotel
-	:param msg:
-	:return:
+	:param q_photo: number of photos for each hotel, 0 without photos
+	:param msg: future of the message to be replaced by the header of the response or None
+	:return: None
 	"""
 	answer = form_message(id_user)
+	if MESSAGE_MODE == 'compact':
+		list_links_photo = get_photo_hotel(q_photo, id_user) if q_photo else []
+		tracer.finish(id_user, 'answer')
+		send_compact_answer(id_user, answer, list_links_photo, msg)
+		return
+	header, list_hotels = answer[0], answer[1:]
 	if msg:
-		bot.edit_message_text(answer[0], chat_id=msg.chat.id, message_id=msg.message_id)
+		header_sent = outbox.submit(id_user, edit_sent_message, msg, form_progress(header, 0, len(list_hotels)))
 	else:
-		bot.send_message(id_user, answer[0])
-	for i, hotel in enumerate(answer[1:]):
-		bot.send_message(id_user, hotel, disable_web_page_preview=True)
-		media_group = []
-		if list_links_photo:
-			try:
-				for link in list_links_photo[i]:
-					if link != 'нет данных':
-						media_group.append(telebot.types.InputMediaPhoto(media=link))
-				bot.send_media_group(id_user, media=media_group)
-			except:
+		header_sent = outbox.submit(id_user, bot.send_message, id_user, form_progress(header, 0, len(list_hotels)))
+	progress = None
+	for i, (hotel, links_photo) in enumerate(zip(list_hotels, iter_photo_hotel(q_photo, id_user)), 1):
+		if i == 1:
+			tracer.event(id_user, 'first_hotel')
+		outbox.submit(id_user, bot.send_message, id_user, hotel, disable_web_page_preview=True)
+		if links_photo is not None:
+			if links_photo:
+				media_group = [telebot.types.InputMediaPhoto(media=link) for link in links_photo]
+				outbox.submit(id_user, bot.send_media_group, id_user, media=media_group)
+			else:
 				logger.error(f'No photo')
-				bot.send_message(id_user, 'нет фото')
-		time.sleep(0.5)
+				outbox.submit(id_user, bot.send_message, id_user, 'нет фото')
+		if i < len(list_hotels) and (progress is None or progress.done()):
+			progress = outbox.submit(id_user, edit_sent_message, header_sent,
+									 form_progress(header, i, len(list_hotels)))
+	outbox.submit(id_user, edit_sent_message, header_sent, header)
+	tracer.finish(id_user, 'answer')
+	logger.info(f'End request')
+	outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?')
+	outbox.submit(id_user, bot.send_message, id_user, get_help())
+
+
+def edit_sent_message(message_sent: Future, text: str, **kwargs) -> Any:
+	"""
+	The function replaces the text of a message after the message has been sent by the outbox,
+	it is itself submitted to the outbox after the message, so the message is sent by then
+	:param message_sent: future of the message
+	:param text: new text of the message
+	:param kwargs: keyword arguments of bot.edit_message_text
+	:return: edited message
+	"""
+	message = message_sent.result()
+	return bot.edit_message_text(text, message.chat.id, message.message_id, **kwargs)
+
+
+def send_compact_answer(id_user: int, answer: list, list_links_photo: list, msg: Optional[Future]) -> None:
+	"""
+	The function sends the response packed into as few messages and albums as the limits of Telegram allow
+	:param id_user: unique user number
+	:param answer: header and description of each hotel
+	:param list_links_photo: list of links to photo for each hotel
+	:param msg: future of the message to be replaced by the first part of the response or None
+	:return: None
+	"""
+	messages = pack_messages(answer)
+	if msg:
+		outbox.submit(id_user, edit_sent_message, msg, messages[0], disable_web_page_preview=True)
+	else:
+		outbox.submit(id_user, bot.send_message, id_user, messages[0], disable_web_page_preview=True)
+	for text in messages[1:]:
+		outbox.submit(id_user, bot.send_message, id_user, text, disable_web_page_preview=True)
+	if list_links_photo:
+		captions = [hotel.split('\n', 1)[0] for hotel in answer[1:]]
+		for album in pack_albums(list_links_photo, captions):
+			if len(album) == 1:
+				outbox.submit(id_user, bot.send_photo, id_user, album[0][0], caption=album[0][1])
+			else:
+				outbox.submit(id_user, bot.send_media_group, id_user,
+							  media=[telebot.types.InputMediaPhoto(media=link, caption=caption)
+									 for link, caption in album])
 	logger.info(f'End request')
-	bot.send_message(id_user, 'Чем я еще могу вам помочь?')
-	bot.send_message(id_user, get_help())
+	outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?')
+	outbox.submit(id_user, bot.send_message, id_user, get_help())
 
 
 if __name__ == '__main__':
@@ -412,4 +509,19 @@ if __name__ == '__main__':
 						format='%(asctime)s - %(levelname)s - %(message)s',
 						datefmt='%d-%b-%y %H:%M:%S')
 	logger.info(f'Start bot "Choosing_hotels_bot"')
-	bot.polling(none_stop=True)
+	start_exporter()
+	if os.getenv('BOT_RUNTIME', 'sync') == 'async':
+		import asyncio
+		from main_async import run
+
+		asyncio.run(run())
+	elif int(os.getenv('BOT_WORKERS', 1)) > 1:
+		from supervisor import run_supervisor
+
+		run_supervisor(bot)
+	elif os.getenv('BOT_MODE', 'polling') == 'webhook':
+		from webhook import run_webhook
+
+		run_webhook(bot)
+	else:
+		bot.polling(none_stop=True)
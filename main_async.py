@@ -0,0 +1,581 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+from typing import Any, Optional
+
+import telebot
+from dotenv import load_dotenv
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message, CallbackQuery, Update
+from telegram_bot_calendar import LSTEP
+
+from api_async import async_hotels_api
+from conversation import conversations
+from date_calendar import STAGE_DATE_FROM, STAGE_DATE_TO, build_calendar, is_calendar_callback, process_calendar
+from dialog import Dialog, dialog_states
+from db import add_new_user, get_id_user, get_history, get_hotel_results
+from func import get_start, get_help, get_another_message, form_message
+from func import MESSAGE_MODE, pack_messages, pack_albums, form_history_pages, form_progress
+from func_async import get_properties, get_district, get_photo_hotel, get_bestdeal, iter_photo_hotel
+from keyboards import get_keyboard_district, get_keyboard_photo, get_keyboard_history
+from metrics import HANDLER_SECONDS, timed, tracer, start_exporter
+from prefetch_async import async_prefetcher
+from sender import PRIORITY_HIGH, PRIORITY_LOW
+from sender_async import async_outbox
+
+logger = logging.getLogger('bot_logger')
+load_dotenv()
+
+LONG_POLLING_TIMEOUT = 20
+OUTBOX_DRAIN_TIMEOUT = 10
+
+
+class LongPollingBot(AsyncTeleBot):
+	"""
+	AsyncTeleBot sending the timeout of long polling with every getUpdates request.
+	asyncio_helper.get_updates of pyTelegramBotAPI 4.4.1 sends only the first of offset, limit, timeout
+	and allowed_updates, so once the offset is known the bot would poll Telegram in a tight loop
+	"""
+
+	async def get_updates(self, offset: Optional[int] = None, limit: Optional[int] = None,
+						  timeout: Optional[int] = None, allowed_updates: Optional[list] = None,
+						  request_timeout: Optional[int] = None) -> list:
+		"""
+		The function receives the new updates of the bot
+		:param offset: identifier of the first update to be returned
+		:param limit: maximum number of updates
+		:param timeout: timeout of long polling in seconds
+		:param allowed_updates: types of the updates to be received
+		:param request_timeout: timeout of the request in seconds, longer than the timeout of long polling
+		:return: list of objects of type Update of class telebot
+		"""
+		params = {'offset': offset, 'limit': limit, 'timeout': timeout,
+				  'allowed_updates': json.dumps(allowed_updates) if allowed_updates is not None else None}
+		json_updates = await telebot.asyncio_helper._process_request(
+			self.token, 'getUpdates', params={key: value for key, value in params.items() if value is not None},
+			request_timeout=request_timeout)
+		return [Update.de_json(json_update) for json_update in json_updates]
+
+
+bot = LongPollingBot(os.getenv('BOT_TOKEN'), parse_mode='HTML')
+if os.getenv('TELEGRAM_API_URL'):
+	telebot.asyncio_helper.API_URL = os.getenv('TELEGRAM_API_URL') + 'bot{0}/{1}'
+
+dialog = Dialog(dialog_states)
+
+
+@bot.message_handler(commands=['start'])
+async def start_message(message: Message) -> None:
+	"""
+	The function executes the bot command start and sends a welcome message
+	:param message: start bot command
+	:return: None
+	"""
+	await asyncio.to_thread(add_new_user, message)
+	id_user = await asyncio.to_thread(get_id_user, message)
+	async_outbox.submit(id_user, bot.send_message, id_user, get_start())
+
+
+@bot.message_handler(commands=['help'])
+async def help_message(message: Message) -> None:
+	"""
+	The function executes the bot command help and sends a help message
+	:param message: help bot command
+	:return: None
+	"""
+	id_user = await asyncio.to_thread(get_id_user, message)
+	async_outbox.submit(id_user, bot.send_message, id_user, get_help())
+
+
+@bot.message_handler(commands=['lowprice', 'highprice', 'bestdeal'])
+@timed(HANDLER_SECONDS)
+async def action_message(message: Message) -> None:
+	"""
+	The function executes the bot command lowprice or highprice or bestdeal and sends a request to the search city
+	:param message: lowprice bot command  or highprice bot command or bestdeal bot command
+	:return: None
+	"""
+	id_user = await asyncio.to_thread(get_id_user, message)
+	async_prefetcher.cancel(id_user)
+	conversation = await asyncio.to_thread(conversations.start, message, id_user)
+	tracer.start(id_user, conversation.command)
+	async_outbox.submit(id_user, bot.send_message, id_user, 'Введите город поиска на английском языке:')
+	await asyncio.to_thread(dialog.next, message.chat.id, get_id_hotels)
+
+
+@bot.message_handler(commands=['history'])
+async def history_message(message: Message) -> None:
+	"""
+	The function executes the bot command history and sends the history of the last 10 user requests
+	:param message: history bot command
+	:return: None
+	"""
+	logger.info(f'Start history query')
+	id_user = await asyncio.to_thread(get_id_user, message)
+	list_history = await asyncio.to_thread(get_history, message)
+	if len(list_history) == 0:
+		async_outbox.submit(message.chat.id, bot.send_message, message.chat.id, 'Пока пусто')
+	elif MESSAGE_MODE == 'compact':
+		pages = await asyncio.to_thread(form_history_pages, list_history)
+		async_outbox.submit(id_user, bot.send_message, id_user, pages[0], disable_web_page_preview=True,
+							reply_markup=get_keyboard_history(0, len(pages)), priority=PRIORITY_LOW)
+	else:
+		for elem in list_history:
+			text = ''
+			text += f"<b>дата запроса - {elem[0]}</b> "
+			text += f"<b>команда - {elem[1]}</b> "
+			text += f"<b>город - {elem[2]}</b> "
+			async_outbox.submit(id_user, bot.send_message, id_user, text, priority=PRIORITY_LOW)
+			list_hotels = await asyncio.to_thread(get_hotel_results, elem[3], ('name', 'current', 'url'))
+			for hotel in list_hotels:
+				text = ''
+				text += f"<b>отель - {hotel['name']}</b>\n"
+				text += f"<b>стоимость - {hotel['current']}</b>\n"
+				text += f"<b>ссылка - {hotel['url']}</b>\n"
+				async_outbox.submit(id_user, bot.send_message, id_user, text, disable_web_page_preview=True,
+									priority=PRIORITY_LOW)
+			if not list_hotels:
+				logger.error(f'No history')
+				text = 'Ничего не нашлось'
+				async_outbox.submit(id_user, bot.send_message, id_user, text, priority=PRIORITY_LOW)
+	logger.info(f'End history query')
+	async_outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?', priority=PRIORITY_LOW)
+	async_outbox.submit(id_user, bot.send_message, id_user, get_help(), priority=PRIORITY_LOW)
+
+
+@bot.message_handler(content_types=['text'])
+async def dialog_message(message: Message) -> None:
+	"""
+	The function passes the answer of the user to the step of the search dialog the chat is at
+	or sends a help message if the chat is not at a step. The step is read from the store in a worker thread
+	here rather than in a filter of the handler, since AsyncTeleBot does not await the filters
+	:param message: object of type Message of class telebot
+	:return: None
+	"""
+	step = await asyncio.to_thread(dialog.pop, message.chat.id)
+	if step:
+		func, args = step
+		await asyncio.to_thread(conversations.resume, message.from_user.id)
+		await func(message, *args)
+	else:
+		await another_message(message)
+
+
+async def another_message(message: Message) -> None:
+	"""
+	The function sends a help message
+	:param message: any text or command for which no handler is defined
+	:return: None
+	"""
+	id_user = await asyncio.to_thread(get_id_user, message)
+	async_outbox.submit(id_user, bot.send_message, id_user, get_another_message())
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('history:'))
+async def history_page(call: CallbackQuery) -> None:
+	"""
+	The function turns the page of the query history sent in compact mode
+	:param call: object of type CallbackQuery of class telebot, call.data contains the number of the page
+	:return: None
+	"""
+	id_user = call.from_user.id
+	page = int(call.data.split(':')[1])
+	pages = await asyncio.to_thread(form_history_pages, await asyncio.to_thread(get_history, call))
+	if 0 <= page < len(pages):
+		async_outbox.submit(id_user, bot.edit_message_text, pages[page], id_user, call.message.message_id,
+							disable_web_page_preview=True, reply_markup=get_keyboard_history(page, len(pages)),
+							priority=PRIORITY_HIGH)
+	await bot.answer_callback_query(call.id)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+@timed(HANDLER_SECONDS)
+async def callback_query(call: CallbackQuery) -> None:
+	"""
+	The object handler function for incoming callback requests from built-in keyboard callback buttons
+	:param call: object of type CallbackQuery of class telebot
+	:return: None
+	"""
+	id_user = call.from_user.id
+	if '***' in call.data:
+		await asyncio.to_thread(conversations.resume, id_user)
+		id_destination = int(call.data.split('***')[0])
+		name_destination = call.data.split('***')[1]
+		await asyncio.to_thread(conversations.update, id_user, id_destination=id_destination,
+								name_destination=name_destination)
+		tracer.event(id_user, 'district')
+		calendar, step = build_calendar(STAGE_DATE_FROM, datetime.date.today())
+		async_outbox.submit(id_user, bot.edit_message_text, f"Выберите дату заезда: {LSTEP[step]}",
+							id_user,
+							call.message.message_id,
+							reply_markup=calendar)
+	elif 'да' in call.data or 'нет' in call.data:
+		if 'да' in call.data:
+			async_outbox.submit(id_user, bot.edit_message_text,
+								'Сколько фотографий для каждого отеля необходимо вывести (не более 5)',
+								id_user, call.message.message_id)
+			await asyncio.to_thread(dialog.next, call.message.chat.id, get_photo, id_user)
+		else:
+			await asyncio.to_thread(conversations.resume, id_user)
+			async_prefetcher.cancel(id_user)
+			await get_answer(id_user, 0, None)
+	elif is_calendar_callback(call.data):
+		answer = process_calendar(call.data)
+		if answer.keyboard:
+			async_outbox.submit(id_user, bot.edit_message_text, f"{LSTEP[answer.step]}",
+								id_user, call.message.message_id, reply_markup=answer.keyboard)
+		elif answer.stage == STAGE_DATE_FROM and answer.result:
+			await asyncio.to_thread(conversations.resume, id_user)
+			await asyncio.to_thread(conversations.update, id_user, date_from=str(answer.result))
+			tracer.event(id_user, 'date_from')
+			calendar, step = build_calendar(STAGE_DATE_TO, answer.result, answer.result + datetime.timedelta(days=28))
+			async_outbox.submit(id_user, bot.edit_message_text, f"Выберите дату отъезда: {LSTEP[step]}",
+								id_user,
+								call.message.message_id,
+								reply_markup=calendar)
+		elif answer.stage == STAGE_DATE_TO and answer.result:
+			conversation = await asyncio.to_thread(conversations.resume, id_user)
+			if conversation.date_to:
+				return
+			date_from, date_to = answer.min_date, answer.result
+			await asyncio.to_thread(conversations.update, id_user, date_from=str(date_from), date_to=str(date_to))
+			if date_from != date_to:
+				q_days = (date_to - date_from).days
+				await asyncio.to_thread(conversations.update, id_user, q_days=q_days)
+			await asyncio.to_thread(conversations.flush)
+			tracer.event(id_user, 'date_to')
+			if conversation.command == '/bestdeal':
+				async_outbox.submit(call.message.chat.id, bot.send_message, call.message.chat.id,
+									'Введите минимальную стоимость отеля в сутки в $')
+				await asyncio.to_thread(dialog.next, call.message.chat.id, get_min_cost, id_user)
+			else:
+				async_outbox.submit(call.message.chat.id, bot.send_message, call.message.chat.id,
+									'Подождите, пожалуйста, запрашиваю для вас информацию...')
+				await get_count_hotel(id_user)
+
+
+@dialog.step
+async def get_id_hotels(message: Message) -> None:
+	"""
+	The function sends an inline keyboard to specify the area of the city, if a response is received
+	from the rapidapi service, or requests the city again in case of a negative response
+	:param message: object of type Message of class telebot
+					message.text contains the city sent to the bot
+	:return: None
+	"""
+	msg = async_outbox.submit(message.chat.id, bot.send_message, message.chat.id,
+							  'Подождите, пожалуйста, запрашиваю для вас информацию...')
+	list_class_cities = await get_district(message.text)
+	tracer.event(message.from_user.id, 'city')
+	if len(list_class_cities) > 0:
+		async_outbox.submit(message.chat.id, edit_sent_message, msg, 'Уточните, пожалуйста, район:',
+							reply_markup=get_keyboard_district(list_class_cities))
+	else:
+		async_outbox.submit(message.chat.id, edit_sent_message, msg, 'Такого города нет!\nПопробуйте еще раз:')
+		await asyncio.to_thread(dialog.next, message.chat.id, get_id_hotels)
+
+
+async def _ask_number(message: Message, id_user: int, error_log: str, retry_text: str, retry_step: Any,
+					  retry_args: tuple, next_text: str, next_step: Any) -> bool:
+	"""
+	The function checks that the user sent a number and asks the next question of the bestdeal dialog,
+	or asks the same question again
+	:param message: object of type Message of class telebot
+	:param id_user: unique user number
+	:param error_log: log message in case of a wrong number
+	:param retry_text: question asked again in case of a wrong number
+	:param retry_step: coroutine processing the repeated answer
+	:param retry_args: arguments of retry_step
+	:param next_text: next question
+	:param next_step: coroutine processing the answer to the next question
+	:return: True if the user sent a number
+	"""
+	try:
+		float(message.text)
+		async_outbox.submit(id_user, bot.send_message, id_user, next_text)
+		await asyncio.to_thread(dialog.next, message.chat.id, next_step, *retry_args, message.text)
+		return True
+	except ValueError as ex:
+		logger.error(error_log, exc_info=ex)
+		async_outbox.submit(id_user, bot.send_message, id_user,
+							f'Вы ввели неправильное число, попробуйте еще раз.\n{retry_text}')
+		await asyncio.to_thread(dialog.next, message.chat.id, retry_step, *retry_args)
+		return False
+
+
+@dialog.step
+async def get_min_cost(message: Message, id_user: int) -> None:
+	"""
+	The function asks the client for the minimum desired cost of the hotel and checks the user's response
+	:param message: object of type Message of class telebot
+					message.text contains the desired minimum hotel price
+	:param id_user: unique user number
+	:return: None
+	"""
+	await _ask_number(message, id_user, f'Ошибка неверный тип данных минимальная стоимость отеля в сутки в $',
+					  f'Введите минимальную стоимость отеля в сутки', get_min_cost, (id_user,),
+					  'Введите максимальную стоимость отеля в сутки в $', get_max_cost)
+
+
+@dialog.step
+async def get_max_cost(message: Message, id_user: int, min_cost: str) -> None:
+	"""
+	The function asks the client for the maximum desired cost of the hotel and checks the user's response
+	:param message: object of type Message of class telebot
+					message.text contains the desired maximum hotel price
+	:param id_user: unique user number
+	:param min_cost: desired minimum hotel price
+	:return: None
+	"""
+	if await _ask_number(message, id_user, f'Ошибка неверный тип данных максимальная стоимость отеля в сутки в $',
+						 f'Введите максимальную стоимость отеля в сутки', get_max_cost, (id_user, min_cost),
+						 'Введите минимальную удаленность отеля от центра в милях', get_min_dist):
+		conversation = await asyncio.to_thread(conversations.get, id_user)
+		async_prefetcher.properties(id_user, conversation.id_destination, conversation.date_from,
+									conversation.date_to, 'PRICE', min_cost, message.text)
+
+
+@dialog.step
+async def get_min_dist(message: Message, id_user: int, min_cost: str, max_cost: str) -> None:
+	"""
+	The function asks the client for the minimum desired distance of the hotel from the center
+	 and checks the user's response
+	:param message: object of type Message of class telebot
+					message.text contains the desired minimum distance of the hotel from the center
+	:param id_user: unique user number
+	:param min_cost: desired minimum hotel price
+	:param max_cost: desired maximum hotel price
+	:return: None
+	"""
+	await _ask_number(message, id_user, f'Ошибка неверный тип данных минимальная удаленность отеля от центра в милях',
+					  f'Введите минимальную удаленность отеля от центра', get_min_dist, (id_user, min_cost, max_cost),
+					  'Введите максимальную удаленность отеля от центра в милях', get_max_dist)
+
+
+@dialog.step
+async def get_max_dist(message: Message, id_user: int, min_cost: str, max_cost: str, min_dist: str) -> None:
+	"""
+	The function asks the client for the maximum desired distance of the hotel from the center
+	 and checks the user's response
+	:param message: object of type Message of class telebot
+					message.text contains the desired maximum distance of the hotel from the center
+	:param id_user: unique user number
+	:param min_cost: desired minimum hotel price
+	:param max_cost: desired maximum hotel price
+	:param min_dist: desired minimum distance of the hotel from the center
+	:return: None
+	"""
+	max_dist = message.text
+	try:
+		float(max_dist)
+		async_outbox.submit(message.chat.id, bot.send_message, message.chat.id,
+							'Подождите, пожалуйста, запрашиваю для вас информацию...')
+		await get_count_hotel(id_user, min_cost, max_cost, min_dist, max_dist)
+	except ValueError as ex:
+		logger.error(f'Ошибка неверный тип данных максимальная удаленность отеля от центра в милях', exc_info=ex)
+		async_outbox.submit(id_user, bot.send_message, id_user,
+							f'Вы ввели неправильное число, попробуйте еще раз.\n'
+							f'Введите  максимальную удаленность отеля от центра')
+		await asyncio.to_thread(dialog.next, message.chat.id, get_max_dist, id_user, min_cost, max_cost, min_dist)
+
+
+@timed(HANDLER_SECONDS)
+async def get_count_hotel(id_user: int, min_cost: str = None, max_cost: str = None, min_dist: str = None,
+						  max_dist: str = None) -> None:
+	"""
+	The function asks the client for the desired quantity hotels for output and checks the user's response
+	or sends a response to the user that nothing was found
+	:param id_user: unique user number
+	:param min_cost: desired minimum hotel price
+	:param max_cost: desired maximum hotel price
+	:param min_dist: desired minimum distance of the hotel from the center
+	:param max_dist: desired maximum distance of the hotel from the center
+	:return: None
+	"""
+	conversation = await asyncio.to_thread(conversations.get, id_user)
+	date_from, date_to, command = conversation.date_from, conversation.date_to, conversation.command
+	id_destination, name_destination = conversation.id_destination, conversation.name_destination
+	order_by = 'PRICE_HIGHEST_FIRST' if command == '/highprice' else 'PRICE'
+	if command == '/bestdeal':
+		list_hotels = await get_bestdeal(id_destination, date_from, date_to, order_by, min_cost, max_cost,
+										 float(min_dist), float(max_dist))
+	else:
+		list_hotels = await get_properties(id_destination, date_from, date_to, order_by)
+	await asyncio.to_thread(conversations.update, id_user, hotels=list_hotels)
+	await asyncio.to_thread(conversations.flush)
+	tracer.event(id_user, 'hotels')
+	if len(list_hotels) != 0:
+		async_prefetcher.photos(id_user, [hotel['id'] for hotel in list_hotels])
+		max_q_hotels = len(list_hotels)
+		async_outbox.submit(id_user, bot.send_message, id_user,
+							f"Вы выбрали {name_destination}"
+							f" c {date_from} по {date_to}\n"
+							f"Какое кол-во отелей вывести в диапазоне от 1"
+							f" до {max_q_hotels}?")
+		await asyncio.to_thread(dialog.next, id_user, need_a_photo, max_q_hotels)
+	else:
+		tracer.finish(id_user, 'not_found')
+		async_outbox.submit(id_user, bot.send_message, id_user, f"К сожалению по данному запросу ничего не найдено")
+		async_outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?')
+		async_outbox.submit(id_user, bot.send_message, id_user, get_help())
+
+
+@dialog.step
+async def need_a_photo(message: Message, max_q_hotels: int) -> None:
+	"""
+	The function checks the possibility of displaying the requested number of hotels
+	and requests the need to display photos
+	:param message: object of type Message of class telebot
+					message.text contains the number of hotels received from the user to be displayed
+	:param max_q_hotels: the maximum number of hotels that can be displayed
+	:return: None
+	"""
+	id_user = await asyncio.to_thread(get_id_user, message)
+	if int(message.text) > max_q_hotels or int(message.text) < 1:
+		async_outbox.submit(id_user, bot.send_message, id_user,
+							f'Вы ввели неправильное число, попробуйте еще раз.\n'
+							f'Какое кол-во отелей вывести в диапазоне'
+							f' от 1 до {max_q_hotels}?')
+		await asyncio.to_thread(dialog.next, message.chat.id, need_a_photo, max_q_hotels)
+	else:
+		await asyncio.to_thread(conversations.update, id_user, q_hotels=int(message.text))
+		conversation = await asyncio.to_thread(conversations.get, id_user)
+		async_prefetcher.photos(id_user, [hotel['id'] for hotel in conversation.hotels], int(message.text))
+		async_outbox.submit(id_user, bot.send_message, id_user, f'Загрузить фото?', reply_markup=get_keyboard_photo())
+
+
+@dialog.step
+async def get_photo(message: Message, id_user: int) -> None:
+	"""
+	The function creates a list of links photos for each hotel
+	and passes it to the function to display a response to the user
+	:param message: object of type Message of class telebot
+					message.text contains the number of photos to display for each hotel
+	:param id_user: unique user number
+	:return: None
+	"""
+	if 0 < int(message.text) <= 5:
+		msg = async_outbox.submit(id_user, bot.send_message, id_user,
+								  'Подождите, пожалуйста, запрашиваю для вас информацию...')
+		await get_answer(id_user, int(message.text), msg)
+	else:
+		async_outbox.submit(id_user, bot.send_message, id_user,
+							f'Вы ввели неправильное число, попробуйте еще раз.\n'
+							f'Сколько фотографий для каждого отеля необходимо вывести (не более 5)')
+		await asyncio.to_thread(dialog.next, message.chat.id, get_photo, id_user)
+
+
+@timed(HANDLER_SECONDS)
+async def get_answer(id_user: int, q_photo: int, msg: Optional[asyncio.Future]) -> None:
+	"""
+	The function sends the header of the response first and then each hotel with its photos
+	as soon as the photos of the hotel are received, the header shows how many hotels have been sent
+	:param id_user: unique user number
+	:param q_photo: number of photos for each hotel, 0 without photos
+	:param msg: future of the message to be replaced by the header of the response or None
+	:return: None
+	"""
+	answer = await asyncio.to_thread(form_message, id_user)
+	if MESSAGE_MODE == 'compact':
+		list_links_photo = await get_photo_hotel(q_photo, id_user) if q_photo else []
+		tracer.finish(id_user, 'answer')
+		await send_compact_answer(id_user, answer, list_links_photo, msg)
+		return
+	header, list_hotels = answer[0], answer[1:]
+	if msg:
+		header_sent = async_outbox.submit(id_user, edit_sent_message, msg, form_progress(header, 0, len(list_hotels)))
+	else:
+		header_sent = async_outbox.submit(id_user, bot.send_message, id_user,
+										  form_progress(header, 0, len(list_hotels)))
+	progress = None
+	i = 0
+	async for links_photo in iter_photo_hotel(q_photo, id_user):
+		hotel = list_hotels[i]
+		i += 1
+		if i == 1:
+			tracer.event(id_user, 'first_hotel')
+		async_outbox.submit(id_user, bot.send_message, id_user, hotel, disable_web_page_preview=True)
+		if links_photo is not None:
+			if links_photo:
+				media_group = [telebot.types.InputMediaPhoto(media=link) for link in links_photo]
+				async_outbox.submit(id_user, bot.send_media_group, id_user, media=media_group)
+			else:
+				logger.error(f'No photo')
+				async_outbox.submit(id_user, bot.send_message, id_user, 'нет фото')
+		if i < len(list_hotels) and (progress is None or progress.done()):
+			progress = async_outbox.submit(id_user, edit_sent_message, header_sent,
+										   form_progress(header, i, len(list_hotels)))
+	async_outbox.submit(id_user, edit_sent_message, header_sent, header)
+	tracer.finish(id_user, 'answer')
+	logger.info(f'End request')
+	async_outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?')
+	async_outbox.submit(id_user, bot.send_message, id_user, get_help())
+
+
+async def edit_sent_message(message_sent: asyncio.Future, text: str, **kwargs) -> Any:
+	"""
+	The function replaces the text of a message after the message has been sent by the outbox,
+	it is itself submitted to the outbox after the message, so the message is sent by then
+	:param message_sent: future of the message
+	:param text: new text of the message
+	:param kwargs: keyword arguments of bot.edit_message_text
+	:return: edited message
+	"""
+	message = await message_sent
+	return await bot.edit_message_text(text, message.chat.id, message.message_id, **kwargs)
+
+
+async def send_compact_answer(id_user: int, answer: list, list_links_photo: list,
+							  msg: Optional[asyncio.Future]) -> None:
+	"""
+	The function sends the response packed into as few messages and albums as the limits of Telegram allow
+	:param id_user: unique user number
+	:param answer: header and description of each hotel
+	:param list_links_photo: list of links to photo for each hotel
+	:param msg: future of the message to be replaced by the first part of the response or None
+	:return: None
+	"""
+	messages = pack_messages(answer)
+	if msg:
+		async_outbox.submit(id_user, edit_sent_message, msg, messages[0], disable_web_page_preview=True)
+	else:
+		async_outbox.submit(id_user, bot.send_message, id_user, messages[0], disable_web_page_preview=True)
+	for text in messages[1:]:
+		async_outbox.submit(id_user, bot.send_message, id_user, text, disable_web_page_preview=True)
+	if list_links_photo:
+		captions = [hotel.split('\n', 1)[0] for hotel in answer[1:]]
+		for album in pack_albums(list_links_photo, captions):
+			if len(album) == 1:
+				async_outbox.submit(id_user, bot.send_photo, id_user, album[0][0], caption=album[0][1])
+			else:
+				async_outbox.submit(id_user, bot.send_media_group, id_user,
+									media=[telebot.types.InputMediaPhoto(media=link, caption=caption)
+										   for link, caption in album])
+	logger.info(f'End request')
+	async_outbox.submit(id_user, bot.send_message, id_user, 'Чем я еще могу вам помочь?')
+	async_outbox.submit(id_user, bot.send_message, id_user, get_help())
+
+
+async def run() -> None:
+	"""
+	The function runs the bot on the asyncio event loop until it is stopped
+	:return: None
+	"""
+	try:
+		await bot.polling(non_stop=True, timeout=LONG_POLLING_TIMEOUT, request_timeout=LONG_POLLING_TIMEOUT + 10)
+	finally:
+		await async_outbox.join(OUTBOX_DRAIN_TIMEOUT)
+		await async_outbox.close()
+		await async_hotels_api.close()
+		await bot.close_session()
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, filename='bot.log', filemode='a',
+						format='%(asctime)s - %(levelname)s - %(message)s',
+						datefmt='%d-%b-%y %H:%M:%S')
+	logger.info(f'Start async bot "Choosing_hotels_bot"')
+	start_exporter()
+	asyncio.run(run())
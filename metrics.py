@@ -0,0 +1,428 @@
+import asyncio
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger('trace')
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', 0))
+METRICS_DUMP_PATH = os.getenv('METRICS_DUMP_PATH', 'metrics.prom')
+TRACE_CONVERSATIONS = os.getenv('TRACE_CONVERSATIONS', '0') == '1'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+_metrics = []
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+	"""
+	The function returns the labels of a sample in the Prometheus text format
+	:param names: names of the labels
+	:param values: values of the labels
+	:param extra: additional label already formatted, for example le="0.1"
+	:return: labels in curly brackets or an empty string
+	"""
+	labels = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+	if extra:
+		labels.append(extra)
+	return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Counter:
+	"""
+	Monotonically increasing counter with labels
+	"""
+
+	def __init__(self, name: str, documentation: str, labels: tuple = ()):
+		self.__name = name
+		self.__documentation = documentation
+		self.__labels = labels
+		self.__values = {}
+		self.__lock = threading.Lock()
+		_metrics.append(self)
+
+	def inc(self, *label_values, amount: float = 1) -> None:
+		"""
+		The function increases the counter
+		:param label_values: values of the labels in the order of their names
+		:param amount: increment
+		:return: None
+		"""
+		with self.__lock:
+			self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+	def render(self) -> list:
+		"""
+		The function returns the lines of the counter in the Prometheus text format
+		:return: list of lines
+		"""
+		with self.__lock:
+			values = list(self.__values.items())
+		lines = [f'# HELP {self.__name} {self.__documentation}', f'# TYPE {self.__name} counter']
+		for label_values, value in sorted(values):
+			lines.append(f'{self.__name}{_format_labels(self.__labels, label_values)} {value}')
+		return lines
+
+
+class Histogram:
+	"""
+	Histogram of observed values with fixed buckets and labels
+	"""
+
+	def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+		self.__name = name
+		self.__documentation = documentation
+		self.__labels = labels
+		self.__buckets = buckets
+		self.__values = {}
+		self.__lock = threading.Lock()
+		_metrics.append(self)
+
+	def observe(self, value: float, *label_values) -> None:
+		"""
+		The function adds the value to the histogram
+		:param value: observed value, for example duration in seconds
+		:param label_values: values of the labels in the order of their names
+		:return: None
+		"""
+		index = bisect.bisect_left(self.__buckets, value)
+		with self.__lock:
+			data = self.__values.get(label_values)
+			if data is None:
+				data = self.__values[label_values] = [[0] * (len(self.__buckets) + 1), 0.0]
+			data[0][index] += 1
+			data[1] += value
+
+	def time(self, *label_values) -> '_Timer':
+		"""
+		The function returns a context manager observing the duration of its block
+		:param label_values: values of the labels in the order of their names
+		:return: context manager
+		"""
+		return _Timer(self, label_values)
+
+	def render(self) -> list:
+		"""
+		The function returns the lines of the histogram in the Prometheus text format
+		:return: list of lines
+		"""
+		with self.__lock:
+			values = [(label_values, list(data[0]), data[1]) for label_values, data in self.__values.items()]
+		lines = [f'# HELP {self.__name} {self.__documentation}', f'# TYPE {self.__name} histogram']
+		for label_values, counts, total in sorted(values):
+			cumulative = 0
+			for bound, count in zip(self.__buckets + ('+Inf',), counts):
+				cumulative += count
+				labels = _format_labels(self.__labels, label_values, f'le="{bound}"')
+				lines.append(f'{self.__name}_bucket{labels} {cumulative}')
+			labels = _format_labels(self.__labels, label_values)
+			lines.append(f'{self.__name}_sum{labels} {total}')
+			lines.append(f'{self.__name}_count{labels} {cumulative}')
+		return lines
+
+
+class Gauge:
+	"""
+	Value with labels that may go up and down
+	"""
+
+	def __init__(self, name: str, documentation: str, labels: tuple = ()):
+		self.__name = name
+		self.__documentation = documentation
+		self.__labels = labels
+		self.__values = {}
+		self.__lock = threading.Lock()
+		_metrics.append(self)
+
+	def set(self, value: float, *label_values) -> None:
+		"""
+		The function sets the value of the gauge
+		:param value: new value
+		:param label_values: values of the labels in the order of their names
+		:return: None
+		"""
+		with self.__lock:
+			self.__values[label_values] = value
+
+	def render(self) -> list:
+		"""
+		The function returns the lines of the gauge in the Prometheus text format
+		:return: list of lines
+		"""
+		with self.__lock:
+			values = list(self.__values.items())
+		lines = [f'# HELP {self.__name} {self.__documentation}', f'# TYPE {self.__name} gauge']
+		for label_values, value in sorted(values):
+			lines.append(f'{self.__name}{_format_labels(self.__labels, label_values)} {value}')
+		return lines
+
+
+class _Timer:
+	__slots__ = ('histogram', 'label_values', 'start')
+
+	def __init__(self, histogram: Histogram, label_values: tuple):
+		self.histogram = histogram
+		self.label_values = label_values
+
+	def __enter__(self) -> '_Timer':
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+def timed(histogram: Histogram, label: Optional[str] = None) -> Callable:
+	"""
+	The function returns a decorator observing the duration of every call of a function or a coroutine function
+	:param histogram: histogram with one label
+	:param label: value of the label, the name of the function by default
+	:return: decorator
+	"""
+
+	def decorator(func: Callable) -> Callable:
+		value = label or func.__name__
+		if asyncio.iscoroutinefunction(func):
+			@functools.wraps(func)
+			async def async_wrapper(*args, **kwargs):
+				with histogram.time(value):
+					return await func(*args, **kwargs)
+
+			return async_wrapper
+
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with histogram.time(value):
+				return func(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Duration of bot handlers', ('handler',))
+API_SECONDS = Histogram('hotels_api_request_seconds', 'Duration of requests to the hotels service', ('endpoint',))
+API_RESPONSES = Counter('hotels_api_responses_total', 'Responses of the hotels service', ('endpoint', 'status'))
+UPSTREAM_EVENTS = Counter('hotels_api_guard_total', 'Requests to the hotels service throttled, rejected or answered '
+						  'from a stale cache by the guard', ('endpoint', 'event'))
+UPSTREAM_CIRCUIT = Gauge('hotels_api_circuit_state', 'State of the circuit breaker: 0 closed, 1 open, 2 half-open',
+						 ('endpoint',))
+UPSTREAM_QUOTA = Gauge('hotels_api_quota_remaining', 'Requests remaining in the quota of the hotels service')
+CACHE_REQUESTS = Counter('cache_requests_total', 'Lookups in the memory caches', ('cache', 'result'))
+DB_SECONDS = Histogram('db_query_seconds', 'Duration of database functions', ('function',), DB_BUCKETS)
+TELEGRAM_SECONDS = Histogram('telegram_request_seconds', 'Duration of requests to the Telegram Bot API', ('method',))
+TELEGRAM_REQUESTS = Counter('telegram_requests_total', 'Requests to the Telegram Bot API', ('method', 'status'))
+OUTBOX_WAIT_SECONDS = Histogram('outbox_wait_seconds', 'Time messages spend in the outbound queue')
+CONVERSATION_SECONDS = Histogram('conversation_seconds', 'Time from the search command to the final answer',
+								 ('command', 'outcome'), (1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+
+
+def render() -> str:
+	"""
+	The function returns all metrics in the Prometheus text format
+	:return: text of the metrics
+	"""
+	lines = []
+	for metric in _metrics:
+		lines.extend(metric.render())
+	return '\n'.join(lines) + '\n'
+
+
+class ConversationTracer:
+	"""
+	Optional trace span of a search conversation from the command to the final answer.
+	Finished spans are written to the trace logger as json lines with the offsets of the steps
+	"""
+
+	def __init__(self, enabled: bool):
+		self.__enabled = enabled
+		self.__spans = {}
+		self.__lock = threading.Lock()
+
+	def start(self, id_user: int, command: str) -> None:
+		"""
+		The function opens the span of the conversation, the previous span of the user is abandoned
+		:param id_user: unique user number
+		:param command: search command
+		:return: None
+		"""
+		if self.__enabled:
+			with self.__lock:
+				previous = self.__spans.pop(id_user, None)
+				self.__spans[id_user] = {'command': command, 'start': time.monotonic(), 'events': []}
+			if previous is not None:
+				self.__write(id_user, previous, 'abandoned')
+
+	def event(self, id_user: int, name: str) -> None:
+		"""
+		The function marks a step of the conversation
+		:param id_user: unique user number
+		:param name: name of the step
+		:return: None
+		"""
+		if self.__enabled:
+			with self.__lock:
+				span = self.__spans.get(id_user)
+				if span is not None:
+					span['events'].append((name, round(time.monotonic() - span['start'], 4)))
+
+	def finish(self, id_user: int, outcome: str) -> None:
+		"""
+		The function closes the span of the conversation
+		:param id_user: unique user number
+		:param outcome: result of the conversation, for example answer or not_found
+		:return: None
+		"""
+		if self.__enabled:
+			with self.__lock:
+				span = self.__spans.pop(id_user, None)
+			if span is not None:
+				self.__write(id_user, span, outcome)
+
+	@staticmethod
+	def __write(id_user: int, span: dict, outcome: str) -> None:
+		"""
+		The function records the finished span
+		:param id_user: unique user number
+		:param span: data of the span
+		:param outcome: result of the conversation
+		:return: None
+		"""
+		duration = time.monotonic() - span['start']
+		CONVERSATION_SECONDS.observe(duration, span['command'], outcome)
+		trace_logger.info(json.dumps({'id_user': id_user, 'command': span['command'], 'outcome': outcome,
+									  'duration': round(duration, 4), 'events': span['events']}))
+
+
+tracer = ConversationTracer(TRACE_CONVERSATIONS)
+
+
+def _send_telegram_request(method: str, url: str, **kwargs):
+	"""
+	The function sends a request of the synchronous bot to the Telegram Bot API and measures it
+	:param method: http method
+	:param url: url of the Bot API method
+	:param kwargs: arguments of requests.Session.request
+	:return: response of the Bot API
+	"""
+	from telebot import apihelper
+
+	name = url.rsplit('/', 1)[-1]
+	start = time.perf_counter()
+	try:
+		response = apihelper._get_req_session().request(method, url, **kwargs)
+	except Exception:
+		TELEGRAM_REQUESTS.inc(name, 'error')
+		raise
+	finally:
+		TELEGRAM_SECONDS.observe(time.perf_counter() - start, name)
+	TELEGRAM_REQUESTS.inc(name, str(response.status_code))
+	return response
+
+
+def instrument_telegram() -> None:
+	"""
+	The function makes the synchronous and the asynchronous bot measure their requests to the Telegram Bot API
+	:return: None
+	"""
+	from telebot import apihelper
+
+	apihelper.CUSTOM_REQUEST_SENDER = _send_telegram_request
+	try:
+		from telebot import asyncio_helper
+	except ImportError:
+		return
+	process_request = asyncio_helper._process_request
+
+	@functools.wraps(process_request)
+	async def _process_request(token, url, *args, **kwargs):
+		start = time.perf_counter()
+		status = 'error'
+		try:
+			result = await process_request(token, url, *args, **kwargs)
+			status = '200'
+			return result
+		except asyncio_helper.ApiTelegramException as ex:
+			status = str(ex.error_code)
+			raise
+		finally:
+			TELEGRAM_SECONDS.observe(time.perf_counter() - start, url)
+			TELEGRAM_REQUESTS.inc(url, status)
+
+	asyncio_helper._process_request = _process_request
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self) -> None:
+		if self.path != '/metrics':
+			self.send_error(404)
+			return
+		body = render().encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format: str, *args) -> None:
+		logger.debug(format, *args)
+
+
+def _dump(path: str, interval: float) -> None:
+	"""
+	The function writes all metrics to the file every interval
+	:param path: path to the file
+	:param interval: interval in seconds
+	:return: None
+	"""
+	while True:
+		time.sleep(interval)
+		try:
+			with open(f'{path}.tmp', 'w') as file:
+				file.write(render())
+			os.replace(f'{path}.tmp', path)
+		except OSError as ex:
+			logger.error(f'Ошибка записи метрик в {path}', exc_info=ex)
+
+
+def worker_exporter(number: int) -> tuple:
+	"""
+	The function returns the port and the dump path of the metrics of a worker process,
+	the worker N uses METRICS_PORT + N + 1 and METRICS_DUMP_PATH with the .workerN suffix before the extension
+	:param number: number of the worker
+	:return: tuple (port or 0, dump path)
+	"""
+	root, extension = os.path.splitext(METRICS_DUMP_PATH)
+	return METRICS_PORT + number + 1 if METRICS_PORT else 0, f'{root}.worker{number}{extension}'
+
+
+def start_exporter(port: int = METRICS_PORT, dump_path: str = METRICS_DUMP_PATH) -> None:
+	"""
+	The function measures requests to the Telegram Bot API and starts the export of metrics:
+	the /metrics endpoint if the port is set and the periodic dump if METRICS_DUMP_INTERVAL is set
+	:param port: port of the /metrics endpoint, 0 without the endpoint
+	:param dump_path: path of the periodic dump
+	:return: None
+	"""
+	instrument_telegram()
+	if port:
+		server = ThreadingHTTPServer((METRICS_HOST, port), _MetricsHandler)
+		threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+		logger.info(f'Start metrics server on {METRICS_HOST}:{port}/metrics')
+	if METRICS_DUMP_INTERVAL:
+		threading.Thread(target=_dump, args=(dump_path, METRICS_DUMP_INTERVAL), name='metrics-dump',
+						 daemon=True).start()
@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable, Optional
+
+from dotenv import load_dotenv
+
+from func import get_properties, warm_photo_links
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 4))
+PREFETCH_PHOTO_HOTELS = int(os.getenv('PREFETCH_PHOTO_HOTELS', 5))
+
+
+class Prefetcher:
+	"""
+	Speculative loading of the data the conversation is going to need.
+	While the user answers the prompts the hotels and their photos are put into the caches in the background,
+	so the final answer is read from the caches or joins the request already in flight.
+	Tasks not started yet are cancelled when the user abandons the conversation
+	"""
+
+	def __init__(self, workers: int, photo_hotels: int):
+		self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+		self.__photo_hotels = photo_hotels
+		self.__tasks = {}
+		self.__lock = threading.Lock()
+
+	def properties(self, id_user: int, *args) -> None:
+		"""
+		The function starts loading the list of hotels into the cache
+		:param id_user: unique user number
+		:param args: arguments of func.get_properties
+		:return: None
+		"""
+		self.__submit(id_user, ('properties',) + args, get_properties, *args)
+
+	def photos(self, id_user: int, list_id_hotels: list, limit: Optional[int] = None) -> None:
+		"""
+		The function starts loading photo link templates of the first hotels into the cache,
+		every hotel is a separate task
+		:param id_user: unique user number
+		:param list_id_hotels: list of unique hotel numbers in the order of output
+		:param limit: number of hotels, PREFETCH_PHOTO_HOTELS by default
+		:return: None
+		"""
+		for id_hotel in list_id_hotels[:limit or self.__photo_hotels]:
+			self.__submit(id_user, ('photos', id_hotel), warm_photo_links, [id_hotel])
+
+	def cancel(self, id_user: int) -> None:
+		"""
+		The function cancels the tasks of the user that have not started yet
+		:param id_user: unique user number
+		:return: None
+		"""
+		with self.__lock:
+			tasks = self.__tasks.pop(id_user, {})
+		cancelled = sum(future.cancel() for future in tasks.values())
+		if cancelled:
+			logger.info(f'Отменено задач предварительной загрузки: {cancelled}')
+
+	def __submit(self, id_user: int, key: Hashable, func: Callable, *args) -> None:
+		"""
+		The function submits the task unless the same task of the user is already queued or running
+		:param id_user: unique user number
+		:param key: key of the task
+		:param func: loading function
+		:param args: arguments of the function
+		:return: None
+		"""
+		with self.__lock:
+			tasks = self.__tasks.setdefault(id_user, {})
+			if key in tasks:
+				return
+			future = self.__executor.submit(self.__run, func, *args)
+			tasks[key] = future
+		future.add_done_callback(lambda done: self.__forget(id_user, key, done))
+
+	def __forget(self, id_user: int, key: Hashable, future: Future) -> None:
+		"""
+		The function removes the finished task
+		:param id_user: unique user number
+		:param key: key of the task
+		:param future: finished task
+		:return: None
+		"""
+		with self.__lock:
+			tasks = self.__tasks.get(id_user)
+			if tasks is not None and tasks.get(key) is future:
+				del tasks[key]
+				if not tasks:
+					del self.__tasks[id_user]
+
+	@staticmethod
+	def __run(func: Callable, *args) -> None:
+		"""
+		The function runs the loading function, errors only affect the speed of the answer
+		:param func: loading function
+		:param args: arguments of the function
+		:return: None
+		"""
+		try:
+			func(*args)
+		except Exception as ex:
+			logger.error(f'Ошибка предварительной загрузки', exc_info=ex)
+
+
+prefetcher = Prefetcher(PREFETCH_WORKERS, PREFETCH_PHOTO_HOTELS)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import Callable, Hashable, Optional
+
+from func_async import get_properties, warm_photo_links
+from prefetch import PREFETCH_WORKERS, PREFETCH_PHOTO_HOTELS
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPrefetcher:
+	"""
+	Speculative loading of the data the conversation is going to need on the event loop.
+	At most workers tasks load at the same time, the tasks of a user are cancelled
+	when the user abandons the conversation
+	"""
+
+	def __init__(self, workers: int, photo_hotels: int):
+		self.__workers = workers
+		self.__photo_hotels = photo_hotels
+		self.__tasks = {}
+		self.__semaphore: Optional[asyncio.Semaphore] = None
+
+	def properties(self, id_user: int, *args) -> None:
+		"""
+		The function starts loading the list of hotels into the cache
+		:param id_user: unique user number
+		:param args: arguments of func_async.get_properties
+		:return: None
+		"""
+		self.__submit(id_user, ('properties',) + args, get_properties, *args)
+
+	def photos(self, id_user: int, list_id_hotels: list, limit: Optional[int] = None) -> None:
+		"""
+		The function starts loading photo link templates of the first hotels into the cache,
+		every hotel is a separate task
+		:param id_user: unique user number
+		:param list_id_hotels: list of unique hotel numbers in the order of output
+		:param limit: number of hotels, PREFETCH_PHOTO_HOTELS by default
+		:return: None
+		"""
+		for id_hotel in list_id_hotels[:limit or self.__photo_hotels]:
+			self.__submit(id_user, ('photos', id_hotel), warm_photo_links, [id_hotel])
+
+	def cancel(self, id_user: int) -> None:
+		"""
+		The function cancels the unfinished tasks of the user
+		:param id_user: unique user number
+		:return: None
+		"""
+		cancelled = sum(task.cancel() for task in self.__tasks.pop(id_user, {}).values())
+		if cancelled:
+			logger.info(f'Отменено задач предварительной загрузки: {cancelled}')
+
+	def __submit(self, id_user: int, key: Hashable, func: Callable, *args) -> None:
+		"""
+		The function creates the task unless the same task of the user is already running
+		:param id_user: unique user number
+		:param key: key of the task
+		:param func: loading coroutine function
+		:param args: arguments of the function
+		:return: None
+		"""
+		if self.__semaphore is None:
+			self.__semaphore = asyncio.Semaphore(self.__workers)
+		tasks = self.__tasks.setdefault(id_user, {})
+		if key in tasks:
+			return
+		task = asyncio.ensure_future(self.__run(func, *args))
+		tasks[key] = task
+		task.add_done_callback(lambda done: self.__forget(id_user, key, done))
+
+	def __forget(self, id_user: int, key: Hashable, task: asyncio.Task) -> None:
+		"""
+		The function removes the finished task
+		:param id_user: unique user number
+		:param key: key of the task
+		:param task: finished task
+		:return: None
+		"""
+		tasks = self.__tasks.get(id_user)
+		if tasks is not None and tasks.get(key) is task:
+			del tasks[key]
+			if not tasks:
+				del self.__tasks[id_user]
+
+	async def __run(self, func: Callable, *args) -> None:
+		"""
+		The function runs the loading function, errors only affect the speed of the answer
+		:param func: loading coroutine function
+		:param args: arguments of the function
+		:return: None
+		"""
+		async with self.__semaphore:
+			try:
+				await func(*args)
+			except Exception as ex:
+				logger.error(f'Ошибка предварительной загрузки', exc_info=ex)
+
+
+async_prefetcher = AsyncPrefetcher(PREFETCH_WORKERS, PREFETCH_PHOTO_HOTELS)
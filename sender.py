@@ -0,0 +1,292 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+from dotenv import load_dotenv
+from telebot.apihelper import ApiTelegramException
+
+from metrics import OUTBOX_WAIT_SECONDS
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', 3))
+GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 30))
+GLOBAL_BURST = float(os.getenv('OUTBOX_GLOBAL_BURST', 30))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+
+
+class TokenBucket:
+	"""
+	Token bucket limiting the rate of requests
+	"""
+
+	def __init__(self, rate: float, capacity: float):
+		self.__rate = rate
+		self.__capacity = capacity
+		self.__tokens = capacity
+		self.__updated = time.monotonic()
+
+	def ready_at(self, now: float) -> float:
+		"""
+		The function returns the moment when one token will be available
+		:param now: current monotonic time
+		:return: monotonic time when a request may be made
+		"""
+		tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+		return now if tokens >= 1 else now + (1 - tokens) / self.__rate
+
+	def take(self, now: float) -> None:
+		"""
+		The function takes one token from the bucket
+		:param now: current monotonic time
+		:return: None
+		"""
+		self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate) - 1
+		self.__updated = now
+
+	def full(self, now: float) -> bool:
+		"""
+		The function checks whether the bucket has been refilled completely
+		:param now: current monotonic time
+		:return: True if the bucket is full
+		"""
+		return self.__tokens + (now - self.__updated) * self.__rate >= self.__capacity
+
+
+class _Job:
+	__slots__ = ('chat_id', 'func', 'args', 'kwargs', 'future', 'attempts', 'queued')
+
+	def __init__(self, chat_id: int, func: Callable, args: tuple, kwargs: dict, future: Any):
+		self.chat_id = chat_id
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.future = future
+		self.attempts = 0
+		self.queued = time.monotonic()
+
+
+class OutboundQueue:
+	"""
+	Queues of outgoing requests to the Telegram Bot API with the per-chat and global rate limits.
+	Requests of one chat are taken one at a time in the order of priority and submission,
+	on error 429 the chat is paused for retry_after seconds and the request is queued again.
+	The queues are not synchronized, the schedulers call them under their lock or in their event loop
+	"""
+	api_exception = ApiTelegramException
+
+	def __init__(self, chat_rate: float, chat_burst: float, global_rate: float, global_burst: float,
+				 max_attempts: int):
+		self.__chat_rate = chat_rate
+		self.__chat_burst = chat_burst
+		self.__global = TokenBucket(global_rate, global_burst)
+		self.__max_attempts = max_attempts
+		self.__queues = {}
+		self.__buckets = {}
+		self.__paused = {}
+		self.__busy = set()
+		self.__sequence = itertools.count()
+
+	def _push(self, chat_id: int, func: Callable, args: tuple, kwargs: dict, priority: int, future: Any) -> None:
+		"""
+		The function queues a request
+		:param chat_id: unique chat number the request is sent to
+		:param func: method of the bot
+		:param args: positional arguments of the method
+		:param kwargs: keyword arguments of the method
+		:param priority: priority of the request, PRIORITY_HIGH is sent first
+		:param future: future receiving the result of the method
+		:return: None
+		"""
+		job = _Job(chat_id, func, args, kwargs, future)
+		heapq.heappush(self.__queues.setdefault(chat_id, []), (priority, next(self.__sequence), job))
+
+	def _idle(self) -> bool:
+		"""
+		The function checks whether all queued requests are sent
+		:return: True if no request is queued or being sent
+		"""
+		return not self.__queues and not self.__busy
+
+	def _poll(self, now: float) -> tuple:
+		"""
+		The function takes the request that may be sent now
+		:param now: current monotonic time
+		:return: tuple (request or None, monotonic time when a request may be ready or None if there are none)
+		"""
+		best, wake_at = None, None
+		for chat_id, jobs in self.__queues.items():
+			if chat_id in self.__busy or not jobs:
+				continue
+			bucket = self.__buckets.get(chat_id)
+			ready = max(bucket.ready_at(now) if bucket else now, self.__paused.get(chat_id, now))
+			if ready <= now:
+				if best is None or jobs[0][:2] < self.__queues[best][0][:2]:
+					best = chat_id
+			elif wake_at is None or ready < wake_at:
+				wake_at = ready
+		if best is not None:
+			global_ready = self.__global.ready_at(now)
+			if global_ready <= now:
+				return self.__take(best, now), None
+			wake_at = global_ready
+		return None, wake_at
+
+	def _failed(self, job: _Job, ex: Exception) -> Optional[float]:
+		"""
+		The function logs the error of the request and decides whether the request is repeated
+		:param job: request
+		:param ex: error of the method
+		:return: delay in seconds before the request is repeated or None if the request has failed
+		"""
+		if isinstance(ex, self.api_exception) and ex.error_code == 429 and job.attempts < self.__max_attempts:
+			retry_after = ex.result_json.get('parameters', {}).get('retry_after', 1)
+			logger.warning(f'Превышен лимит Telegram для чата {job.chat_id}, повтор через {retry_after} с')
+			return retry_after
+		logger.error(f'Ошибка отправки сообщения в чат {job.chat_id}', exc_info=ex)
+		return None
+
+	def _release(self, job: _Job, retry_after: Optional[float]) -> None:
+		"""
+		The function lets the next request of the chat be taken, the failed request is queued first again
+		:param job: sent request
+		:param retry_after: delay in seconds before the request is repeated or None
+		:return: None
+		"""
+		self.__busy.discard(job.chat_id)
+		if retry_after is not None:
+			self.__paused[job.chat_id] = time.monotonic() + retry_after
+			job.queued = time.monotonic()
+			heapq.heappush(self.__queues.setdefault(job.chat_id, []), (PRIORITY_HIGH, -1, job))
+
+	def __take(self, chat_id: int, now: float) -> _Job:
+		"""
+		The function takes the first request of the chat and spends the tokens of the chat and the global bucket
+		:param chat_id: unique chat number
+		:param now: current monotonic time
+		:return: request to send
+		"""
+		job = heapq.heappop(self.__queues[chat_id])[2]
+		if not self.__queues[chat_id]:
+			del self.__queues[chat_id]
+		bucket = self.__buckets.get(chat_id)
+		if bucket is None:
+			bucket = self.__buckets[chat_id] = TokenBucket(self.__chat_rate, self.__chat_burst)
+		bucket.take(now)
+		self.__global.take(now)
+		self.__paused.pop(chat_id, None)
+		self.__busy.add(chat_id)
+		for idle_chat_id in [key for key, value in self.__buckets.items()
+							 if key not in self.__queues and key not in self.__busy and value.full(now)]:
+			del self.__buckets[idle_chat_id]
+		OUTBOX_WAIT_SECONDS.observe(now - job.queued)
+		job.attempts += 1
+		return job
+
+
+class OutboundScheduler(OutboundQueue):
+	"""
+	Scheduler of outgoing requests to the Telegram Bot API.
+	Requests are queued by priority without blocking the handler and sent by a pool of workers
+	within the per-chat and global rate limits. Requests of one chat are sent one at a time
+	in the order of priority and submission. On error 429 the chat is paused for retry_after seconds
+	"""
+
+	def __init__(self, chat_rate: float, chat_burst: float, global_rate: float, global_burst: float, workers: int,
+				 max_attempts: int):
+		super().__init__(chat_rate, chat_burst, global_rate, global_burst, max_attempts)
+		self.__workers = workers
+		lock = threading.Lock()
+		self.__condition = threading.Condition(lock)
+		self.__drained = threading.Condition(lock)
+		self.__threads = []
+
+	def submit(self, chat_id: int, func: Callable, /, *args, priority: int = PRIORITY_NORMAL, **kwargs) -> Future:
+		"""
+		The function queues a request to the Telegram Bot API and returns immediately
+		:param chat_id: unique chat number the request is sent to
+		:param func: method of the bot, for example bot.send_message
+		:param args: positional arguments of the method
+		:param priority: priority of the request, PRIORITY_HIGH is sent first
+		:param kwargs: keyword arguments of the method, chat_id may be passed here as well
+		:return: future with the result of the method
+		"""
+		future = Future()
+		with self.__condition:
+			self.__start()
+			self._push(chat_id, func, args, kwargs, priority, future)
+			self.__condition.notify()
+		return future
+
+	def join(self, timeout: float) -> bool:
+		"""
+		The function waits until all queued requests are sent
+		:param timeout: timeout in seconds
+		:return: True if the queue is empty
+		"""
+		deadline = time.monotonic() + timeout
+		with self.__drained:
+			while not self._idle():
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				self.__drained.wait(remaining)
+		return True
+
+	def __start(self) -> None:
+		"""
+		The function starts the workers on the first request
+		:return: None
+		"""
+		if not self.__threads:
+			for number in range(self.__workers):
+				thread = threading.Thread(target=self.__run, name=f'outbox-{number}', daemon=True)
+				thread.start()
+				self.__threads.append(thread)
+
+	def __next_job(self) -> _Job:
+		"""
+		The function waits for the request that may be sent now and takes it from the queue
+		:return: request to send
+		"""
+		with self.__condition:
+			while True:
+				now = time.monotonic()
+				job, wake_at = self._poll(now)
+				if job is not None:
+					return job
+				self.__condition.wait(None if wake_at is None else wake_at - now)
+
+	def __run(self) -> None:
+		"""
+		The function sends queued requests until the process ends
+		:return: None
+		"""
+		while True:
+			job = self.__next_job()
+			retry_after = None
+			try:
+				job.future.set_result(job.func(*job.args, **job.kwargs))
+			except Exception as ex:
+				retry_after = self._failed(job, ex)
+				if retry_after is None:
+					job.future.set_exception(ex)
+			with self.__condition:
+				self._release(job, retry_after)
+				self.__condition.notify_all()
+				self.__drained.notify_all()
+
+
+outbox = OutboundScheduler(CHAT_RATE, CHAT_BURST, GLOBAL_RATE, GLOBAL_BURST, OUTBOX_WORKERS, MAX_ATTEMPTS)
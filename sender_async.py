@@ -0,0 +1,117 @@
+import asyncio
+import time
+from typing import Any, Callable, Optional
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from sender import CHAT_BURST, CHAT_RATE, GLOBAL_BURST, GLOBAL_RATE, MAX_ATTEMPTS, OUTBOX_WORKERS, PRIORITY_NORMAL
+from sender import OutboundQueue
+
+
+class AsyncOutboundScheduler(OutboundQueue):
+	"""
+	Scheduler of outgoing requests to the Telegram Bot API on the event loop.
+	Requests are queued like in sender.OutboundScheduler, with the same per-chat and global rate limits,
+	priorities and pauses on error 429, and sent by worker tasks instead of threads
+	"""
+	api_exception = ApiTelegramException
+
+	def __init__(self, chat_rate: float, chat_burst: float, global_rate: float, global_burst: float, workers: int,
+				 max_attempts: int):
+		super().__init__(chat_rate, chat_burst, global_rate, global_burst, max_attempts)
+		self.__workers = workers
+		self.__tasks = []
+		self.__wakeup: Optional[asyncio.Event] = None
+		self.__drained: Optional[asyncio.Event] = None
+
+	def submit(self, chat_id: int, func: Callable, /, *args, priority: int = PRIORITY_NORMAL,
+			   **kwargs) -> asyncio.Future:
+		"""
+		The function queues a request to the Telegram Bot API and returns immediately
+		:param chat_id: unique chat number the request is sent to
+		:param func: coroutine method of the bot, for example bot.send_message
+		:param args: positional arguments of the method
+		:param priority: priority of the request, PRIORITY_HIGH is sent first
+		:param kwargs: keyword arguments of the method, chat_id may be passed here as well
+		:return: future with the result of the method
+		"""
+		future = asyncio.get_running_loop().create_future()
+		self.__start()
+		self._push(chat_id, func, args, kwargs, priority, future)
+		self.__wakeup.set()
+		return future
+
+	async def join(self, timeout: float) -> bool:
+		"""
+		The function waits until all queued requests are sent
+		:param timeout: timeout in seconds
+		:return: True if the queue is empty
+		"""
+		deadline = time.monotonic() + timeout
+		while not self._idle():
+			self.__drained.clear()
+			try:
+				await asyncio.wait_for(self.__drained.wait(), deadline - time.monotonic())
+			except asyncio.TimeoutError:
+				return False
+		return True
+
+	async def close(self) -> None:
+		"""
+		The function stops the workers
+		:return: None
+		"""
+		for task in self.__tasks:
+			task.cancel()
+		await asyncio.gather(*self.__tasks, return_exceptions=True)
+		self.__tasks = []
+
+	def __start(self) -> None:
+		"""
+		The function starts the workers on the first request
+		:return: None
+		"""
+		if not self.__tasks:
+			self.__wakeup = asyncio.Event()
+			self.__drained = asyncio.Event()
+			self.__tasks = [asyncio.ensure_future(self.__run()) for _ in range(self.__workers)]
+
+	async def __next_job(self) -> Any:
+		"""
+		The function waits for the request that may be sent now and takes it from the queue
+		:return: request to send
+		"""
+		while True:
+			now = time.monotonic()
+			job, wake_at = self._poll(now)
+			if job is not None:
+				return job
+			self.__wakeup.clear()
+			try:
+				await asyncio.wait_for(self.__wakeup.wait(), None if wake_at is None else wake_at - now)
+			except asyncio.TimeoutError:
+				pass
+
+	async def __run(self) -> None:
+		"""
+		The function sends queued requests until the workers are stopped
+		:return: None
+		"""
+		while True:
+			job = await self.__next_job()
+			retry_after = None
+			try:
+				result = await job.func(*job.args, **job.kwargs)
+				if not job.future.done():
+					job.future.set_result(result)
+			except Exception as ex:
+				retry_after = self._failed(job, ex)
+				if retry_after is None and not job.future.done():
+					job.future.set_exception(ex)
+					job.future.exception()  # the error is logged, a request nobody waits for is not reported again
+			self._release(job, retry_after)
+			self.__wakeup.set()
+			self.__drained.set()
+
+
+async_outbox = AsyncOutboundScheduler(CHAT_RATE, CHAT_BURST, GLOBAL_RATE, GLOBAL_BURST, OUTBOX_WORKERS, MAX_ATTEMPTS)
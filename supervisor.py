@@ -0,0 +1,367 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import threading
+import time
+import zlib
+
+import telebot
+from dotenv import load_dotenv
+from telebot.types import Update
+
+from webhook import UpdateDispatcher, get_chat_id
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 4))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 1000))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 30))
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', 10))
+HEALTH_PATH = os.getenv('HEALTH_PATH', 'health.json')
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 20))
+
+
+def _run_worker(number: int, updates: multiprocessing.Queue, status: multiprocessing.Queue, threads: int,
+				queue_size: int, drain_timeout: float, health_interval: float) -> None:
+	"""
+	The function processes the updates of the shard in a worker process until the None sentinel is received,
+	then waits for the queued updates, the conversations and the outgoing messages
+	:param number: number of the worker
+	:param updates: queue of the updates of the shard
+	:param status: queue of the health reports for the supervisor
+	:param threads: number of threads processing the updates, the updates of one chat go to one thread
+	:param queue_size: maximum number of updates waiting for a thread
+	:param drain_timeout: timeout of sending the queued messages on stop in seconds
+	:param health_interval: interval of the health reports in seconds
+	:return: None
+	"""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGHUP, signal.SIG_IGN)
+	logging.basicConfig(level=logging.INFO, filename='bot.log', filemode='a',
+						format=f'%(asctime)s - worker {number} - %(levelname)s - %(message)s',
+						datefmt='%d-%b-%y %H:%M:%S')
+	from conversation import conversations
+	from main import bot
+	from metrics import start_exporter, worker_exporter
+	from sender import outbox
+
+	start_exporter(*worker_exporter(number))
+	bot.threaded = False
+	dispatcher = UpdateDispatcher(bot, threads, queue_size)
+	dispatcher.start()
+	started = time.time()
+	stopped = threading.Event()
+
+	def report(state: str) -> None:
+		status.put(dict(dispatcher.stats(), worker=number, pid=os.getpid(), state=state, time=time.time(),
+						uptime=time.time() - started, rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+	def heartbeat() -> None:
+		while not stopped.wait(health_interval):
+			report('running')
+
+	report('running')
+	threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+	logger.info(f'Воркер {number} запущен, pid {os.getpid()}')
+	while True:
+		update = updates.get()
+		if update is None:
+			break
+		dispatcher.put(update)
+	dispatcher.stop()
+	conversations.flush()
+	if not outbox.join(drain_timeout):
+		logger.warning(f'Воркер {number} не успел отправить все сообщения за {drain_timeout} с')
+	stopped.set()
+	report('stopped')
+	logger.info(f'Воркер {number} остановлен')
+
+
+class _Worker:
+	"""
+	Worker process of a shard and the queue of its updates
+	"""
+
+	def __init__(self, updates: multiprocessing.Queue):
+		self.updates = updates
+		self.process = None
+		self.restarts = 0
+		self.report = {}
+		self.heartbeat = time.monotonic()
+
+
+class Supervisor:
+	"""
+	Runs the handlers of the bot in several worker processes.
+	Every update is routed to the worker of its shard by the hash of the chat number, so the updates of one chat
+	are processed by one worker in order, and the worker keeps the conversations of its chats in memory.
+	A worker that dies or stops reporting is restarted, SIGHUP restarts the workers one by one:
+	the updates of the shard wait in a new queue while the old worker drains its queue.
+	Has the start, put and stop methods of UpdateDispatcher, so it can receive the updates of the webhook
+	"""
+
+	def __init__(self, workers: int, threads: int, queue_size: int, drain_timeout: float, health_interval: float,
+				 health_path: str):
+		self.__context = multiprocessing.get_context('spawn')
+		self.__threads = threads
+		self.__queue_size = queue_size
+		self.__drain_timeout = drain_timeout
+		self.__health_interval = health_interval
+		self.__health_path = health_path
+		self.__status = self.__context.Queue()
+		self.__workers = [_Worker(self.__context.Queue(queue_size)) for _ in range(workers)]
+		self.__lock = threading.Lock()
+		self.__restart = threading.Event()
+		self.__stopping = threading.Event()
+		self.__monitor = None
+
+	def start(self) -> None:
+		"""
+		The function starts the worker processes and the monitor thread
+		:return: None
+		"""
+		for number in range(len(self.__workers)):
+			self.__spawn(number)
+		self.__monitor = threading.Thread(target=self.__run_monitor, name='supervisor', daemon=True)
+		self.__monitor.start()
+
+	def put(self, update: Update) -> None:
+		"""
+		The function passes the update to the worker of its chat
+		:param update: object of type Update of class telebot
+		:return: None
+		"""
+		key = get_chat_id(update)
+		if key is None:
+			key = update.update_id
+		number = zlib.crc32(str(key).encode()) % len(self.__workers)
+		with self.__lock:
+			self.__workers[number].updates.put(update)
+
+	def restart(self) -> None:
+		"""
+		The function requests the rolling restart of the workers, it is safe to call from a signal handler
+		:return: None
+		"""
+		self.__restart.set()
+
+	def stop(self) -> None:
+		"""
+		The function waits until the workers process the queued updates and stops them
+		:return: None
+		"""
+		self.__stopping.set()
+		if self.__monitor:
+			self.__monitor.join()
+		with self.__lock:
+			workers = list(self.__workers)
+		for worker in workers:
+			worker.updates.put(None)
+		for number, worker in enumerate(workers):
+			self.__join(number, worker)
+		self.__collect()
+		self.__write_health()
+		logger.info('Воркеры остановлены')
+
+	def health(self) -> list:
+		"""
+		The function returns the last reports of the workers
+		:return: list of dictionaries with the state of every worker
+		"""
+		now = time.monotonic()
+		list_health = []
+		for number, worker in enumerate(self.__workers):
+			try:
+				queued = worker.updates.qsize()
+			except NotImplementedError:
+				queued = None
+			list_health.append(dict(worker.report, worker=number, restarts=worker.restarts, queued=queued,
+									alive=bool(worker.process and worker.process.is_alive()),
+									heartbeat_age=round(now - worker.heartbeat, 1)))
+		return list_health
+
+	def __spawn(self, number: int) -> None:
+		"""
+		The function starts the process of the worker on the queue of its shard
+		:param number: number of the worker
+		:return: None
+		"""
+		worker = self.__workers[number]
+		worker.process = self.__context.Process(target=_run_worker, name=f'bot-worker-{number}',
+												args=(number, worker.updates, self.__status, self.__threads,
+													  self.__queue_size, self.__drain_timeout, self.__health_interval))
+		worker.process.start()
+		worker.heartbeat = time.monotonic()
+
+	def __join(self, number: int, worker: _Worker) -> None:
+		"""
+		The function waits for the worker to drain its queue and terminates it after the timeout
+		:param number: number of the worker
+		:param worker: stopped worker
+		:return: None
+		"""
+		worker.process.join(self.__drain_timeout)
+		if worker.process.is_alive():
+			logger.error(f'Воркер {number} не остановился за {self.__drain_timeout} с и будет завершен')
+			worker.process.terminate()
+			worker.process.join()
+
+	def __rolling_restart(self) -> None:
+		"""
+		The function restarts the workers one by one, the updates of the shard are not lost and keep their order
+		:return: None
+		"""
+		logger.info('Поочередный перезапуск воркеров')
+		for number in range(len(self.__workers)):
+			with self.__lock:
+				old = self.__workers[number]
+				new = self.__workers[number] = _Worker(self.__context.Queue(self.__queue_size))
+				new.restarts = old.restarts + 1
+				old.updates.put(None)
+			self.__join(number, old)
+			self.__spawn(number)
+
+	def __replace_queue(self, number: int) -> None:
+		"""
+		The function gives a new queue to the shard of the killed worker,
+		the old queue may be locked by the worker and its updates are dropped
+		:param number: number of the worker
+		:return: None
+		"""
+		with self.__lock:
+			old = self.__workers[number]
+			new = self.__workers[number] = _Worker(self.__context.Queue(self.__queue_size))
+			new.restarts = old.restarts + 1
+			try:
+				lost = old.updates.qsize()
+			except NotImplementedError:
+				lost = '?'
+			old.updates.cancel_join_thread()
+		logger.error(f'Потеряно обновлений воркера {number}: {lost}')
+
+	def __run_monitor(self) -> None:
+		"""
+		The function collects the reports of the workers, restarts the workers that died or stopped reporting
+		and writes the health report every health_interval seconds
+		:return: None
+		"""
+		written = time.monotonic()
+		while not self.__stopping.wait(1):
+			self.__collect()
+			if self.__restart.is_set():
+				self.__restart.clear()
+				self.__rolling_restart()
+				self.__collect()  # the reports sent by the new workers while the old ones were draining
+			now = time.monotonic()
+			for number, worker in enumerate(self.__workers):
+				if not worker.process.is_alive():
+					logger.error(f'Воркер {number} завершился с кодом {worker.process.exitcode}, перезапуск')
+				elif now - worker.heartbeat > 3 * self.__health_interval + 10:
+					logger.error(f'Воркер {number} не отвечает {now - worker.heartbeat:.0f} с, перезапуск')
+					worker.process.kill()
+					worker.process.join()
+				else:
+					continue
+				self.__replace_queue(number)
+				self.__spawn(number)
+			if now - written >= self.__health_interval:
+				written = now
+				self.__write_health()
+
+	def __collect(self) -> None:
+		"""
+		The function takes the reports of the workers from the status queue
+		:return: None
+		"""
+		while True:
+			try:
+				report = self.__status.get_nowait()
+			except queue.Empty:
+				return
+			worker = self.__workers[report['worker']]
+			if worker.process and worker.process.pid == report['pid']:
+				worker.report = report
+				worker.heartbeat = time.monotonic()
+
+	def __write_health(self) -> None:
+		"""
+		The function logs the health of the workers and writes it to health_path in json
+		:return: None
+		"""
+		list_health = self.health()
+		for item in list_health:
+			logger.info(f'Воркер {item["worker"]}: pid {item.get("pid")}, работает {item["alive"]}, '
+						f'обработано {item.get("processed", 0)}, ошибок {item.get("failed", 0)}, '
+						f'в очереди {item["queued"]}, перезапусков {item["restarts"]}, '
+						f'отчет {item["heartbeat_age"]} с назад')
+		if self.__health_path:
+			temp_path = f'{self.__health_path}.tmp'
+			with open(temp_path, 'w') as file:
+				json.dump({'time': time.time(), 'workers': list_health}, file, indent=2)
+			os.replace(temp_path, self.__health_path)
+
+
+def poll_updates(bot: telebot.TeleBot, supervisor: Supervisor, stopped: threading.Event) -> None:
+	"""
+	The function receives the updates by long polling and passes them to the supervisor until stopped is set,
+	then confirms the received updates to Telegram
+	:param bot: object of class TeleBot
+	:param supervisor: supervisor of the workers
+	:param stopped: event of the stop of the bot
+	:return: None
+	"""
+	offset = None
+	while not stopped.is_set():
+		try:
+			updates = bot.get_updates(offset, timeout=POLLING_TIMEOUT + 5, long_polling_timeout=POLLING_TIMEOUT)
+		except Exception as ex:
+			logger.error('Ошибка получения обновлений', exc_info=ex)
+			stopped.wait(3)
+			continue
+		for update in updates:
+			supervisor.put(update)
+			offset = update.update_id + 1
+	if offset is not None:
+		try:
+			bot.get_updates(offset, limit=1, timeout=5, long_polling_timeout=0)
+		except Exception as ex:
+			logger.error('Ошибка подтверждения обновлений', exc_info=ex)
+
+
+def run_supervisor(bot: telebot.TeleBot, workers: int = BOT_WORKERS) -> None:
+	"""
+	The function runs the bot in the worker processes, the updates are received by long polling
+	or through the webhook with BOT_MODE=webhook. SIGTERM and SIGINT stop the bot after the workers drain
+	their queues, SIGHUP restarts the workers one by one
+	:param bot: object of class TeleBot
+	:param workers: number of the worker processes
+	:return: None
+	"""
+	supervisor = Supervisor(workers, WORKER_THREADS, WORKER_QUEUE_SIZE, DRAIN_TIMEOUT, HEALTH_INTERVAL, HEALTH_PATH)
+	signal.signal(signal.SIGHUP, lambda signum, frame: supervisor.restart())
+	logger.info(f'Запуск {workers} воркеров')
+	if os.getenv('BOT_MODE', 'polling') == 'webhook':
+		from webhook import run_webhook
+
+		def stop_webhook(signum: int, frame) -> None:
+			raise SystemExit(0)
+
+		signal.signal(signal.SIGTERM, stop_webhook)
+		run_webhook(bot, supervisor)
+		return
+
+	stopped = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+	signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+	supervisor.start()
+	poller = threading.Thread(target=poll_updates, args=(bot, supervisor, stopped), name='polling', daemon=True)
+	poller.start()
+	while poller.is_alive():
+		poller.join(1)
+	supervisor.stop()
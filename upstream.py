@@ -0,0 +1,187 @@
+import logging
+import os
+import threading
+import time
+from typing import Mapping, Optional
+
+from dotenv import load_dotenv
+
+from metrics import UPSTREAM_CIRCUIT, UPSTREAM_EVENTS, UPSTREAM_QUOTA
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', 5))
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))
+QUOTA_RESERVE = float(os.getenv('QUOTA_RESERVE', 0.1))
+QUOTA_MAX_DELAY = float(os.getenv('QUOTA_MAX_DELAY', 2))
+
+QUOTA_LIMIT_HEADER = 'x-ratelimit-requests-limit'
+QUOTA_REMAINING_HEADER = 'x-ratelimit-requests-remaining'
+QUOTA_RESET_HEADER = 'x-ratelimit-requests-reset'
+
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+
+class UpstreamUnavailable(Exception):
+	"""
+	The request to the hotels service is not made because its circuit is open or its quota is exhausted
+	"""
+
+
+class _Circuit:
+	"""
+	Circuit breaker of one endpoint
+	"""
+
+	def __init__(self):
+		self.state = CLOSED
+		self.failures = 0
+		self.opened_at = 0.0
+		self.trial = False
+
+
+class UpstreamGuard:
+	"""
+	Guard of the requests to the hotels service.
+	Every endpoint has a circuit breaker: after failure_threshold failures in a row the endpoint fails fast
+	for open_seconds, then one trial request decides whether the circuit closes or opens again.
+	The quota of the api key is taken from the x-ratelimit-requests-* headers of the responses,
+	when less than the reserve share of the quota remains, the requests are spread evenly until the reset
+	of the quota, and the requests that would wait longer than max_delay are rejected
+	"""
+
+	def __init__(self, failure_threshold: int, open_seconds: float, quota_reserve: float, max_delay: float):
+		self.__failure_threshold = failure_threshold
+		self.__open_seconds = open_seconds
+		self.__quota_reserve = quota_reserve
+		self.__max_delay = max_delay
+		self.__circuits = {}
+		self.__limit = None
+		self.__remaining = None
+		self.__reset_at = 0.0
+		self.__next_at = 0.0
+		self.__lock = threading.Lock()
+
+	def acquire(self, endpoint: str) -> float:
+		"""
+		The function checks whether the request to the endpoint may be made
+		:param endpoint: path of the endpoint, for example "properties/list"
+		:return: delay in seconds the caller has to wait before the request
+		:raise UpstreamUnavailable: if the circuit of the endpoint is open or the quota is exhausted
+		"""
+		now = time.monotonic()
+		with self.__lock:
+			circuit = self.__circuits.setdefault(endpoint, _Circuit())
+			if circuit.state == OPEN and now - circuit.opened_at >= self.__open_seconds:
+				self.__set_state(endpoint, circuit, HALF_OPEN)
+			if circuit.state == OPEN or circuit.state == HALF_OPEN and circuit.trial:
+				UPSTREAM_EVENTS.inc(endpoint, 'rejected')
+				raise UpstreamUnavailable(f'circuit of {endpoint} is open')
+			delay = self.__quota_delay(endpoint, now)
+			if circuit.state == HALF_OPEN:
+				circuit.trial = True
+		return delay
+
+	def record(self, endpoint: str, status: Optional[int], headers: Optional[Mapping] = None) -> None:
+		"""
+		The function records the outcome of the request to the endpoint
+		:param endpoint: path of the endpoint
+		:param status: status code of the response or None if the request failed without a response
+		:param headers: headers of the response
+		:return: None
+		"""
+		with self.__lock:
+			if headers:
+				self.__update_quota(headers)
+			circuit = self.__circuits.setdefault(endpoint, _Circuit())
+			circuit.trial = False
+			if status is not None and status < 500 and status != 429:
+				circuit.failures = 0
+				if circuit.state != CLOSED:
+					self.__set_state(endpoint, circuit, CLOSED)
+				return
+			circuit.failures += 1
+			if circuit.state == HALF_OPEN or circuit.failures >= self.__failure_threshold:
+				circuit.opened_at = time.monotonic()
+				if circuit.state != OPEN:
+					UPSTREAM_EVENTS.inc(endpoint, 'opened')
+					self.__set_state(endpoint, circuit, OPEN)
+
+	def release(self, endpoint: str) -> None:
+		"""
+		The function frees the trial slot of the endpoint taken by a request that was cancelled before its outcome,
+		the cancellation is not a failure of the service and is not counted by the circuit breaker
+		:param endpoint: path of the endpoint
+		:return: None
+		"""
+		with self.__lock:
+			self.__circuits.setdefault(endpoint, _Circuit()).trial = False
+
+	def stale(self, endpoint: str) -> None:
+		"""
+		The function counts the answer of the endpoint served from an expired cache entry
+		:param endpoint: path of the endpoint
+		:return: None
+		"""
+		UPSTREAM_EVENTS.inc(endpoint, 'stale')
+
+	def __quota_delay(self, endpoint: str, now: float) -> float:
+		"""
+		The function spends one request of the quota and returns the delay spreading the rest of the quota
+		:param endpoint: path of the endpoint
+		:param now: current monotonic time
+		:return: delay in seconds
+		"""
+		if self.__remaining is None or now >= self.__reset_at:
+			return 0.0
+		if self.__remaining <= 0:
+			UPSTREAM_EVENTS.inc(endpoint, 'rejected')
+			raise UpstreamUnavailable('quota of the hotels service is exhausted')
+		delay = 0.0
+		if self.__remaining < self.__limit * self.__quota_reserve:
+			delay = max(0.0, self.__next_at - now)
+			if delay > self.__max_delay:
+				UPSTREAM_EVENTS.inc(endpoint, 'rejected')
+				raise UpstreamUnavailable('quota of the hotels service is almost exhausted')
+			self.__next_at = max(now, self.__next_at) + (self.__reset_at - now) / self.__remaining
+			if delay:
+				UPSTREAM_EVENTS.inc(endpoint, 'throttled')
+		self.__remaining -= 1
+		return delay
+
+	def __update_quota(self, headers: Mapping) -> None:
+		"""
+		The function takes the state of the quota from the headers of the response
+		:param headers: headers of the response
+		:return: None
+		"""
+		try:
+			limit = int(headers[QUOTA_LIMIT_HEADER])
+			remaining = int(headers[QUOTA_REMAINING_HEADER])
+			reset = float(headers[QUOTA_RESET_HEADER])
+		except (KeyError, ValueError):
+			return
+		if self.__remaining is not None and remaining < limit * self.__quota_reserve <= self.__remaining:
+			logger.warning(f'Квота сервиса отелей почти исчерпана: осталось {remaining} из {limit} запросов')
+		self.__limit, self.__remaining = limit, remaining
+		self.__reset_at = time.monotonic() + reset
+		UPSTREAM_QUOTA.set(remaining)
+
+	def __set_state(self, endpoint: str, circuit: _Circuit, state: int) -> None:
+		"""
+		The function changes the state of the circuit of the endpoint
+		:param endpoint: path of the endpoint
+		:param circuit: circuit of the endpoint
+		:param state: CLOSED, OPEN or HALF_OPEN
+		:return: None
+		"""
+		if state == OPEN:
+			logger.error(f'Сервис отелей {endpoint} недоступен, запросы отклоняются {self.__open_seconds} с')
+		elif state == CLOSED:
+			logger.info(f'Сервис отелей {endpoint} снова доступен')
+		circuit.state = state
+		UPSTREAM_CIRCUIT.set(state, endpoint)
+
+
+upstream_guard = UpstreamGuard(CIRCUIT_FAILURES, CIRCUIT_OPEN_SECONDS, QUOTA_RESERVE, QUOTA_MAX_DELAY)
@@ -0,0 +1,207 @@
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+import telebot
+from dotenv import load_dotenv
+from telebot.types import Update
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+
+
+def get_chat_id(update: Update) -> Optional[int]:
+	"""
+	The function returns the number of the chat the update belongs to
+	:param update: object of type Update of class telebot
+	:return: unique chat number or None if the update is not bound to a chat
+	"""
+	if update.message:
+		return update.message.chat.id
+	if update.edited_message:
+		return update.edited_message.chat.id
+	if update.callback_query:
+		if update.callback_query.message:
+			return update.callback_query.message.chat.id
+		return update.callback_query.from_user.id
+	return None
+
+
+class UpdateDispatcher:
+	"""
+	Pool of workers processing updates of the bot.
+	All updates of one chat go to the same worker, so they are processed in the order of arrival
+	"""
+
+	def __init__(self, bot: telebot.TeleBot, workers: int, queue_size: int):
+		self.__bot = bot
+		self.__processed = 0
+		self.__failed = 0
+		self.__lock = threading.Lock()
+		self.__queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+		self.__threads = [threading.Thread(target=self.__run, args=(q,), name=f'update-worker-{number}', daemon=True)
+						  for number, q in enumerate(self.__queues)]
+
+	def start(self) -> None:
+		"""
+		The function starts the workers
+		:return: None
+		"""
+		for thread in self.__threads:
+			thread.start()
+
+	def put(self, update: Update) -> None:
+		"""
+		The function puts the update into the queue of the worker serving its chat
+		:param update: object of type Update of class telebot
+		:return: None
+		"""
+		chat_id = get_chat_id(update)
+		key = chat_id if chat_id is not None else update.update_id
+		self.__queues[hash(key) % len(self.__queues)].put(update)
+
+	def stats(self) -> dict:
+		"""
+		The function returns the counters of the dispatcher
+		:return: dictionary with the numbers of processed, failed and queued updates
+		"""
+		with self.__lock:
+			processed, failed = self.__processed, self.__failed
+		return {'processed': processed, 'failed': failed, 'pending': sum(q.qsize() for q in self.__queues)}
+
+	def stop(self) -> None:
+		"""
+		The function waits until the queued updates are processed and stops the workers
+		:return: None
+		"""
+		for q in self.__queues:
+			q.put(None)
+		for thread in self.__threads:
+			thread.join()
+
+	def __run(self, updates: queue.Queue) -> None:
+		"""
+		The function processes updates from the queue of the worker one by one
+		:param updates: queue of the worker
+		:return: None
+		"""
+		while True:
+			update = updates.get()
+			if update is None:
+				break
+			failed = False
+			try:
+				self.__bot.process_new_updates([update])
+			except Exception as ex:
+				failed = True
+				logger.error(f'Ошибка обработки обновления {update.update_id}', exc_info=ex)
+			with self.__lock:
+				self.__processed += 1
+				self.__failed += failed
+
+
+def make_handler(dispatcher: UpdateDispatcher, path: str, secret: str) -> type:
+	"""
+	The function returns the request handler class of the webhook server
+	:param dispatcher: dispatcher receiving the updates
+	:param path: path of the webhook
+	:param secret: secret token every request must carry in the X-Telegram-Bot-Api-Secret-Token header
+	:return: request handler class
+	"""
+
+	class WebhookHandler(BaseHTTPRequestHandler):
+
+		def do_POST(self) -> None:
+			if self.path != path:
+				self.send_error(404)
+				return
+			token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+			if not hmac.compare_digest(token, secret):
+				self.send_error(403)
+				return
+			try:
+				length = int(self.headers.get('Content-Length', 0))
+				data = json.loads(self.rfile.read(length))
+				if not isinstance(data, dict):
+					raise ValueError(f'update is {type(data).__name__}, not an object')
+				update = Update.de_json(data)
+			except (ValueError, KeyError, TypeError, AttributeError) as ex:
+				logger.error(f'Ошибка разбора обновления webhook', exc_info=ex)
+				self.send_error(400)
+				return
+			dispatcher.put(update)
+			self.send_response(200)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+
+		def log_message(self, format: str, *args) -> None:
+			logger.debug(format, *args)
+
+	return WebhookHandler
+
+
+def set_webhook(bot: telebot.TeleBot, url: str, secret: str) -> None:
+	"""
+	The function registers the url of the webhook with Telegram
+	:param bot: object of class TeleBot
+	:param url: public url of the webhook
+	:param secret: secret token Telegram will send with every update
+	:return: None
+	"""
+	params = {'url': url, 'secret_token': secret}
+	telebot.apihelper._make_request(bot.token, 'setWebhook', params=params, method='post')
+
+
+def get_secret() -> str:
+	"""
+	The function returns the secret token of the webhook: WEBHOOK_SECRET or, when the url of the webhook
+	is registered by the bot itself, a random token registered together with it
+	:return: secret token
+	:raise SystemExit: if WEBHOOK_SECRET is not set and WEBHOOK_URL is not set either
+	"""
+	if WEBHOOK_SECRET:
+		return WEBHOOK_SECRET
+	if WEBHOOK_URL:
+		logger.info(f'WEBHOOK_SECRET не задан, для webhook создан случайный секрет')
+		return secrets.token_urlsafe(32)
+	logger.error(f'Для BOT_MODE=webhook нужен WEBHOOK_SECRET или WEBHOOK_URL')
+	raise SystemExit('WEBHOOK_SECRET is required with BOT_MODE=webhook unless WEBHOOK_URL is set')
+
+
+def run_webhook(bot: telebot.TeleBot, dispatcher: Optional[Any] = None) -> None:
+	"""
+	The function receives updates of the bot through a webhook instead of long polling,
+	only the requests with the secret token of the webhook are accepted
+	:param bot: object of class TeleBot
+	:param dispatcher: receiver of the updates with the start, put and stop methods,
+					   by default the updates are processed by UpdateDispatcher in this process
+	:return: None
+	"""
+	secret = get_secret()
+	if dispatcher is None:
+		bot.threaded = False
+		dispatcher = UpdateDispatcher(bot, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+	dispatcher.start()
+	if WEBHOOK_URL:
+		set_webhook(bot, WEBHOOK_URL, secret)
+	server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), make_handler(dispatcher, WEBHOOK_PATH, secret))
+	logger.info(f'Start webhook server on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		dispatcher.stop()